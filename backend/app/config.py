@@ -12,13 +12,70 @@ class Settings(BaseSettings):
     vision_ai_api_key: str = ""
     vision_ai_model: str = "meta-llama/llama-4-scout-17b-16e-instruct"
 
+    # Shared HTTP client for AI APIs (app/services/http_client.py)
+    http2: bool = True  # needs the h2 package, falls back to HTTP/1.1
+    http_max_connections: int = 20
+    http_max_keepalive_connections: int = 10
+    http_keepalive_expiry: float = 120.0
+    http_connect_timeout: float = 5.0
+    http_prewarm: bool = True
+    # Per-operation read timeouts, seconds
+    ai_text_timeout: float = 30.0
+    ai_vision_timeout: float = 60.0
+    # Photos for vision analysis are downscaled to this side in pixels and
+    # re-encoded to at most this many bytes (app/services/image_service.py)
+    vision_image_max_side: int = 1024
+    vision_image_max_bytes: int = 400_000
+    # Cached AI answers (app/services/ai_cache.py): lifetime in seconds
+    # (0 disables) and in-memory size
+    ai_cache_ttl: float = 86400.0
+    ai_cache_size: int = 2000
+    # Also keep answers in the ai_cache collection so they survive restarts
+    ai_cache_persistent: bool = True
+    # Turns with history skip the cache unless enabled; then the key includes
+    # the last ai_cache_history_turns messages
+    ai_cache_with_history: bool = False
+    ai_cache_history_turns: int = 2
+    # Chat history sent to the model, estimated tokens; older turns are
+    # folded into a cached summary (app/services/context_builder.py)
+    ai_history_token_budget: int = 2000
+    ai_summary_max_tokens: int = 300
+    ai_summary_cache_size: int = 1000
+    # AI chat sessions loaded by session_id: messages per session, cached
+    # sessions and their lifetime in seconds
+    chat_history_limit: int = 100
+    chat_history_cache_size: int = 1000
+    chat_history_cache_ttl: float = 600.0
+
     # MongoDB
     mongodb_url: str = "mongodb://localhost:27017"
+    # Create missing indexes from app/db/indexes.py in the background on connect
+    mongo_ensure_indexes: bool = True
+
+    # SQLite fallback
+    sqlite_read_pool_size: int = 4
+    sqlite_busy_timeout_ms: int = 5000
+    # Seconds to wait for a free reader connection before failing
+    sqlite_acquire_timeout: float = 30.0
+    sqlite_codec: str = "auto"  # auto | orjson | json
+
+    # Cached totals for large listing results, seconds (0 disables)
+    query_total_cache_ttl: float = 30.0
+
+    # Buffered product view counts: flush period in seconds and buffer size
+    view_flush_interval: float = 5.0
+    view_flush_threshold: int = 500
 
     # Auth
     jwt_secret: str = "change-me-in-production-very-secret-key"
     jwt_algorithm: str = "HS256"
     jwt_expiration_hours: int = 168  # 7 days
+    # Users cached by the auth middleware: entry lifetime in seconds and size
+    user_cache_ttl: float = 60.0
+    user_cache_size: int = 10000
+    # Verified JWT payloads: entry lifetime in seconds (capped by exp) and size
+    token_cache_ttl: float = 300.0
+    token_cache_size: int = 10000
 
     # App
     env: str = "development"
@@ -0,0 +1,154 @@
+"""
+Кодек документов SQLite fallback: dict <-> JSON-текст в колонке data.
+
+Бэкенд выбирается при старте (настройка sqlite_codec): orjson, если он
+установлен, иначе stdlib json. Формат на диске в обоих случаях один —
+JSON-текст, потому что фильтры и обновления работают через
+json_extract()/json_set() внутри SQLite. msgpack поэтому не подходит.
+
+datetime хранится строкой ISO 8601 фиксированной ширины (всегда с
+микросекундами), чтобы строки сравнивались и сортировались в SQL так же,
+как datetime в Python. При чтении в datetime превращаются только поля из
+DATETIME_FIELDS коллекции — остальные строки не трогаются.
+
+Версия формата хранится в PRAGMA user_version (см. FORMAT_VERSION):
+0 — старый формат (stdlib json, datetime переменной ширины),
+1 — datetime фиксированной ширины. Декодер читает оба.
+"""
+
+import json
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - зависит от окружения
+    orjson = None
+
+FORMAT_VERSION = 1
+
+# Поля с datetime по коллекциям; "messages.created_at" — поле элементов массива.
+# chat_sessions хранит время строками ISO, их не преобразуем.
+DATETIME_FIELDS: Dict[str, List[str]] = {
+    "users": ["created_at", "updated_at"],
+    "products": ["created_at", "updated_at"],
+    "favorites": ["created_at"],
+    "conversations": ["created_at", "updated_at", "last_message_at", "messages.created_at"],
+    "messages": ["created_at"],
+    "ai_cache": ["created_at", "expires_at"],
+}
+
+
+def format_datetime(value: datetime) -> str:
+    """ISO 8601 фиксированной ширины: 2025-01-01T00:00:00.000000[+00:00]."""
+    return value.isoformat(timespec="microseconds")
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, datetime):
+        return format_datetime(obj)
+    raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
+
+
+def _stdlib_dumps(obj: Any, sort_keys: bool = False) -> str:
+    return json.dumps(obj, default=_default, ensure_ascii=False, sort_keys=sort_keys)
+
+
+def _orjson_dumps(obj: Any, sort_keys: bool = False) -> str:
+    # Без OPT_PASSTHROUGH_DATETIME orjson опускает нулевые микросекунды
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=_default, option=option).decode()
+
+
+def select_backend(name: str = "auto") -> Tuple[str, Callable[..., str], Callable[[str], Any]]:
+    """(имя, dumps, loads) для настройки sqlite_codec: auto | orjson | json."""
+    if name not in ("auto", "orjson", "json"):
+        raise ValueError(f"Unknown SQLite codec: {name}")
+    if name == "json" or orjson is None:
+        if name == "orjson":
+            print("[WARNING] orjson is not installed, using stdlib json")
+        return "json", _stdlib_dumps, json.loads
+    return "orjson", _orjson_dumps, orjson.loads
+
+
+_backend_name, dumps, loads = select_backend()
+
+
+def configure(name: str) -> str:
+    """Выбрать бэкенд кодека; возвращает имя выбранного."""
+    global _backend_name, dumps, loads
+    _backend_name, dumps, loads = select_backend(name)
+    return _backend_name
+
+
+def backend_name() -> str:
+    return _backend_name
+
+
+def _parse_datetime(value: Any) -> Any:
+    if type(value) is not str:
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def _restorer(path: str) -> Callable[[Any], None]:
+    """Функция, заменяющая строку по пути на datetime (через массивы тоже)."""
+    head, _, rest = path.partition(".")
+
+    if not rest:
+        def restore(node: Any):
+            if isinstance(node, dict):
+                value = node.get(head)
+                if value is not None:
+                    node[head] = _parse_datetime(value)
+            elif isinstance(node, list):
+                for item in node:
+                    restore(item)
+        return restore
+
+    inner = _restorer(rest)
+
+    def restore(node: Any):
+        if isinstance(node, dict):
+            child = node.get(head)
+            if child is not None:
+                inner(child)
+        elif isinstance(node, list):
+            for item in node:
+                restore(item)
+
+    return restore
+
+
+class DocumentCodec:
+    """Кодирование документов одной коллекции."""
+
+    def __init__(self, datetime_fields: Optional[List[str]] = None):
+        self.datetime_fields = list(datetime_fields or [])
+        self._restorers = [_restorer(path) for path in self.datetime_fields]
+
+    def encode(self, value: Any) -> str:
+        """Документ или значение оператора обновления -> JSON-текст."""
+        return dumps(value)
+
+    def decode(self, data: str) -> dict:
+        return self.restore(loads(data))
+
+    def decode_value(self, data: str) -> Any:
+        """JSON-фрагмент (колонка проекции) без восстановления datetime."""
+        return loads(data)
+
+    def restore(self, doc: dict) -> dict:
+        """Заменить строки в DATETIME_FIELDS документа на datetime."""
+        for restore in self._restorers:
+            restore(doc)
+        return doc
+
+
+def codec_for(collection: str) -> DocumentCodec:
+    return DocumentCodec(DATETIME_FIELDS.get(collection))
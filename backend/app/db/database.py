@@ -1,26 +1,64 @@
 """
 Database module with MongoDB primary and SQLite fallback.
 
-ВАЖНО: Предыдущая реализация была ошибочной потому что:
+ВАЖНО: Первая реализация была ошибочной потому что:
 1. aiosqlite.connect() создаёт внутренний thread для работы с SQLite
 2. Этот thread нельзя переиспользовать после закрытия соединения
 3. Сохранение connection в переменной и повторное использование вызывает
    "RuntimeError: threads can only be started once"
 
-РЕШЕНИЕ: Каждая операция открывает НОВОЕ соединение через async with.
-Это безопасно для SQLite т.к. он поддерживает множественные соединения.
+Открывать НОВОЕ соединение на каждую операцию безопасно, но дорого:
+каждый вызов порождает поток и заново открывает файл.
+
+РЕШЕНИЕ: SQLiteConnectionPool открывает соединения один раз в connect_db()
+и закрывает их в close_db(). Закрытое соединение никогда не открывается
+повторно — при следующем open() пул создаёт новые объекты соединений.
+Чтение идёт через ограниченный пул reader-соединений, запись — через
+единственное writer-соединение под asyncio.Lock (WAL допускает одного
+писателя и параллельных читателей).
 """
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, InvalidOperation
+from app.cache import TTLCache
 from app.config import get_settings
 import certifi
 import aiosqlite
-import json
+import asyncio
+import sqlite3
+import weakref
 import os
-from typing import Optional, Any, List
-from datetime import datetime
+from contextlib import asynccontextmanager
+from typing import Optional, Any, Callable, Dict, List, NamedTuple
 import re
 
+from app.db import codec
+from app.db.codec import codec_for
+from app.db.indexes import (
+    ARRAY_FIELDS,
+    CHILD_ARRAYS,
+    TEXT_INDEXES,
+    ChildArray,
+    column_name,
+    index_name,
+    indexed_fields,
+    sqlite_indexes,
+)
+from app.db.matcher import compile_matcher
+from app.db.models import generate_id
+from app.db.mongo_indexes import ensure_indexes
+from app.db.projection import Projection, slice_bounds
+from app.db.sqlite_query import (
+    QueryCompiler,
+    SortSpec,
+    UnsupportedQuery,
+    json_path,
+    normalize_sort,
+    sqlite_regexp,
+)
+from app.db.sqlite_update import UpdateCompiler
+
 settings = get_settings()
 
 # Global database instance
@@ -33,209 +71,765 @@ SQLITE_DB_PATH = os.path.join(
 )
 
 
-def json_serializer(obj):
-    """Сериализатор для datetime и других объектов."""
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
+# =============================================================================
+# SQLite Connection Pool
+# =============================================================================
+
+class SQLiteConnectionPool:
+    """
+    Долгоживущие соединения SQLite: пул читателей и один писатель.
+
+    Соединения создаются в open() и живут до close(). Повторно открыть
+    закрытый пул можно — open() всегда создаёт новые объекты соединений,
+    поэтому "threads can only be started once" не возникает.
+    """
 
+    # Применяются к каждому соединению при открытии
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous = NORMAL;"
+        "PRAGMA temp_store = MEMORY;"
+        "PRAGMA cache_size = -16000;"  # 16 MB на соединение
+        "PRAGMA mmap_size = 134217728;"  # 128 MB
+        "PRAGMA foreign_keys = ON;"
+    )
 
-def json_deserializer(data: str) -> dict:
-    """Десериализатор с восстановлением datetime."""
-    obj = json.loads(data)
-    # Восстанавливаем datetime поля
-    for key in ["created_at", "updated_at"]:
-        if key in obj and obj[key]:
+    def __init__(self, db_path: str, readers: int = 4, busy_timeout_ms: int = 5000, acquire_timeout: float = 30.0):
+        self.db_path = db_path
+        self.readers = max(1, readers)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.acquire_timeout = acquire_timeout
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._reader_queue: Optional[asyncio.Queue] = None
+        self._all_readers: List[aiosqlite.Connection] = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _open_connection(self, read_only: bool) -> aiosqlite.Connection:
+        # isolation_level=None: транзакциями управляем явно (BEGIN IMMEDIATE)
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        conn.row_factory = aiosqlite.Row
+        # executescript не оставляет незавершённых курсоров от PRAGMA,
+        # иначе открытый statement удерживает блокировку файла
+        pragmas = f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)};"
+        pragmas += self.CONNECTION_PRAGMAS
+        if read_only:
+            pragmas += "PRAGMA query_only = ON;"
+        await conn.executescript(pragmas)
+        # Функции для скомпилированных запросов ($regex -> regexp())
+        await conn.create_function("regexp", 2, sqlite_regexp, deterministic=True)
+        return conn
+
+    async def open(self):
+        """Открыть писателя и пул читателей."""
+        if self.is_open:
+            return
+
+        writer = await self._open_connection(read_only=False)
+        # WAL сохраняется в файле БД, достаточно включить один раз писателем
+        await writer.executescript("PRAGMA journal_mode = WAL;")
+
+        queue: asyncio.Queue = asyncio.Queue()
+        readers = []
+        for _ in range(self.readers):
+            conn = await self._open_connection(read_only=True)
+            readers.append(conn)
+            queue.put_nowait(conn)
+
+        self._writer = writer
+        self._all_readers = readers
+        self._reader_queue = queue
+
+    async def close(self):
+        """Закрыть все соединения. Пул можно снова открыть через open()."""
+        writer, readers = self._writer, self._all_readers
+        self._writer = None
+        self._all_readers = []
+        self._reader_queue = None
+
+        for conn in readers:
+            await conn.close()
+        if writer is not None:
+            # Обновляем статистику планировщика и переносим WAL в основной файл
             try:
-                obj[key] = datetime.fromisoformat(obj[key])
-            except (ValueError, TypeError):
+                await writer.executescript("PRAGMA optimize; PRAGMA wal_checkpoint(TRUNCATE);")
+            except sqlite3.Error:
                 pass
-    return obj
+            await writer.close()
+
+    def _ensure_open(self):
+        if not self.is_open:
+            raise RuntimeError("SQLite pool is not open; call connect_db() first")
+
+    @asynccontextmanager
+    async def reader(self):
+        """
+        Взять reader-соединение из пула на время блока.
+
+        Если за acquire_timeout секунд соединение не освободилось, падает
+        с sqlite3.OperationalError, а не ждёт бесконечно.
+        """
+        self._ensure_open()
+        queue = self._reader_queue
+        try:
+            conn = await asyncio.wait_for(queue.get(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise sqlite3.OperationalError(
+                f"No SQLite reader connection available within {self.acquire_timeout}s"
+            ) from None
+        try:
+            yield conn
+        finally:
+            queue.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """
+        Эксклюзивное writer-соединение внутри транзакции.
+
+        COMMIT при успешном выходе из блока, ROLLBACK при исключении.
+        """
+        self._ensure_open()
+        async with self._writer_lock:
+            conn = self._writer
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            await conn.execute("COMMIT")
 
 
 # =============================================================================
-# SQLite Implementation - каждая операция открывает новое соединение
+# SQLite Implementation - операции через общий пул соединений
 # =============================================================================
 
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class InsertManyResult:
+    def __init__(self, inserted_ids: List[Any]):
+        self.inserted_ids = inserted_ids
+
+
+class UpdateResult:
+    def __init__(self, matched_count: int, modified_count: int, upserted_id: Any = None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+    
+    @classmethod
+    def from_bulk(cls, result: dict) -> "UpdateResult":
+        upserted = result["upserted"]
+        return cls(result["nMatched"], result["nModified"], upserted[0]["_id"] if upserted else None)
+
+
+class DeleteResult:
+    def __init__(self, deleted_count: int):
+        self.deleted_count = deleted_count
+
+
+class BulkWriteResult:
+    """Итог bulk_write(); bulk_api_result — словарь в формате MongoDB."""
+    
+    def __init__(self, bulk_api_result: dict):
+        self.bulk_api_result = bulk_api_result
+        self.inserted_count = bulk_api_result["nInserted"]
+        self.matched_count = bulk_api_result["nMatched"]
+        self.modified_count = bulk_api_result["nModified"]
+        self.deleted_count = bulk_api_result["nRemoved"]
+        self.upserted_count = bulk_api_result["nUpserted"]
+        self.upserted_ids = {item["index"]: item["_id"] for item in bulk_api_result["upserted"]}
+
+
+class _Write(NamedTuple):
+    """Скомпилированная операция записи для SQLiteCollection._bulk_write()."""
+    index: int
+    op: Any
+    kind: str  # "insert" | "update" | "delete"
+    sql: str  # для update/delete — без WHERE
+    params: list
+    query: Optional[dict] = None
+    sort: Optional[SortSpec] = None
+    limit: Optional[int] = None
+    upsert: Optional[dict] = None  # документ для вставки, если ничего не найдено
+    apply_after_upsert: bool = False
+    # Запись в дочерние таблицы: функции [id документов] -> [(sql, [params, ...])]
+    children: tuple = ()
+
+
+def _upsert_seed(query: Optional[dict]) -> dict:
+    """Документ для upsert из полей равенства фильтра (как в MongoDB)."""
+    seed = {}
+    for key, value in (query or {}).items():
+        if key.startswith("$") or "." in key:
+            continue
+        if isinstance(value, dict) and any(k.startswith("$") for k in value):
+            if "$eq" not in value:
+                continue
+            value = value["$eq"]
+        seed[key] = value
+    seed.setdefault("_id", generate_id())
+    return seed
+
+
+def _new_result() -> dict:
+    """Пустой результат bulk-записи в формате bulk_api_result MongoDB."""
+    return {
+        "writeErrors": [],
+        "nInserted": 0,
+        "nUpserted": 0,
+        "nMatched": 0,
+        "nModified": 0,
+        "nRemoved": 0,
+        "upserted": [],
+    }
+
+
+def _count_write(result: dict, kind: str, rowcount: int):
+    if kind == "insert":
+        result["nInserted"] += rowcount
+    elif kind == "update":
+        result["nMatched"] += rowcount
+        result["nModified"] += rowcount
+    else:
+        result["nRemoved"] += rowcount
+
+
 class SQLiteCollection:
     """
     Эмулирует MongoDB Collection API для SQLite.
     
-    КРИТИЧНО: Не сохраняем connection! Каждый метод открывает своё соединение.
+    Соединения берутся из SQLiteConnectionPool: чтение через reader(),
+    запись через writer(). Сами соединения коллекция не хранит.
     """
     
-    def __init__(self, table_name: str):
+    # SQL-выражение полного документа строки таблицы
+    document_sql = "data"
+    
+    def __init__(self, table_name: str, pool: SQLiteConnectionPool):
         self.table_name = table_name
-        self.db_path = SQLITE_DB_PATH
+        self.name = table_name
+        self.pool = pool
+        # Поля с индексированными generated-колонками (см. app/db/indexes.py)
+        self.columns = indexed_fields(table_name)
+        self.text_fields = TEXT_INDEXES.get(table_name, [])
+        self.text_table = f"{table_name}_fts" if self.text_fields else None
+        self.codec = codec_for(table_name)
+        self.array_fields = ARRAY_FIELDS.get(table_name, [])
     
-    async def find_one(self, query: dict) -> Optional[dict]:
+    def _compile(self, query: Optional[dict]) -> Optional[tuple]:
+        """
+        Скомпилировать фильтр в (compiler, where, params).
+
+        None означает, что запрос не выражается в SQL и документы нужно
+        фильтровать в Python через compile_matcher().
+        """
+        compiler = QueryCompiler(
+            columns=self.columns,
+            table=self.table_name,
+            text_table=self.text_table,
+            array_fields=self.array_fields,
+        )
+        try:
+            where, params = compiler.compile(query)
+        except UnsupportedQuery:
+            return None
+        return compiler, where, params
+    
+    def _select(self, columns: str, compiled: tuple, tail: str = "") -> tuple:
+        """SELECT по скомпилированному фильтру: (sql, params)."""
+        compiler, where, params = compiled
+        from_sql, from_params = compiler.from_clause()
+        sql = f"SELECT {columns} {from_sql} WHERE {where} {tail}"
+        return sql, [*from_params, *params]
+    
+    async def _scan(self, conn, query: dict) -> List[dict]:
+        """Запасной путь: прочитать всю таблицу и отфильтровать в Python."""
+        async with conn.execute(f"SELECT {self.document_sql} FROM {self.table_name}") as cursor:
+            rows = await cursor.fetchall()
+        
+        matches = compile_matcher(query, self.text_fields)
+        results = []
+        for row in rows:
+            doc = self.codec.decode(row[0])
+            if matches(doc):
+                results.append(doc)
+        return results
+    
+    def _columns(self, projection: Optional[Projection]) -> str:
+        """Список колонок SELECT для проекции (или весь документ)."""
+        if projection is None:
+            return self.document_sql
+        return ", ".join(sql for _, sql in projection.columns())
+    
+    def _decode_row(self, row: tuple, projection: Optional[Projection]) -> dict:
+        if projection is None:
+            return self.codec.decode(row[0])
+        return projection.assemble(row, self.codec)
+    
+    async def find_one(self, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
         """Найти один документ по запросу."""
-        async with aiosqlite.connect(self.db_path) as conn:
-            conn.row_factory = aiosqlite.Row
+        compiled = self._compile(query)
+        projection = Projection(projection) if projection is not None else None
+        
+        async with self.pool.reader() as conn:
+            if compiled is None:
+                docs = await self._scan(conn, query)
+                if not docs:
+                    return None
+                return projection.apply(docs[0]) if projection else docs[0]
             
-            # Поиск по _id
-            if "_id" in query:
-                cursor = await conn.execute(
-                    f"SELECT data FROM {self.table_name} WHERE id = ?",
-                    (query["_id"],)
-                )
+            sql, params = self._select(self._columns(projection), compiled, "LIMIT 1")
+            async with conn.execute(sql, params) as cursor:
                 row = await cursor.fetchone()
-                if row:
-                    return json_deserializer(row["data"])
-                return None
-            
-            # Поиск по другим полям (сканируем все записи)
-            cursor = await conn.execute(f"SELECT data FROM {self.table_name}")
-            rows = await cursor.fetchall()
-            
-            for row in rows:
-                doc = json_deserializer(row["data"])
-                if self._matches(doc, query):
-                    return doc
-            
-            return None
+        
+        return self._decode_row(row, projection) if row else None
     
-    async def insert_one(self, document: dict) -> Any:
+    async def insert_one(self, document: dict) -> InsertOneResult:
         """Вставить документ."""
         doc_id = document.get("_id", "")
         
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute(
-                f"INSERT OR REPLACE INTO {self.table_name} (id, data) VALUES (?, ?)",
-                (doc_id, json.dumps(document, default=json_serializer))
+        try:
+            async with self.pool.writer() as conn:
+                # Upsert по id сохраняет rowid; нарушение уникального индекса
+                # по другим полям — ошибка, как в MongoDB
+                await conn.execute(
+                    f"INSERT INTO {self.table_name} (id, data) VALUES (?, ?) "
+                    f"ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                    (doc_id, self._encode(document))
+                )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e), 11000)
+        
+        return InsertOneResult(doc_id)
+    
+    def _encode(self, value: Any) -> str:
+        """Сериализовать значение в JSON-текст для записи в data."""
+        return self.codec.encode(value)
+    
+    def _where(
+        self,
+        query: dict,
+        sort: Optional[SortSpec] = None,
+        limit: Optional[int] = None,
+    ) -> Optional[tuple]:
+        """Условие WHERE по rowid для фильтра, если он компилируется в SQL."""
+        compiled = self._compile(query)
+        if compiled is None:
+            return None
+        
+        compiler = compiled[0]
+        tail = compiler.compile_sort(normalize_sort(sort or []))
+        if limit is not None:
+            tail += f" LIMIT {int(limit)}"
+        sql, params = self._select(f"{self.table_name}.rowid", compiled, tail)
+        return f"rowid IN ({sql})", params
+    
+    async def _target(
+        self,
+        conn,
+        query: dict,
+        sort: Optional[SortSpec] = None,
+        limit: Optional[int] = None,
+    ) -> tuple:
+        """
+        Условие WHERE для строк, подходящих под фильтр: (sql, params).
+        
+        Вызывается на writer-соединении внутри транзакции, поэтому выбор
+        строк и их изменение атомарны.
+        """
+        where = self._where(query, sort, limit)
+        if where is not None:
+            return where
+        
+        docs = await self._scan(conn, query)
+        if sort or limit is not None:
+            cursor = SQLiteCursor(self, query).sort(sort or [])
+            docs = cursor._sort_and_slice(docs, limit if limit is not None else len(docs))
+        ids = [doc["_id"] for doc in docs]
+        if not ids:
+            return "0", []
+        return f"id IN ({', '.join('?' * len(ids))})", ids
+    
+    # -------------------------------------------------------------------------
+    # Запись: все операции изменения идут через bulk-движок
+    # -------------------------------------------------------------------------
+    
+    def _prepare(self, index: int, op: Any) -> _Write:
+        """Скомпилировать операцию pymongo (InsertOne, UpdateOne, ...) в _Write."""
+        kind = type(op).__name__
+        table = self.table_name
+        
+        if kind == "InsertOne":
+            document = op._doc
+            document.setdefault("_id", generate_id())
+            return _Write(
+                index, op, "insert",
+                f"INSERT INTO {table} (id, data) VALUES (?, ?)",
+                [document["_id"], self._encode(document)],
             )
-            await conn.commit()
         
-        # Возвращаем объект с inserted_id как в MongoDB
-        class InsertResult:
-            def __init__(self, id):
-                self.inserted_id = id
+        if kind in ("DeleteOne", "DeleteMany"):
+            limit = 1 if kind == "DeleteOne" else None
+            return _Write(index, op, "delete", f"DELETE FROM {table}", [], op._filter, None, limit)
         
-        return InsertResult(doc_id)
+        if kind == "ReplaceOne":
+            if any(key.startswith("$") for key in op._doc):
+                raise ValueError("replacement can not include $ operators")
+            upsert = None
+            if op._upsert:
+                upsert = {**_upsert_seed(op._filter), **op._doc}
+            return _Write(
+                index, op, "update",
+                f"UPDATE {table} SET data = json_set(?, '$._id', id)",
+                [self._encode(op._doc)],
+                op._filter, getattr(op, "_sort", None), 1, upsert,
+            )
+        
+        if kind in ("UpdateOne", "UpdateMany"):
+            set_sql, set_params = UpdateCompiler(self._encode, op._array_filters).compile(op._doc)
+            limit = 1 if kind == "UpdateOne" else None
+            return _Write(
+                index, op, "update",
+                f"UPDATE {table} SET data = {set_sql}",
+                set_params,
+                op._filter, getattr(op, "_sort", None), limit,
+                _upsert_seed(op._filter) if op._upsert else None,
+                apply_after_upsert=True,
+            )
+        
+        raise TypeError(f"{kind} is not a valid bulk write request")
     
-    async def update_one(self, query: dict, update: dict) -> Any:
-        """Обновить один документ."""
-        doc = await self.find_one(query)
-        modified = 0
+    async def _bulk_write(self, requests: List[Any], ordered: bool) -> dict:
+        """
+        Выполнить операции в одной транзакции writer-соединения.
         
-        if doc:
-            # Применяем $set
-            if "$set" in update:
-                doc.update(update["$set"])
-            
-            # Применяем $inc
-            if "$inc" in update:
-                for key, value in update["$inc"].items():
-                    doc[key] = doc.get(key, 0) + value
-            
-            # Сохраняем обновлённый документ
-            async with aiosqlite.connect(self.db_path) as conn:
-                await conn.execute(
-                    f"UPDATE {self.table_name} SET data = ? WHERE id = ?",
-                    (json.dumps(doc, default=json_serializer), doc["_id"])
-                )
-                await conn.commit()
-            modified = 1
+        Подряд идущие операции с одинаковым SQL (например, $inc по _id для
+        разных товаров) выполняются одним executemany(). Ошибки уникальных
+        индексов собираются в writeErrors как в MongoDB: ordered=True
+        останавливается на первой ошибке, ordered=False выполняет остальные.
+        Уже выполненные операции при этом сохраняются.
+        """
+        writes = [self._prepare(index, op) for index, op in enumerate(requests)]
+        result = _new_result()
         
-        class UpdateResult:
-            def __init__(self, count):
-                self.modified_count = count
+        async with self.pool.writer() as conn:
+            batch: list = []
+            for write in writes:
+                statement = self._statement(write)
+                single = statement is None or write.upsert is not None or bool(write.children)
+                if batch and (single or statement[0] != batch[0][1]):
+                    ok = await self._execute_batch(conn, batch, result, ordered)
+                    batch = []
+                    if not ok and ordered:
+                        break
+                
+                if not single:
+                    batch.append((write, *statement))
+                    continue
+                if statement is None:
+                    # Фильтр не компилируется — строки выбираются в Python
+                    where, params = await self._target(conn, write.query, write.sort, write.limit)
+                    statement = (f"{write.sql} WHERE {where}", [*write.params, *params])
+                if not await self._execute_one(conn, write, *statement, result) and ordered:
+                    break
+            else:
+                if batch:
+                    await self._execute_batch(conn, batch, result, ordered)
         
-        return UpdateResult(modified)
+        return result
     
-    async def delete_one(self, query: dict) -> Any:
-        """Удалить один документ."""
-        # Сначала находим документ
-        doc = await self.find_one(query)
-        deleted = 0
+    def _statement(self, write: _Write) -> Optional[tuple]:
+        """Полный SQL операции или None, если цель нужно искать сканированием."""
+        if write.kind == "insert":
+            return write.sql, write.params
+        where = self._where(write.query, write.sort, write.limit)
+        if where is None:
+            return None
+        return f"{write.sql} WHERE {where[0]}", [*write.params, *where[1]]
+    
+    async def _execute_batch(self, conn, batch: list, result: dict, ordered: bool) -> bool:
+        """executemany() для операций с одинаковым SQL; False при ошибке."""
+        if len(batch) == 1:
+            return await self._execute_one(conn, *batch[0], result)
         
-        if doc:
-            async with aiosqlite.connect(self.db_path) as conn:
-                await conn.execute(
-                    f"DELETE FROM {self.table_name} WHERE id = ?",
-                    (doc["_id"],)
-                )
-                await conn.commit()
-            deleted = 1
+        write, sql, _ = batch[0]
+        await conn.execute("SAVEPOINT bulk_batch")
+        try:
+            cursor = await conn.executemany(sql, [params for _, _, params in batch])
+        except sqlite3.IntegrityError:
+            # Откатить пачку и повторить по одной, чтобы найти сбойные операции
+            await conn.execute("ROLLBACK TO bulk_batch")
+            await conn.execute("RELEASE bulk_batch")
+            ok = True
+            for item in batch:
+                if not await self._execute_one(conn, *item, result):
+                    ok = False
+                    if ordered:
+                        break
+            return ok
+        await conn.execute("RELEASE bulk_batch")
+        
+        _count_write(result, write.kind, cursor.rowcount)
+        return True
+    
+    async def _execute_one(self, conn, write: _Write, sql: str, params: list, result: dict) -> bool:
+        """Выполнить одну операцию (с upsert); False при ошибке уникальности."""
+        try:
+            cursor = await conn.execute(sql, params)
+            if cursor.rowcount == 0 and write.upsert is not None:
+                await self._upsert(conn, write)
+                result["nUpserted"] += 1
+                result["upserted"].append({"index": write.index, "_id": write.upsert["_id"]})
+                return True
+        except sqlite3.IntegrityError as e:
+            result["writeErrors"].append({
+                "index": write.index,
+                "code": 11000,
+                "errmsg": str(e),
+                "op": write.op,
+            })
+            return False
         
-        class DeleteResult:
-            def __init__(self, count):
-                self.deleted_count = count
+        _count_write(result, write.kind, cursor.rowcount)
+        return True
+    
+    async def _upsert(self, conn, write: _Write):
+        """Вставить документ upsert и применить к нему операторы обновления."""
+        document = write.upsert
+        await conn.execute("SAVEPOINT bulk_upsert")
+        try:
+            await conn.execute(
+                f"INSERT INTO {self.table_name} (id, data) VALUES (?, ?)",
+                (document["_id"], self._encode(document)),
+            )
+            if write.apply_after_upsert:
+                await conn.execute(f"{write.sql} WHERE id = ?", [*write.params, document["_id"]])
+        except BaseException:
+            await conn.execute("ROLLBACK TO bulk_upsert")
+            await conn.execute("RELEASE bulk_upsert")
+            raise
+        await conn.execute("RELEASE bulk_upsert")
+    
+    async def _write_one(self, op: Any) -> dict:
+        """Одна операция через bulk-движок; ошибка уникальности — DuplicateKeyError."""
+        result = await self._bulk_write([op], ordered=True)
+        if result["writeErrors"]:
+            error = result["writeErrors"][0]
+            raise DuplicateKeyError(error["errmsg"], error["code"])
+        return result
+    
+    async def bulk_write(self, requests: List[Any], ordered: bool = True) -> BulkWriteResult:
+        """
+        Пакет операций pymongo (InsertOne, UpdateOne, UpdateMany, ReplaceOne,
+        DeleteOne, DeleteMany) в одной транзакции.
+        """
+        requests = list(requests)
+        if not requests:
+            raise InvalidOperation("No operations to execute")
+        
+        result = await self._bulk_write(requests, ordered)
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result)
+    
+    async def insert_many(self, documents: List[dict], ordered: bool = True) -> InsertManyResult:
+        """Вставить документы одной транзакцией; без _id он генерируется."""
+        documents = list(documents)
+        if not documents:
+            raise TypeError("documents must be a non-empty list")
+        await self.bulk_write([InsertOne(document) for document in documents], ordered=ordered)
+        return InsertManyResult([document["_id"] for document in documents])
+    
+    async def update_one(
+        self,
+        query: dict,
+        update: dict,
+        upsert: bool = False,
+        array_filters: Optional[List[dict]] = None,
+    ) -> UpdateResult:
+        """
+        Обновить один документ.
         
-        return DeleteResult(deleted)
+        Операторы компилируются в одно UPDATE ... SET data = json_set(...),
+        поэтому конкурентные $inc/$push не теряются.
+        """
+        result = await self._write_one(UpdateOne(query, update, upsert=upsert, array_filters=array_filters))
+        return UpdateResult.from_bulk(result)
+    
+    async def update_many(
+        self,
+        query: dict,
+        update: dict,
+        upsert: bool = False,
+        array_filters: Optional[List[dict]] = None,
+    ) -> UpdateResult:
+        """Обновить все подходящие документы одним UPDATE."""
+        result = await self._write_one(UpdateMany(query, update, upsert=upsert, array_filters=array_filters))
+        return UpdateResult.from_bulk(result)
+    
+    async def replace_one(self, query: dict, replacement: dict, upsert: bool = False) -> UpdateResult:
+        """Заменить документ целиком, сохранив его _id."""
+        result = await self._write_one(ReplaceOne(query, replacement, upsert=upsert))
+        return UpdateResult.from_bulk(result)
+    
+    async def find_one_and_update(
+        self,
+        query: dict,
+        update: dict,
+        projection: Optional[dict] = None,
+        sort: Optional[SortSpec] = None,
+        return_document: bool = False,
+        array_filters: Optional[List[dict]] = None,
+    ) -> Optional[dict]:
+        """
+        Атомарно обновить один документ и вернуть его.
+        
+        return_document=False (ReturnDocument.BEFORE) — документ до
+        изменения, True (ReturnDocument.AFTER) — после.
+        """
+        # Обновление идёт тем же путём, что update_one(): так учитываются
+        # и дочерние таблицы (см. ChildArrayCollection)
+        write = self._prepare(0, UpdateOne(query, update, array_filters=array_filters))
+        projection = Projection(projection) if projection is not None else None
+        columns = self._columns(projection)
+        
+        async with self.pool.writer() as conn:
+            where, where_params = await self._target(conn, query, sort=sort, limit=1)
+            async with conn.execute(
+                f"SELECT id, {columns} FROM {self.table_name} WHERE {where}", where_params
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            
+            doc_id, before = row[0], tuple(row[1:])
+            result = _new_result()
+            if not await self._execute_one(
+                conn, write, f"{write.sql} WHERE id = ?", [*write.params, doc_id], result
+            ):
+                error = result["writeErrors"][0]
+                raise DuplicateKeyError(error["errmsg"], error["code"])
+            if not return_document:
+                return self._decode_row(before, projection)
+            
+            async with conn.execute(
+                f"SELECT {columns} FROM {self.table_name} WHERE id = ?", [doc_id]
+            ) as cursor:
+                after = await cursor.fetchone()
+        
+        return self._decode_row(after, projection) if after else None
+    
+    async def delete_one(self, query: dict) -> DeleteResult:
+        """Удалить один документ."""
+        result = await self._write_one(DeleteOne(query))
+        return DeleteResult(result["nRemoved"])
+    
+    async def delete_many(self, query: dict) -> DeleteResult:
+        """Удалить все подходящие документы одним DELETE."""
+        result = await self._write_one(DeleteMany(query))
+        return DeleteResult(result["nRemoved"])
     
     async def count_documents(self, query: dict) -> int:
         """Подсчитать документы по запросу."""
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute(f"SELECT data FROM {self.table_name}")
-            rows = await cursor.fetchall()
+        compiled = self._compile(query)
         
-        count = 0
-        for row in rows:
-            doc = json_deserializer(row[0])
-            if self._matches(doc, query):
-                count += 1
+        async with self.pool.reader() as conn:
+            if compiled is None:
+                return len(await self._scan(conn, query))
+            
+            sql, params = self._select("COUNT(*)", compiled)
+            async with conn.execute(sql, params) as cursor:
+                row = await cursor.fetchone()
         
-        return count
+        return row[0]
     
-    def find(self, query: dict = None) -> "SQLiteCursor":
-        """Вернуть курсор для поиска множества документов."""
-        return SQLiteCursor(self, query or {})
-    
-    def _matches(self, doc: dict, query: dict) -> bool:
-        """Проверить, соответствует ли документ запросу."""
-        for key, value in query.items():
-            # Оператор $or
-            if key == "$or":
-                if not any(self._matches(doc, sub_q) for sub_q in value):
-                    return False
-                continue
-            
-            # Вложенные операторы
-            if isinstance(value, dict):
-                doc_value = doc.get(key)
-                
-                # $regex
-                if "$regex" in value:
-                    pattern = value["$regex"]
-                    flags = re.IGNORECASE if value.get("$options") == "i" else 0
-                    if not re.search(pattern, str(doc_value or ""), flags):
-                        return False
-                
-                # $gte, $lte
-                if "$gte" in value:
-                    if (doc_value or 0) < value["$gte"]:
-                        return False
-                if "$lte" in value:
-                    if (doc_value or 0) > value["$lte"]:
-                        return False
-                
-                # $in
-                if "$in" in value:
-                    if doc_value not in value["$in"]:
-                        return False
-            else:
-                # Простое сравнение
-                if doc.get(key) != value:
-                    return False
+    async def find_page(
+        self,
+        query: dict,
+        sort: Optional[SortSpec],
+        skip: int,
+        limit: int,
+    ) -> tuple:
+        """
+        Страница документов и общее число совпадений одним запросом.
         
-        return True
+        Счётчик — некоррелированный подзапрос, SQLite вычисляет его один
+        раз; в отличие от COUNT(*) OVER () он не буферизует JSON всех
+        подходящих строк. Если страница пуста, total считается отдельно.
+        """
+        compiled = self._compile(query)
+        if compiled is None:
+            async with self.pool.reader() as conn:
+                docs = await self._scan(conn, query)
+            cursor = SQLiteCursor(self, query)
+            cursor._sort = normalize_sort(sort or [])
+            cursor._skip_count = skip
+            return cursor._sort_and_slice(docs, limit), len(docs)
+        
+        compiler = compiled[0]
+        count_sql, count_params = self._select("COUNT(*)", compiled)
+        order_by = compiler.compile_sort(normalize_sort(sort or []))
+        page_sql, page_params = self._select(
+            f"{self.document_sql}, ({count_sql}) AS total", compiled, f"{order_by} LIMIT ? OFFSET ?"
+        )
+        
+        async with self.pool.reader() as conn:
+            async with conn.execute(
+                page_sql, [*count_params, *page_params, limit, skip]
+            ) as cursor:
+                rows = await cursor.fetchall()
+            if rows:
+                return [self.codec.decode(row[0]) for row in rows], rows[0][1]
+            
+            async with conn.execute(count_sql, count_params) as cursor:
+                total = (await cursor.fetchone())[0]
+        return [], total
+    
+    def find(self, query: dict = None, projection: Optional[dict] = None) -> "SQLiteCursor":
+        """Вернуть курсор для поиска множества документов."""
+        return SQLiteCursor(self, query or {}, projection)
 
 
 class SQLiteCursor:
-    """Эмулирует MongoDB Cursor для цепочки .sort().skip().limit()"""
+    """
+    Эмулирует MongoDB Cursor для цепочки .sort().skip().limit().
+    
+    Результат можно получить списком (to_list) или читать потоково через
+    async for: строки читаются пачками по batch_size, так что память не
+    зависит от размера коллекции. Reader-соединение берётся из пула только
+    на время чтения пачки — тело цикла может само обращаться к базе, и
+    параллельные итерации не занимают весь пул. Следующая пачка
+    продолжает с последнего rowid (без сортировки) или по OFFSET (с
+    сортировкой, порядок однозначен благодаря rowid в ORDER BY); как и
+    курсор MongoDB, итерация не видит согласованного снимка коллекции.
+    close() завершает итерацию досрочно.
+    """
+    
+    DEFAULT_BATCH_SIZE = 100
+    
+    # to_list() без length и без limit() возвращает не больше стольких документов
+    DEFAULT_LIST_LENGTH = 100
     
-    def __init__(self, collection: SQLiteCollection, query: dict):
+    def __init__(self, collection: SQLiteCollection, query: dict, projection: Optional[dict] = None):
         self.collection = collection
         self.query = query
-        self._sort_field = None
-        self._sort_direction = 1
+        self.projection = Projection(projection) if projection is not None else None
+        self._sort: SortSpec = []
         self._skip_count = 0
-        self._limit_count = 100
+        self._limit_count = 0  # 0 — без ограничения, как в MongoDB
+        self._batch_size = self.DEFAULT_BATCH_SIZE
+        self._iterators: "weakref.WeakSet" = weakref.WeakSet()
+        self._killed = False
     
-    def sort(self, field: str, direction: int = 1) -> "SQLiteCursor":
-        self._sort_field = field
-        self._sort_direction = direction
+    def sort(self, key_or_list, direction: int = None) -> "SQLiteCursor":
+        self._sort = normalize_sort(key_or_list, direction)
         return self
     
     def skip(self, count: int) -> "SQLiteCursor":
@@ -246,72 +840,707 @@ class SQLiteCursor:
         self._limit_count = count
         return self
     
+    def batch_size(self, size: int) -> "SQLiteCursor":
+        """Число строк, забираемых из SQLite за один fetchmany() при async for."""
+        if size < 0:
+            raise ValueError("batch_size must be >= 0")
+        self._batch_size = size or self.DEFAULT_BATCH_SIZE
+        return self
+    
+    async def close(self):
+        """Прервать итерацию."""
+        self._killed = True
+        for iterator in list(self._iterators):
+            await iterator.aclose()
+    
+    def __aiter__(self):
+        iterator = self._iterate()
+        self._iterators.add(iterator)
+        return iterator
+    
+    async def _iterate(self):
+        collection = self.collection
+        compiled = collection._compile(self.query)
+        remaining = self._limit_count or None
+        if self._killed:
+            return
+        
+        if compiled is None and self._sort:
+            # Сортировка в Python требует всех совпадений сразу
+            async with collection.pool.reader() as conn:
+                docs = await collection._scan(conn, self.query)
+            for doc in self._sort_and_slice(docs, remaining or len(docs)):
+                yield self.projection.apply(doc) if self.projection else doc
+            return
+        
+        rowid = f"{collection.table_name}.rowid"
+        if compiled is None:
+            # Без сортировки запасной путь тоже потоковый: фильтр по строкам
+            matches = compile_matcher(self.query, collection.text_fields)
+        else:
+            matches = None
+        skip = self._skip_count
+        fetched = 0
+        last_rowid = None
+        while not self._killed:
+            size = self._batch_size if remaining is None or matches is not None else min(self._batch_size, remaining)
+            if matches is not None:
+                # Keyset по rowid: каждая пачка продолжает с последней строки
+                sql = f"SELECT {collection.document_sql}, {rowid} FROM {collection.table_name}"
+                params = []
+                if last_rowid is not None:
+                    sql += f" WHERE {rowid} > ?"
+                    params.append(last_rowid)
+                sql += f" ORDER BY {rowid} LIMIT ?"
+                params.append(size)
+            elif self._sort:
+                # Порядок с rowid в конце однозначен — пачки идут по OFFSET
+                compiler = compiled[0]
+                columns = collection._columns(self.projection)
+                sql, params = collection._select(
+                    f"{columns}, {rowid}", compiled, f"{compiler.compile_sort(self._sort)} LIMIT ? OFFSET ?"
+                )
+                params = [*params, size, self._skip_count + fetched]
+            else:
+                compiler, where, where_params = compiled
+                if last_rowid is not None:
+                    where, where_params = f"({where}) AND {rowid} > ?", [*where_params, last_rowid]
+                columns = collection._columns(self.projection)
+                sql, params = collection._select(
+                    f"{columns}, {rowid}", (compiler, where, where_params), f"ORDER BY {rowid} LIMIT ? OFFSET ?"
+                )
+                params = [*params, size, self._skip_count if last_rowid is None else 0]
+            
+            # Соединение занято только на время пачки: тело async for может
+            # само обращаться к базе, не дожидаясь конца итерации
+            async with collection.pool.reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                return
+            fetched += len(rows)
+            last_rowid = rows[-1][-1]
+            
+            for row in rows:
+                values = tuple(row)[:-1]
+                if matches is None:
+                    doc = collection._decode_row(values, self.projection)
+                else:
+                    doc = collection.codec.decode(values[0])
+                    if not matches(doc):
+                        continue
+                    if skip:
+                        skip -= 1
+                        continue
+                    if self.projection is not None:
+                        doc = self.projection.apply(doc)
+                yield doc
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+                if self._killed:
+                    return
+            if len(rows) < size:
+                return
+    
     async def to_list(self, length: int = None) -> List[dict]:
         """Выполнить запрос и вернуть список документов."""
-        # Открываем НОВОЕ соединение для этого запроса
-        async with aiosqlite.connect(self.collection.db_path) as conn:
-            cursor = await conn.execute(
-                f"SELECT data FROM {self.collection.table_name}"
-            )
-            rows = await cursor.fetchall()
+        limit = length or self._limit_count or self.DEFAULT_LIST_LENGTH
+        compiled = self.collection._compile(self.query)
         
-        # Фильтруем
-        results = []
-        for row in rows:
-            doc = json_deserializer(row[0])
-            if self.collection._matches(doc, self.query):
-                results.append(doc)
+        if compiled is None:
+            async with self.collection.pool.reader() as conn:
+                results = await self.collection._scan(conn, self.query)
+            results = self._sort_and_slice(results, limit)
+            if self.projection is not None:
+                results = [self.projection.apply(doc) for doc in results]
+            return results
+        
+        # Фильтрация, сортировка и пагинация целиком на стороне SQLite;
+        # при проекции читаются только нужные поля
+        compiler = compiled[0]
+        order_by = compiler.compile_sort(self._sort)
+        columns = self.collection._columns(self.projection)
+        sql, params = self.collection._select(columns, compiled, f"{order_by} LIMIT ? OFFSET ?")
+        async with self.collection.pool.reader() as conn:
+            async with conn.execute(sql, [*params, limit, self._skip_count]) as cursor:
+                rows = await cursor.fetchall()
         
-        # Сортируем
-        if self._sort_field:
+        return [self.collection._decode_row(row, self.projection) for row in rows]
+    
+    def _sort_and_slice(self, results: List[dict], limit: int) -> List[dict]:
+        """Сортировка и skip/limit в Python для запасного пути."""
+        for field, direction in reversed(self._sort):
+            if isinstance(direction, dict):
+                continue
+            # null и отсутствующие поля идут первыми, как в MongoDB; "or ''"
+            # раньше превращал 0 в строку и ломал сравнение чисел
             results.sort(
-                key=lambda x: x.get(self._sort_field) or "",
-                reverse=(self._sort_direction == -1)
+                key=lambda x: (0, 0) if x.get(field) is None else (1, x.get(field)),
+                reverse=(direction == -1)
             )
+        return results[self._skip_count : self._skip_count + limit]
+
+
+class ChildArrayCollection(SQLiteCollection):
+    """
+    Коллекция с растущим массивом документов в дочерней таблице.
+    
+    Элемент массива (сообщение) — строка <коллекция>_<поле> (parent_id,
+    data) с индексом (parent_id, created_at); в data родителя массива нет.
+    $push превращается в INSERT одной строки вместо перезаписи всего
+    документа, $set по arrayFilters — в UPDATE подходящих строк, удаление
+    документа удаляет строки триггером. При чтении массив собирается
+    json_group_array() в порядке индекса; {"messages": {"$slice": -50}}
+    читает только последние строки.
+    
+    Фильтры по полям массива выполняются запасным путём в Python.
+    """
+    
+    def __init__(self, table_name: str, pool: SQLiteConnectionPool, child: ChildArray):
+        super().__init__(table_name, pool)
+        self.child = child
+        self.child_table = f"{table_name}_{child.field}"
+        self.document_sql = self._document_sql()
+    
+    # -------------------------------------------------------------------------
+    # Чтение
+    # -------------------------------------------------------------------------
+    
+    def _items_sql(self, slice_spec: Any = None) -> str:
+        """JSON-массив элементов документа (с $slice — только их часть)."""
+        order = column_name(self.child.order_by)
+        rows = (
+            f"SELECT data, {order}, id FROM {self.child_table} "
+            f"WHERE parent_id = {self.table_name}.id"
+        )
+        ascending = f"ORDER BY {order}, id"
+        if slice_spec is None:
+            rows = f"{rows} {ascending}"
+        else:
+            skip, limit = slice_bounds(slice_spec)
+            limit = -1 if limit is None else int(limit)
+            if skip >= 0:
+                rows = f"{rows} {ascending} LIMIT {limit} OFFSET {int(skip)}"
+            else:
+                # Последние -skip строк по индексу в обратном порядке
+                rows = (
+                    f"SELECT * FROM ({rows} ORDER BY {order} DESC, id DESC LIMIT {-int(skip)}) "
+                    f"{ascending} LIMIT {limit}"
+                )
+        return f"json((SELECT json_group_array(json(data)) FROM ({rows})))"
+    
+    async def child_items(self, batch_size: int = 200):
+        """
+        Элементы массива напрямую из дочерней таблицы, без сборки документов.
         
-        # Skip и Limit
-        limit = length or self._limit_count
-        results = results[self._skip_count : self._skip_count + limit]
+        Пачками {parent_id: [элемент, ...]} по batch_size документов;
+        элементы документа всегда в одной пачке. Следующая пачка продолжает
+        с последнего parent_id, поэтому элементы уже отданных документов
+        можно удалять во время итерации.
+        """
+        field = self.child.field
+        order = column_name(self.child.order_by)
+        last = ""
+        while True:
+            async with self.pool.reader() as conn:
+                async with conn.execute(
+                    f"SELECT DISTINCT parent_id FROM {self.child_table} "
+                    f"WHERE parent_id > ? ORDER BY parent_id LIMIT ?",
+                    (last, batch_size),
+                ) as cursor:
+                    parent_ids = [row[0] for row in await cursor.fetchall()]
+                if not parent_ids:
+                    return
+                marks = ", ".join("?" for _ in parent_ids)
+                async with conn.execute(
+                    f"SELECT parent_id, data FROM {self.child_table} "
+                    f"WHERE parent_id IN ({marks}) ORDER BY parent_id, {order}, id",
+                    parent_ids,
+                ) as cursor:
+                    rows = await cursor.fetchall()
+            
+            batch: Dict[str, list] = {parent_id: [] for parent_id in parent_ids}
+            for parent_id, data in rows:
+                batch[parent_id].append(self.codec.decode_value(data))
+            # datetime в элементах восстанавливаются как в целом документе
+            yield {
+                parent_id: self.codec.restore({field: items})[field]
+                for parent_id, items in batch.items()
+            }
+            last = parent_ids[-1]
+    
+    def _document_sql(self, slice_spec: Any = None) -> str:
+        path = json_path(self.child.field).replace("'", "''")
+        return f"json_set({self.table_name}.data, '{path}', {self._items_sql(slice_spec)})"
+    
+    def _compile(self, query: Optional[dict]) -> Optional[tuple]:
+        # Поля элементов массива есть только в собранном документе
+        if self._mentions_child(query):
+            return None
+        return super()._compile(query)
+    
+    def _mentions_child(self, query: Optional[dict]) -> bool:
+        field = self.child.field
+        for key, value in (query or {}).items():
+            if key in ("$and", "$or", "$nor"):
+                if any(self._mentions_child(branch) for branch in value):
+                    return True
+            elif key == field or key.startswith(field + "."):
+                return True
+        return False
+    
+    def _columns(self, projection: Optional[Projection]) -> str:
+        field = self.child.field
+        if projection is None or not projection.needs_field(field):
+            return super()._columns(projection)
+        slice_spec = projection.slices.get(field)
+        if projection.inclusive:
+            columns = projection.columns(fields={field: self._items_sql(slice_spec)})
+        else:
+            columns = projection.columns(self._document_sql(slice_spec))
+        return ", ".join(sql for _, sql in columns)
+    
+    def _decode_row(self, row: tuple, projection: Optional[Projection]) -> dict:
+        if projection is None:
+            return self.codec.decode(row[0])
+        # $slice по дочерней таблице уже выполнен в SQL
+        return projection.assemble(row, self.codec, sliced=(self.child.field,))
+    
+    # -------------------------------------------------------------------------
+    # Запись
+    # -------------------------------------------------------------------------
+    
+    async def insert_one(self, document: dict) -> InsertOneResult:
+        """Вставить документ (upsert по id, как в SQLiteCollection)."""
+        doc_id = document.get("_id", "")
+        await self._write_one(ReplaceOne({"_id": doc_id}, document, upsert=True))
+        return InsertOneResult(doc_id)
+    
+    def _split(self, document: dict) -> tuple:
+        """(документ без массива, элементы массива или None)."""
+        field = self.child.field
+        parent = {key: value for key, value in document.items() if key != field}
+        return parent, document.get(field)
+    
+    def _prepare(self, index: int, op: Any) -> _Write:
+        kind = type(op).__name__
         
-        return results
+        if kind == "InsertOne":
+            document = op._doc
+            document.setdefault("_id", generate_id())
+            parent, items = self._split(document)
+            return _Write(
+                index, op, "insert",
+                f"INSERT INTO {self.table_name} (id, data) VALUES (?, ?)",
+                [document["_id"], self._encode(parent)],
+                children=(self._append(items),) if items else (),
+            )
+        
+        if kind == "ReplaceOne":
+            write = super()._prepare(index, op)
+            parent, items = self._split(op._doc)
+            return write._replace(
+                params=[self._encode(parent)],
+                upsert=self._split(write.upsert)[0] if write.upsert is not None else None,
+                children=(self._replace_items(items or []),),
+            )
+        
+        if kind in ("UpdateOne", "UpdateMany"):
+            update, children = self._split_update(op._doc, op._array_filters)
+            if not children:
+                return super()._prepare(index, op)
+            set_sql, set_params = "data", []
+            if update:
+                set_sql, set_params = UpdateCompiler(self._encode, op._array_filters).compile(update)
+            return _Write(
+                index, op, "update",
+                f"UPDATE {self.table_name} SET data = {set_sql}",
+                set_params,
+                op._filter, getattr(op, "_sort", None), 1 if kind == "UpdateOne" else None,
+                _upsert_seed(op._filter) if op._upsert else None,
+                apply_after_upsert=True,
+                children=tuple(children),
+            )
+        
+        return super()._prepare(index, op)
+    
+    def _split_update(self, update: dict, array_filters: Optional[List[dict]]) -> tuple:
+        """Разделить обновление на операторы документа и записи в дочернюю таблицу."""
+        if not update or not all(op.startswith("$") for op in update):
+            raise ValueError("update only works with $ operators")
+        
+        field = self.child.field
+        parent: dict = {}
+        children = []
+        for op, fields in update.items():
+            for path, value in fields.items():
+                if path == field:
+                    children.append(self._array_update(op, value))
+                elif path.startswith(field + "."):
+                    rest = path[len(field) + 1:]
+                    children.append(self._element_update(op, rest, value, array_filters))
+                else:
+                    parent.setdefault(op, {})[path] = value
+        return parent, children
+    
+    def _array_update(self, op: str, value: Any) -> Callable:
+        if op == "$push":
+            if isinstance(value, dict) and "$each" in value:
+                if set(value) != {"$each"}:
+                    raise NotImplementedError(
+                        f"$push modifiers on {self.child.field} are not supported by the SQLite backend"
+                    )
+                return self._append(list(value["$each"]))
+            return self._append([value])
+        if op == "$set" and isinstance(value, list):
+            return self._replace_items(value)
+        if op == "$unset":
+            return self._replace_items([])
+        raise NotImplementedError(f"{op} on {self.child.field} is not supported by the SQLite backend")
+    
+    def _element_update(self, op: str, rest: str, value: Any, array_filters: Optional[List[dict]]) -> Callable:
+        """Оператор по пути "messages.$[elem].read" -> UPDATE строк дочерней таблицы."""
+        if not rest.startswith("$["):
+            raise NotImplementedError(
+                f"Only $[] and $[<identifier>] updates of {self.child.field} are supported by the SQLite backend"
+            )
+        name, _, inner = rest[2:].partition("]")
+        inner = inner.lstrip(".")
+        if "$" in inner:
+            raise NotImplementedError("Nested or positional array updates are not supported")
+        
+        cond_sql, cond_params = "1", []
+        if name:
+            condition = UpdateCompiler(self._encode, array_filters).array_filters.get(name)
+            if condition is None:
+                raise ValueError(f"No array filter found for identifier '{name}'")
+            try:
+                cond_sql, cond_params = QueryCompiler(doc=f"{self.child_table}.data").compile(condition)
+            except UnsupportedQuery as e:
+                raise NotImplementedError(str(e))
+        
+        if inner:
+            set_sql, set_params = UpdateCompiler(self._encode).compile({op: {inner: value}})
+        elif op == "$set":
+            set_sql, set_params = "json(?)", [self._encode(value)]
+        else:
+            raise NotImplementedError(f"{op} of whole {self.child.field} elements is not supported")
+        
+        def statements(ids: List[str]) -> list:
+            marks = ", ".join("?" * len(ids))
+            sql = (
+                f"UPDATE {self.child_table} SET data = {set_sql} "
+                f"WHERE parent_id IN ({marks}) AND {cond_sql}"
+            )
+            return [(sql, [[*set_params, *ids, *cond_params]])]
+        
+        return statements
+    
+    def _append(self, items: list) -> Callable:
+        encoded = [self._encode(item) for item in items]
+        sql = f"INSERT INTO {self.child_table} (parent_id, data) VALUES (?, ?)"
+        return lambda ids: [(sql, [[doc_id, data] for doc_id in ids for data in encoded])]
+    
+    def _replace_items(self, items: list) -> Callable:
+        append = self._append(items)
+        
+        def statements(ids: List[str]) -> list:
+            marks = ", ".join("?" * len(ids))
+            delete = f"DELETE FROM {self.child_table} WHERE parent_id IN ({marks})"
+            return [(delete, [ids]), *append(ids)]
+        
+        return statements
+    
+    async def _execute_one(self, conn, write: _Write, sql: str, params: list, result: dict) -> bool:
+        """Запись документа и его строк в дочерней таблице атомарно."""
+        if not write.children:
+            return await super()._execute_one(conn, write, sql, params, result)
+        
+        upserted = False
+        await conn.execute("SAVEPOINT child_write")
+        try:
+            if write.kind == "insert":
+                await conn.execute(sql, params)
+                ids = [params[0]]
+            else:
+                async with conn.execute(f"{sql} RETURNING id", params) as cursor:
+                    ids = [row[0] for row in await cursor.fetchall()]
+                if not ids and write.upsert is not None:
+                    await self._upsert(conn, write)
+                    ids, upserted = [write.upsert["_id"]], True
+            if ids:
+                for statements in write.children:
+                    for child_sql, rows in statements(ids):
+                        await conn.executemany(child_sql, rows)
+        except BaseException as e:
+            await conn.execute("ROLLBACK TO child_write")
+            await conn.execute("RELEASE child_write")
+            if not isinstance(e, sqlite3.IntegrityError):
+                raise
+            result["writeErrors"].append({
+                "index": write.index,
+                "code": 11000,
+                "errmsg": str(e),
+                "op": write.op,
+            })
+            return False
+        await conn.execute("RELEASE child_write")
+        
+        if upserted:
+            result["nUpserted"] += 1
+            result["upserted"].append({"index": write.index, "_id": write.upsert["_id"]})
+        else:
+            _count_write(result, write.kind, len(ids))
+        return True
 
 
 class SQLiteDatabase:
     """Эмулирует MongoDB Database с коллекциями."""
     
-    def __init__(self):
-        self.users = SQLiteCollection("users")
-        self.products = SQLiteCollection("products")
-        self.favorites = SQLiteCollection("favorites")
+    COLLECTIONS = ("users", "products", "favorites", "conversations", "messages", "chat_sessions", "ai_cache")
+    
+    def __init__(self, db_path: str = SQLITE_DB_PATH):
+        self.pool = SQLiteConnectionPool(
+            db_path,
+            readers=settings.sqlite_read_pool_size,
+            busy_timeout_ms=settings.sqlite_busy_timeout_ms,
+            acquire_timeout=settings.sqlite_acquire_timeout,
+        )
+        self.users = SQLiteCollection("users", self.pool)
+        self.products = SQLiteCollection("products", self.pool)
+        self.favorites = SQLiteCollection("favorites", self.pool)
+        self.conversations = ChildArrayCollection("conversations", self.pool, CHILD_ARRAYS["conversations"])
+        self.messages = SQLiteCollection("messages", self.pool)
+        self.chat_sessions = ChildArrayCollection("chat_sessions", self.pool, CHILD_ARRAYS["chat_sessions"])
+        self.ai_cache = SQLiteCollection("ai_cache", self.pool)
+    
+    async def connect(self):
+        """Открыть пул соединений и создать таблицы."""
+        print(f"[INFO] SQLite document codec: {codec.configure(settings.sqlite_codec)}")
+        await self.pool.open()
+        await self.init_tables()
+    
+    async def close(self):
+        """Закрыть пул соединений."""
+        await self.pool.close()
     
     async def init_tables(self):
-        """Создать таблицы если не существуют."""
-        async with aiosqlite.connect(SQLITE_DB_PATH) as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT PRIMARY KEY,
-                    data TEXT NOT NULL
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    id TEXT PRIMARY KEY,
-                    data TEXT NOT NULL
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS favorites (
-                    id TEXT PRIMARY KEY,
-                    data TEXT NOT NULL
-                )
-            """)
-            await conn.commit()
+        """Создать таблицы если не существуют и привести индексы к спецификации."""
+        async with self.pool.writer() as conn:
+            for table in self.COLLECTIONS:
+                await conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        id TEXT PRIMARY KEY,
+                        data TEXT NOT NULL
+                    )
+                """)
+                await self._ensure_indexes(conn, table)
+                if table in CHILD_ARRAYS:
+                    await self._ensure_child_table(conn, getattr(self, table))
+                if TEXT_INDEXES.get(table):
+                    await self._ensure_text_index(conn, table, TEXT_INDEXES[table])
+            
+            async with conn.execute("PRAGMA user_version") as cursor:
+                version = (await cursor.fetchone())[0]
+            if version < codec.FORMAT_VERSION:
+                await self._migrate_format(conn, version)
+                await conn.execute(f"PRAGMA user_version = {codec.FORMAT_VERSION}")
+    
+    async def _migrate_format(self, conn, version: int):
+        """
+        Переписать документы в текущий формат кодека (см. app/db/codec.py).
+        
+        Декодер читает и старые строки, но datetime переменной ширины
+        неправильно сравниваются в SQL со значениями фильтров.
+        """
+        for table in self.COLLECTIONS:
+            collection: SQLiteCollection = getattr(self, table)
+            async with conn.execute(f"SELECT id, data FROM {table}") as cursor:
+                rows = await cursor.fetchall()
+            updates = []
+            for doc_id, data in rows:
+                encoded = collection.codec.encode(collection.codec.decode(data))
+                if encoded != data:
+                    updates.append((encoded, doc_id))
+            if updates:
+                await conn.executemany(f"UPDATE {table} SET data = ? WHERE id = ?", updates)
+                print(f"[INFO] SQLite {table}: {len(updates)} documents migrated from format {version} to {codec.FORMAT_VERSION}")
+    
+    async def _ensure_indexes(self, conn, table: str):
+        """
+        Добавить generated-колонки и индексы из INDEXES.
+        
+        Идемпотентно, поэтому работает и как миграция для существующих
+        файлов dehqonjon.db: недостающие колонки добавляются через
+        ALTER TABLE, устаревшие индексы ix_/ux_ удаляются.
+        """
+        async with conn.execute(f"PRAGMA table_xinfo({table})") as cursor:
+            existing_columns = {row["name"] for row in await cursor.fetchall()}
+        
+        for field, column in indexed_fields(table).items():
+            if column in existing_columns:
+                continue
+            path = json_path(field).replace("'", "''")
+            # VIRTUAL без типа: значение хранится с типом из json_extract
+            await conn.execute(
+                f"ALTER TABLE {table} ADD COLUMN {column} "
+                f"GENERATED ALWAYS AS (json_extract(data, '{path}')) VIRTUAL"
+            )
+        
+        async with conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+            (table,),
+        ) as cursor:
+            existing_indexes = {row["name"] for row in await cursor.fetchall()}
+        
+        wanted = {index_name(table, spec): spec for spec in sqlite_indexes(table)}
+        # Неуникальные копии уникальных индексов (если в данных есть дубликаты)
+        fallbacks = {"ix" + name[2:] for name, spec in wanted.items() if spec.unique}
+        
+        for name in existing_indexes - set(wanted) - fallbacks:
+            if name.startswith(("ix_", "ux_")):
+                await conn.execute(f"DROP INDEX {name}")
+        
+        for name, spec in wanted.items():
+            if name in existing_indexes:
+                continue
+            # Все колонки по возрастанию: SQLite умеет обходить индекс в обратном
+            # порядке, а rowid внутри индекса всегда идёт по возрастанию, так что
+            # ORDER BY created_at DESC, rowid DESC обходится без сортировки
+            columns = ", ".join(
+                "id" if field == "_id" else column_name(field) for field in spec.fields
+            )
+            if not spec.unique:
+                await conn.execute(f"CREATE INDEX {name} ON {table} ({columns})")
+                continue
+            
+            fallback = "ix" + name[2:]
+            try:
+                await conn.execute(f"CREATE UNIQUE INDEX {name} ON {table} ({columns})")
+            except sqlite3.IntegrityError:
+                # В старых данных есть дубликаты — индексируем без UNIQUE
+                if fallback not in existing_indexes:
+                    print(f"[WARNING] Duplicate values in {table}, {name} created as non-unique")
+                    await conn.execute(f"CREATE INDEX {fallback} ON {table} ({columns})")
+                continue
+            if fallback in existing_indexes:
+                await conn.execute(f"DROP INDEX {fallback}")
+
+    
+    async def _ensure_child_table(self, conn, collection: ChildArrayCollection):
+        """
+        Дочерняя таблица элементов массива с индексом (parent_id, <order_by>).
+        
+        Строки удаляются вместе с документом триггером на родительской таблице.
+        """
+        table, child = collection.table_name, collection.child_table
+        order = column_name(collection.child.order_by)
+        path = json_path(collection.child.order_by).replace("'", "''")
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {child} (
+                id INTEGER PRIMARY KEY,
+                parent_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                {order} GENERATED ALWAYS AS (json_extract(data, '{path}')) VIRTUAL
+            )
+        """)
+        await conn.execute(
+            f"CREATE INDEX IF NOT EXISTS ix_{child}_parent_id_{order} ON {child} (parent_id, {order})"
+        )
+        await conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {child}_ad AFTER DELETE ON {table} "
+            f"BEGIN DELETE FROM {child} WHERE parent_id = old.id; END"
+        )
+    
+    async def _ensure_text_index(self, conn, table: str, fields: List[str]):
+        """
+        FTS5-индекс <table>_fts по текстовым полям документа.
+        
+        rowid FTS-записи совпадает с rowid документа. Синхронизацию при
+        insert/update/delete выполняют триггеры, поэтому любой путь записи
+        (включая массовые операции) поддерживает индекс в актуальном виде.
+        При изменении набора полей таблица пересоздаётся и заполняется заново.
+        """
+        fts = f"{table}_fts"
+        async with conn.execute(f"PRAGMA table_info({fts})") as cursor:
+            existing = [row["name"] for row in await cursor.fetchall()]
+        
+        if existing != list(fields):
+            if existing:
+                await conn.execute(f"DROP TABLE {fts}")
+            await conn.execute(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5("
+                f"{', '.join(fields)}, tokenize = 'unicode61 remove_diacritics 2')"
+            )
+            rebuild = True
+        else:
+            rebuild = False
+        
+        def values(alias: str) -> str:
+            return ", ".join(
+                f"json_extract({alias}.data, '{json_path(f)}')" for f in fields
+            )
+        
+        columns = ", ".join(fields)
+        insert = f"INSERT INTO {fts} (rowid, {columns}) VALUES (new.rowid, {values('new')});"
+        delete = f"DELETE FROM {fts} WHERE rowid = old.rowid;"
+        triggers = {
+            f"{fts}_ai": f"AFTER INSERT ON {table} BEGIN {insert} END",
+            f"{fts}_ad": f"AFTER DELETE ON {table} BEGIN {delete} END",
+            f"{fts}_au": f"AFTER UPDATE OF data ON {table} BEGIN {delete} {insert} END",
+        }
+        for name, body in triggers.items():
+            await conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            await conn.execute(f"CREATE TRIGGER {name} {body}")
+        
+        if rebuild:
+            await conn.execute(
+                f"INSERT INTO {fts} (rowid, {columns}) "
+                f"SELECT rowid, {values(table)} FROM {table}"
+            )
 
 
 # =============================================================================
 # Database Connection Management
 # =============================================================================
 
+# Кэш больших total для find_page(cache_total=True): {(коллекция, запрос): total}
+_total_cache = TTLCache(maxsize=1024, ttl=settings.query_total_cache_ttl)
+
+# total меньше порога всегда считается точно
+LARGE_TOTAL = 1000
+
+
+# Фоновая задача ensure_indexes() после подключения к MongoDB
+_index_task: Optional[asyncio.Task] = None
+
+
+def _start_index_bootstrap(db):
+    global _index_task
+    
+    async def run():
+        try:
+            await ensure_indexes(db)
+        except Exception as e:
+            print(f"[WARNING] MongoDB index bootstrap failed: {str(e)[:100]}")
+    
+    _index_task = asyncio.create_task(run())
+
+
+async def _stop_index_bootstrap():
+    global _index_task
+    
+    if _index_task is not None and not _index_task.done():
+        _index_task.cancel()
+        try:
+            await _index_task
+        except asyncio.CancelledError:
+            pass
+    _index_task = None
+
+
 async def connect_db():
     """Подключиться к базе данных (MongoDB или SQLite fallback)."""
     global _db_instance, _db_type
@@ -330,14 +1559,18 @@ async def connect_db():
         _db_instance = client.dehqonjon
         _db_type = "mongodb"
         print("[OK] Connected to MongoDB Atlas")
+        if settings.mongo_ensure_indexes:
+            # Сборка индексов на больших коллекциях не задерживает старт
+            _start_index_bootstrap(_db_instance)
         return
     except Exception as e:
         print(f"[WARNING] MongoDB connection failed: {str(e)[:100]}...")
     
     # Попытка 2: SQLite fallback
     print("[INFO] Falling back to SQLite...")
-    _db_instance = SQLiteDatabase()
-    await _db_instance.init_tables()
+    sqlite_db = SQLiteDatabase()
+    await sqlite_db.connect()
+    _db_instance = sqlite_db
     _db_type = "sqlite"
     print(f"[OK] SQLite database ready: {SQLITE_DB_PATH}")
 
@@ -346,9 +1579,13 @@ async def close_db():
     """Закрыть соединение с базой данных."""
     global _db_instance, _db_type
     
+    await _stop_index_bootstrap()
     if _db_type == "mongodb" and _db_instance is not None:
         _db_instance.client.close()
         print("[OK] MongoDB connection closed")
+    elif _db_type == "sqlite" and _db_instance is not None:
+        await _db_instance.close()
+        print("[OK] SQLite connections closed")
     
     _db_instance = None
     _db_type = None
@@ -357,3 +1594,86 @@ async def close_db():
 def get_db():
     """Получить текущий экземпляр базы данных."""
     return _db_instance
+
+
+def text_search_query(search: str, fields: List[str]) -> tuple:
+    """
+    Фильтр и сортировка для текстового поиска по полям коллекции.
+    
+    SQLite: $text по FTS5-индексу с ранжированием bm25 и поиском по
+    префиксу слов. MongoDB: регулярное выражение по полям, как раньше
+    (у $text в MongoDB нет поиска по префиксу, нужного для поиска по мере
+    ввода). Возвращает (filter, sort) — sort ставится перед остальными
+    ключами сортировки.
+    """
+    if _db_type == "sqlite":
+        return {"$text": {"$search": search}}, [("score", {"$meta": "textScore"})]
+    
+    pattern = re.escape(search)
+    return {
+        "$or": [{field: {"$regex": pattern, "$options": "i"}} for field in fields]
+    }, []
+
+
+def _total_cache_key(collection, query: dict) -> tuple:
+    return collection.name, codec.dumps(query, sort_keys=True)
+
+
+async def count_documents_cached(collection, query: dict) -> int:
+    """count_documents() с тем же кэшем больших total, что и у find_page()."""
+    cache_key = _total_cache_key(collection, query)
+    total = _total_cache.get(cache_key)
+    if total is None:
+        total = await collection.count_documents(query)
+        if total >= LARGE_TOTAL:
+            _total_cache.set(cache_key, total)
+    return total
+
+
+async def find_page(
+    collection,
+    query: dict,
+    sort: Optional[SortSpec],
+    skip: int,
+    limit: int,
+    cache_total: bool = False,
+) -> tuple:
+    """
+    Страница документов и общее число совпадений: (docs, total).
+    
+    SQLite — один SELECT с подзапросом-счётчиком, MongoDB — одна
+    агрегация с $facet вместо count_documents() + find().
+    
+    cache_total=True разрешает вернуть приблизительный total: для больших
+    выборок (от LARGE_TOTAL) он кэшируется на query_total_cache_ttl
+    секунд, и повторные запросы читают только страницу.
+    """
+    cache_key = None
+    if cache_total:
+        cache_key = _total_cache_key(collection, query)
+        total = _total_cache.get(cache_key)
+        if total is not None:
+            cursor = collection.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            docs = await cursor.skip(skip).limit(limit).to_list(length=limit)
+            return docs, total
+    
+    if isinstance(collection, SQLiteCollection):
+        docs, total = await collection.find_page(query, sort, skip, limit)
+    else:
+        # Пустой $sort MongoDB отвергает: без сортировки стадии нет
+        items = [{"$sort": dict(sort)}] if sort else []
+        items += [{"$skip": skip}, {"$limit": limit}]
+        pipeline = [
+            {"$match": query},
+            {"$facet": {"items": items, "total": [{"$count": "count"}]}},
+        ]
+        result = await collection.aggregate(pipeline).to_list(length=1)
+        facet = result[0] if result else {"items": [], "total": []}
+        docs = facet["items"]
+        total = facet["total"][0]["count"] if facet["total"] else 0
+    
+    if cache_key is not None and total >= LARGE_TOTAL:
+        _total_cache.set(cache_key, total)
+    return docs, total
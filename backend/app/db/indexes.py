@@ -0,0 +1,138 @@
+"""
+Декларативное описание индексов по коллекциям.
+
+Одна спецификация на оба бэкенда: в SQLite по каждому полю индекса
+создаётся виртуальная generated-колонка над json_extract(data, ...)
+и B-tree индекс по этим колонкам, в MongoDB индексы создаёт
+app/db/mongo_indexes.py при подключении.
+
+TEXT_INDEXES — поля полнотекстового поиска ($text). В SQLite это
+FTS5-таблица <коллекция>_fts, которую синхронизируют триггеры.
+
+CHILD_ARRAYS — растущие массивы документов (сообщения), которые в SQLite
+хранятся отдельной таблицей <коллекция>_<поле> по строке на элемент.
+ARRAY_FIELDS — поля-массивы скаляров, по которым ищут элемент
+({"participant_ids": user_id}). В MongoDB индекс по такому полю
+multikey, в SQLite поле из индекса выпадает (см. sqlite_spec()).
+"""
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+class IndexSpec(NamedTuple):
+    keys: List[Tuple[str, int]]  # [(поле, 1 | -1), ...]
+    unique: bool = False
+    # MongoDB partialFilterExpression: в индекс попадают только документы,
+    # подходящие под фильтр. В SQLite фильтр не применяется — UNIQUE и так
+    # не учитывает NULL
+    partial_filter: Optional[dict] = None
+    # MongoDB TTL-индекс: документ удаляется через столько секунд после
+    # значения поля. В SQLite не поддерживается — просроченные документы
+    # удаляет код коллекции
+    expire_after_seconds: Optional[int] = None
+
+    @property
+    def fields(self) -> List[str]:
+        return [field for field, _ in self.keys]
+
+
+INDEXES: Dict[str, List[IndexSpec]] = {
+    "users": [
+        IndexSpec([("phone", 1)], unique=True),
+        # У старых пользователей username может не быть или он null:
+        # sparse-индекс включил бы null, и второй такой пользователь
+        # нарушил бы уникальность
+        IndexSpec([("username", 1)], unique=True, partial_filter={"username": {"$type": "string"}}),
+    ],
+    "products": [
+        # _id — стабильный второй ключ для keyset-пагинации по created_at
+        IndexSpec([("status", 1), ("created_at", -1), ("_id", -1)]),
+        IndexSpec([("status", 1), ("category", 1), ("created_at", -1), ("_id", -1)]),
+        IndexSpec([("seller_id", 1), ("created_at", -1)]),
+    ],
+    "favorites": [
+        IndexSpec([("user_id", 1), ("product_id", 1)], unique=True),
+        IndexSpec([("user_id", 1), ("created_at", -1)]),
+        IndexSpec([("product_id", 1)]),
+    ],
+    "conversations": [
+        IndexSpec([("participant_ids", 1), ("last_message_at", -1)]),
+    ],
+    "messages": [
+        # История переписки: keyset-пагинация по (created_at, _id) назад
+        IndexSpec([("conversation_id", 1), ("created_at", -1), ("_id", -1)]),
+        IndexSpec([("conversation_id", 1), ("read", 1)]),
+    ],
+    "chat_sessions": [
+        IndexSpec([("user_id", 1), ("updated_at", -1)]),
+    ],
+    "ai_cache": [
+        IndexSpec([("expires_at", 1)], expire_after_seconds=0),
+    ],
+}
+
+
+TEXT_INDEXES: Dict[str, List[str]] = {
+    "products": ["title", "description"],
+    "users": ["username", "name"],
+}
+
+
+class ChildArray(NamedTuple):
+    field: str  # поле-массив документа
+    order_by: str = "created_at"  # поле элемента, по которому идёт индекс
+
+
+CHILD_ARRAYS: Dict[str, ChildArray] = {
+    # Сообщения переписок живут в коллекции messages; массив остаётся только
+    # у старых документов до migrate_conversation_messages()
+    "conversations": ChildArray("messages"),
+    "chat_sessions": ChildArray("messages"),
+}
+
+
+ARRAY_FIELDS: Dict[str, List[str]] = {
+    "conversations": ["participant_ids"],
+}
+
+
+def column_name(field: str) -> str:
+    """Имя generated-колонки для поля документа."""
+    return field.replace(".", "__")
+
+
+def index_name(table: str, spec: IndexSpec) -> str:
+    prefix = "ux" if spec.unique else "ix"
+    return f"{prefix}_{table}_" + "_".join(column_name(f).strip("_") for f in spec.fields)
+
+
+def sqlite_spec(collection: str, spec: IndexSpec) -> Optional[IndexSpec]:
+    """
+    Индекс для SQLite: без полей-массивов из ARRAY_FIELDS.
+
+    Колонка над json_extract() массива — это JSON-текст, искать по ней
+    элемент нельзя. None — если от индекса ничего не осталось или он
+    уникальный (уникальность по элементам массива SQLite не выразит).
+    """
+    arrays = ARRAY_FIELDS.get(collection, [])
+    keys = [(field, direction) for field, direction in spec.keys if field not in arrays]
+    if len(keys) == len(spec.keys):
+        return spec
+    if not keys or spec.unique:
+        return None
+    return spec._replace(keys=keys)
+
+
+def sqlite_indexes(collection: str) -> List[IndexSpec]:
+    specs = (sqlite_spec(collection, spec) for spec in INDEXES.get(collection, []))
+    return [spec for spec in specs if spec is not None]
+
+
+def indexed_fields(collection: str) -> Dict[str, str]:
+    """Поля коллекции, для которых есть колонка: {поле: колонка}."""
+    columns = {}
+    for spec in sqlite_indexes(collection):
+        for field in spec.fields:
+            if field != "_id":
+                columns[field] = column_name(field)
+    return columns
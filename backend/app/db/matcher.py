@@ -0,0 +1,298 @@
+"""
+Предкомпилированный матчер MongoDB-фильтров для фильтрации в Python.
+
+compile_matcher() разбирает фильтр один раз и возвращает функцию
+doc -> bool: пути полей, операторы и регулярные выражения подготовлены
+заранее, на каждый документ остаются только сравнения. Используется
+там, где SQLite fallback не может выразить запрос в SQL.
+
+Семантика операторов, которые умеет и QueryCompiler, у обоих одна —
+тесты tests/test_query_parity.py прогоняют фильтры обоими путями:
+
+- условие на поле-массив выполняется, если ему удовлетворяет сам массив
+  или любой его элемент (равенство, $in, $gt/$lt, $regex, null);
+  $ne/$nin — отрицание равенства/$in в этом смысле;
+- отсутствующее поле равно null, не проходит $gt/$lt и $regex, проходит
+  $ne/$nin;
+- $gt/$gte/$lt/$lte сравнивают числа (bool считается числом, как 0/1 в
+  SQLite) с числами, строки со строками, datetime с datetime; значения
+  других типов и null условию не удовлетворяют;
+- $regex проверяет только строки.
+
+Пути с точкой QueryCompiler не компилирует — "items.name" здесь, как в
+MongoDB, проходит по элементам массива items.
+"""
+
+import operator
+import re
+from typing import Any, Callable, Iterable, List
+
+from app.db.sqlite_query import compile_regex, regex_pattern, search_terms
+
+Matcher = Callable[[dict], bool]
+Predicate = Callable[[Any], bool]
+
+# Значение отсутствующего поля (в отличие от явного null)
+MISSING = object()
+
+_COMPARE = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+
+
+def compile_matcher(query: dict, text_fields: Iterable[str] = ()) -> Matcher:
+    """Скомпилировать фильтр в функцию doc -> bool."""
+    text_fields = tuple(text_fields)
+    checks: List[Matcher] = []
+    for key, value in (query or {}).items():
+        if key == "$text":
+            checks.append(_text_matcher(value.get("$search", ""), text_fields))
+        elif key in ("$and", "$or", "$nor"):
+            checks.append(_logical_matcher(key, value, text_fields))
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Unsupported top-level operator {key}")
+        else:
+            checks.append(_field_matcher(key, _predicate(value)))
+    return _all_of(checks)
+
+
+def _all_of(checks: List[Matcher]) -> Matcher:
+    if not checks:
+        return lambda doc: True
+    if len(checks) == 1:
+        return checks[0]
+    if len(checks) == 2:
+        first, second = checks
+        return lambda doc: first(doc) and second(doc)
+    checks = tuple(checks)
+
+    # Явный цикл заметно дешевле all() с генератором на каждый документ
+    def match(doc) -> bool:
+        for check in checks:
+            if not check(doc):
+                return False
+        return True
+
+    return match
+
+
+def _logical_matcher(op: str, branches: list, text_fields: tuple) -> Matcher:
+    if not isinstance(branches, (list, tuple)) or not branches:
+        raise ValueError(f"{op} expects a non-empty list")
+    matchers = [compile_matcher(branch, text_fields) for branch in branches]
+    if op == "$and":
+        return _all_of(matchers)
+    matchers = tuple(matchers)
+
+    def any_of(doc) -> bool:
+        for matcher in matchers:
+            if matcher(doc):
+                return True
+        return False
+
+    if op == "$or":
+        return any_of
+    return lambda doc: not any_of(doc)
+
+
+def _text_matcher(search: str, text_fields: tuple) -> Matcher:
+    """$text: каждое слово запроса — префикс какого-нибудь слова в полях."""
+    terms = tuple(search_terms(search))
+    if not terms:
+        return lambda doc: False
+
+    def match(doc: dict) -> bool:
+        words = search_terms(" ".join(str(doc.get(f) or "") for f in text_fields))
+        return all(any(word.startswith(term) for word in words) for term in terms)
+
+    return match
+
+
+def _getter(field: str) -> Callable[[dict], Any]:
+    """Функция чтения поля по пути с точками; MISSING если его нет."""
+    parts = field.split(".")
+    if len(parts) == 1:
+        return lambda doc: doc.get(field, MISSING)
+
+    def get(doc: dict) -> Any:
+        value: Any = doc
+        for part in parts:
+            if isinstance(value, dict):
+                value = value.get(part, MISSING)
+            elif isinstance(value, list):
+                if part.isdigit():
+                    index = int(part)
+                    value = value[index] if index < len(value) else MISSING
+                else:
+                    # "messages.sender_id" — значения поля у элементов массива
+                    value = [item[part] for item in value if isinstance(item, dict) and part in item]
+                    if not value:
+                        return MISSING
+            else:
+                return MISSING
+            if value is MISSING:
+                return MISSING
+        return value
+
+    return get
+
+
+def _field_matcher(field: str, predicate: Predicate) -> Matcher:
+    if "." not in field:
+        return lambda doc: predicate(doc.get(field, MISSING))
+    get = _getter(field)
+    return lambda doc: predicate(get(doc))
+
+
+def _any_value(predicate: Predicate) -> Predicate:
+    """Условие выполняется для значения или для любого элемента массива."""
+    def match(value: Any) -> bool:
+        if predicate(value):
+            return True
+        return isinstance(value, list) and any(predicate(item) for item in value)
+    return match
+
+
+def _predicate(condition: Any) -> Predicate:
+    if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+        return _operators_predicate(condition)
+    return _eq_predicate(condition)
+
+
+def _eq_predicate(expected: Any) -> Predicate:
+    if isinstance(expected, re.Pattern):
+        return _regex_predicate(regex_pattern(expected))
+    if expected is None:
+        return _any_value(lambda value: value is None or value is MISSING)
+    if isinstance(expected, (list, dict)):
+        return _any_value(lambda value: value == expected)
+
+    # Скаляр: MISSING ни с чем не равен, массив проверяется поэлементно
+    def match(value: Any) -> bool:
+        return value == expected or (type(value) is list and expected in value)
+
+    return match
+
+
+def _regex_predicate(pattern: str) -> Predicate:
+    search = compile_regex(pattern).search
+
+    def match(value: Any) -> bool:
+        if type(value) is str:
+            return search(value) is not None
+        if isinstance(value, list):
+            return any(type(item) is str and search(item) is not None for item in value)
+        return False
+
+    return match
+
+
+def _compare_predicate(op: str, expected: Any) -> Predicate:
+    compare = _COMPARE[op]
+    if expected is None:
+        return lambda value: False
+
+    def scalar(value: Any) -> bool:
+        try:
+            return compare(value, expected)
+        except TypeError:
+            # MISSING, None и значения другого типа не сравниваются
+            return False
+
+    def match(value: Any) -> bool:
+        if isinstance(value, list):
+            return any(scalar(item) for item in value)
+        return scalar(value)
+
+    return match
+
+
+def _in_predicate(values: Any) -> Predicate:
+    if not isinstance(values, (list, tuple, set)):
+        raise ValueError("$in needs an array")
+    predicates = [_eq_predicate(v) for v in values]
+    hashable = [v for v in values if v is not None and not isinstance(v, re.Pattern)]
+    try:
+        lookup = frozenset(hashable)
+    except TypeError:
+        lookup = None
+
+    if lookup is None or len(hashable) != len(predicates):
+        return lambda value: any(p(value) for p in predicates)
+
+    def match(value: Any) -> bool:
+        if isinstance(value, list):
+            return any(p(value) for p in predicates)
+        try:
+            return value in lookup
+        except TypeError:
+            return False
+
+    return match
+
+
+def _operators_predicate(ops: dict) -> Predicate:
+    predicates: List[Predicate] = []
+    for op, value in ops.items():
+        if op == "$eq":
+            predicates.append(_eq_predicate(value))
+        elif op == "$ne":
+            eq = _eq_predicate(value)
+            predicates.append(lambda v, eq=eq: not eq(v))
+        elif op in _COMPARE:
+            predicates.append(_compare_predicate(op, value))
+        elif op == "$in":
+            predicates.append(_in_predicate(value))
+        elif op == "$nin":
+            contains = _in_predicate(value)
+            predicates.append(lambda v, contains=contains: not contains(v))
+        elif op == "$exists":
+            expected = bool(value)
+            predicates.append(lambda v, expected=expected: (v is not MISSING) == expected)
+        elif op == "$regex":
+            predicates.append(_regex_predicate(regex_pattern(value, ops.get("$options", ""))))
+        elif op == "$options":
+            if "$regex" not in ops:
+                raise ValueError("$options needs a $regex")
+        elif op == "$not":
+            inner = _predicate(value)
+            predicates.append(lambda v, inner=inner: not inner(v))
+        elif op == "$all":
+            # Как в MongoDB: каждое значение равно полю или есть среди его элементов
+            required = [_eq_predicate(item) for item in value]
+            predicates.append(
+                lambda v, required=required: bool(required) and all(p(v) for p in required)
+            )
+        elif op == "$size":
+            predicates.append(lambda v, size=value: isinstance(v, list) and len(v) == size)
+        elif op == "$elemMatch":
+            predicates.append(_elem_match_predicate(value))
+        else:
+            raise NotImplementedError(f"Unsupported operator {op}")
+
+    if len(predicates) == 1:
+        return predicates[0]
+    if len(predicates) == 2:
+        first, second = predicates
+        return lambda v: first(v) and second(v)
+    predicates = tuple(predicates)
+
+    def match(value: Any) -> bool:
+        for predicate in predicates:
+            if not predicate(value):
+                return False
+        return True
+
+    return match
+
+
+def _elem_match_predicate(condition: dict) -> Predicate:
+    if any(k.startswith("$") for k in condition):
+        # {"$elemMatch": {"$gte": 1}} — условие на сам элемент
+        inner = _operators_predicate(condition)
+        return lambda v: isinstance(v, list) and any(inner(item) for item in v)
+    matcher = compile_matcher(condition)
+    return lambda v: isinstance(v, list) and any(isinstance(item, dict) and matcher(item) for item in v)
@@ -0,0 +1,118 @@
+"""
+Миграции данных, которые выполняются при старте приложения.
+
+Работают через общий API коллекций, поэтому одинаково выполняются на
+MongoDB и на SQLite fallback. Каждая миграция идемпотентна: повторный
+запуск (в том числе после падения на середине) доводит данные до конца
+и ничего не дублирует.
+"""
+
+from pymongo import ReplaceOne, UpdateOne
+
+from app.db.database import ChildArrayCollection
+from app.db.models import generate_id
+
+# Переписок за одну запись в базу
+BATCH_SIZE = 200
+
+
+async def migrate_conversation_messages(db) -> int:
+    """
+    Перенести сообщения из массива conversations.messages в коллекцию messages.
+
+    Один проход пачками по BATCH_SIZE переписок: сообщения пишутся
+    upsert'ом по их id, затем массив удаляется у всей пачки. Возвращает
+    число перенесённых сообщений.
+    """
+    if db is None:
+        return 0
+
+    moved = 0
+    conversations = 0
+    async for batch in _embedded_messages(db):
+        requests = []
+        for conv_id, messages in batch.items():
+            for message in messages:
+                message = dict(message)
+                message_id = message.pop("id", None) or generate_id()
+                message["_id"] = message_id
+                message["conversation_id"] = conv_id
+                message.setdefault("read", False)
+                requests.append(ReplaceOne({"_id": message_id}, message, upsert=True))
+
+        if requests:
+            await db.messages.bulk_write(requests, ordered=False)
+        await db.conversations.update_many({"_id": {"$in": list(batch)}}, {"$unset": {"messages": ""}})
+        moved += len(requests)
+        conversations += len(batch)
+
+    if moved:
+        print(f"[INFO] Moved {moved} messages from {conversations} conversations to the messages collection")
+    return moved
+
+
+async def _embedded_messages(db):
+    """
+    Сообщения, оставшиеся в массивах переписок: пачки {conversation_id: [сообщение, ...]}.
+
+    В SQLite массив лежит в дочерней таблице — она читается напрямую, а
+    пустая таблица завершает миграцию без чтения переписок. В MongoDB —
+    один курсор по перепискам с непустым массивом.
+    """
+    if isinstance(db.conversations, ChildArrayCollection):
+        async for batch in db.conversations.child_items(BATCH_SIZE):
+            yield batch
+        return
+
+    cursor = db.conversations.find({"messages.0": {"$exists": True}}, {"messages": 1}).batch_size(BATCH_SIZE)
+    batch = {}
+    async for conv in cursor:
+        batch[conv["_id"]] = conv["messages"]
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = {}
+    if batch:
+        yield batch
+
+
+async def backfill_unread_counts(db) -> int:
+    """
+    Заполнить conversations.unread_counts для переписок, где его ещё нет.
+
+    Счётчик участника — число непрочитанных сообщений от остальных. Один
+    курсор по перепискам без счётчиков, запись пачками по BATCH_SIZE.
+    Возвращает число обновлённых переписок.
+    """
+    if db is None:
+        return 0
+
+    updated = 0
+    requests = []
+    cursor = db.conversations.find(
+        {"unread_counts": {"$exists": False}},
+        {"participant_ids": 1},
+    ).batch_size(BATCH_SIZE)
+    async for conv in cursor:
+        counts = {}
+        for user_id in conv.get("participant_ids", []):
+            counts[user_id] = await db.messages.count_documents({
+                "conversation_id": conv["_id"],
+                "read": False,
+                "sender_id": {"$ne": user_id},
+            })
+        # Условие повторяет фильтр: счётчик, появившийся с новым сообщением, не затирается
+        requests.append(UpdateOne(
+            {"_id": conv["_id"], "unread_counts": {"$exists": False}},
+            {"$set": {"unread_counts": counts}},
+        ))
+        if len(requests) >= BATCH_SIZE:
+            await db.conversations.bulk_write(requests, ordered=False)
+            updated += len(requests)
+            requests = []
+    if requests:
+        await db.conversations.bulk_write(requests, ordered=False)
+        updated += len(requests)
+
+    if updated:
+        print(f"[INFO] Unread counters filled for {updated} conversations")
+    return updated
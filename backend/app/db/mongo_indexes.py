@@ -0,0 +1,104 @@
+"""
+Индексы MongoDB по спецификации из app/db/indexes.py.
+
+ensure_indexes() запускается из connect_db() фоновой задачей: сверяет
+индексы коллекций с INDEXES, создаёт недостающие и печатает отчёт —
+чего не хватало, что создано, что создать не удалось и какие индексы
+лишние. Лишние индексы не удаляются: их могли создать вручную в Atlas.
+Повторный запуск ничего не меняет.
+
+Индексы сравниваются по ключам, а не по имени: индекс с теми же ключами
+под другим именем считается существующим.
+
+TEXT_INDEXES в MongoDB не создаются: поиск там идёт регулярными
+выражениями (см. text_search_query()).
+"""
+
+from typing import Any, Dict, List
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from app.db.indexes import INDEXES, IndexSpec, index_name
+
+
+def index_model(collection: str, spec: IndexSpec) -> IndexModel:
+    options: Dict[str, Any] = {"name": index_name(collection, spec)}
+    if spec.unique:
+        options["unique"] = True
+    if spec.partial_filter is not None:
+        options["partialFilterExpression"] = spec.partial_filter
+    if spec.expire_after_seconds is not None:
+        options["expireAfterSeconds"] = spec.expire_after_seconds
+    return IndexModel(spec.keys, **options)
+
+
+def _key(keys) -> tuple:
+    """Ключ индекса для сравнения: list_indexes() может вернуть 1.0 вместо 1."""
+    return tuple(
+        (field, int(direction) if isinstance(direction, (int, float)) else direction)
+        for field, direction in keys
+    )
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """Создать недостающие индексы; возвращает отчёт {раздел: ["коллекция.индекс", ...]}."""
+    report: Dict[str, List[str]] = {
+        "missing": [],
+        "created": [],
+        "failed": [],
+        "mismatched": [],
+        "extra": [],
+    }
+
+    for collection, specs in INDEXES.items():
+        existing = {}
+        async for info in db[collection].list_indexes():
+            existing[_key(info["key"].items())] = info
+
+        declared = set()
+        for spec in specs:
+            key = _key(spec.keys)
+            declared.add(key)
+            info = existing.get(key)
+            name = f"{collection}.{index_name(collection, spec)}"
+            if info is not None:
+                if (
+                    bool(info.get("unique")) != spec.unique
+                    or info.get("partialFilterExpression") != spec.partial_filter
+                    or info.get("expireAfterSeconds") != spec.expire_after_seconds
+                ):
+                    report["mismatched"].append(f"{collection}.{info['name']}")
+                continue
+
+            report["missing"].append(name)
+            # По одному: дубликаты под unique не мешают создать остальные
+            try:
+                await db[collection].create_indexes([index_model(collection, spec)])
+            except OperationFailure as e:
+                report["failed"].append(f"{name} ({str(e)[:100]})")
+                continue
+            report["created"].append(name)
+
+        for key, info in existing.items():
+            if info["name"] != "_id_" and key not in declared:
+                report["extra"].append(f"{collection}.{info['name']}")
+
+    print_report(report)
+    return report
+
+
+def print_report(report: Dict[str, List[str]]):
+    if not any(report.values()):
+        print("[OK] MongoDB indexes match the spec")
+        return
+    if report["missing"]:
+        print(f"[INFO] MongoDB indexes missing: {', '.join(report['missing'])}")
+    if report["created"]:
+        print(f"[OK] MongoDB indexes created: {', '.join(report['created'])}")
+    for item in report["failed"]:
+        print(f"[WARNING] MongoDB index not created: {item}")
+    if report["mismatched"]:
+        print(f"[WARNING] MongoDB indexes with options differing from the spec: {', '.join(report['mismatched'])}")
+    if report["extra"]:
+        print(f"[INFO] MongoDB indexes not in the spec: {', '.join(report['extra'])}")
@@ -0,0 +1,232 @@
+"""
+Проекции MongoDB ({"title": 1, "messages.read": 1} или {"password_hash": 0})
+для SQLite fallback.
+
+Проекция включения компилируется в список колонок: по одной на поле
+верхнего уровня, `data -> '$.поле'`. Для вложенных путей колонка
+собирается в SQL через json_object(), по элементам массивов — через
+json_each(), как делает MongoDB для "messages.read". В Python приходят
+и декодируются только выбранные поля. Проекция исключения — это
+json_remove(data, ...). Если проекцию нельзя выразить в SQL (запрос
+фильтруется в Python), она применяется к готовому документу через
+Projection.apply().
+
+{"messages": {"$slice": -50}} обрезает массив верхнего уровня: для
+массивов в дочерних таблицах (см. CHILD_ARRAYS) — прямо в SQL, для
+остальных — после декодирования.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.db.sqlite_query import json_path
+
+# Дерево включаемых полей: {"title": True, "messages": {"read": True}}
+Tree = Dict[str, Any]
+
+
+def _quote(sql: str) -> str:
+    return "'" + sql.replace("'", "''") + "'"
+
+
+class Projection:
+    """Разобранная проекция: включение полей или исключение."""
+
+    def __init__(self, spec: dict):
+        spec = dict(spec)
+        id_value = spec.pop("_id", None)
+        self.include_id = id_value is None or bool(id_value)
+
+        # {"поле": {"$slice": n | [skip, n]}} — не влияет на режим проекции
+        self.slices: Dict[str, Any] = {}
+        for field, value in list(spec.items()):
+            if not isinstance(value, dict):
+                continue
+            if set(value) != {"$slice"} or "." in field:
+                raise NotImplementedError(f"Projection operators are not supported: {field}")
+            self.slices[field] = value["$slice"]
+            del spec[field]
+
+        values = {bool(v) for v in spec.values()}
+        if len(values) > 1:
+            raise ValueError("Cannot do exclusion and inclusion in the same projection")
+        if values == {True}:
+            # Обрезаемый массив в проекции включения тоже включается
+            spec.update({field: 1 for field in self.slices})
+
+        # {"_id": 1} без других полей — тоже проекция включения
+        self.inclusive = values == {True} or (not spec and bool(id_value))
+        self.fields: List[str] = list(spec)
+        self.tree: Tree = {}
+        if self.inclusive:
+            for field in self.fields:
+                node = self.tree
+                parts = field.split(".")
+                for part in parts[:-1]:
+                    child = node.get(part)
+                    if child is True:
+                        break
+                    node = node.setdefault(part, {})
+                else:
+                    node[parts[-1]] = True
+            self._names = (["_id"] if self.include_id else []) + list(self.tree)
+        else:
+            self.excluded = self.fields + ([] if self.include_id else ["_id"])
+
+    # -------------------------------------------------------------------------
+    # SQL
+    # -------------------------------------------------------------------------
+
+    def columns(
+        self, doc: str = "data", fields: Optional[Dict[str, str]] = None
+    ) -> List[Tuple[Optional[str], str]]:
+        """
+        Колонки SELECT: [(поле верхнего уровня, SQL)].
+
+        Для проекции исключения — одна колонка (None, json_remove(...)) с
+        целым документом. fields — SQL значения для полей, которые лежат не
+        в doc (массив из дочерней таблицы).
+        """
+        if not self.inclusive:
+            if not self.excluded:
+                return [(None, doc)]
+            paths = ", ".join(_quote(json_path(field)) for field in self.excluded)
+            return [(None, f"json_remove({doc}, {paths})")]
+
+        columns = []
+        if self.include_id:
+            columns.append(("_id", f"{doc} -> '$._id'"))
+        for field, subtree in self.tree.items():
+            node = (fields or {}).get(field) or f"{doc} -> {_quote(json_path(field))}"
+            columns.append((field, node if subtree is True else _subtree_sql(node, subtree, 1)))
+        return columns
+
+    def assemble(self, values: tuple, codec, sliced: Iterable[str] = ()) -> dict:
+        """
+        Собрать документ из значений колонок columns() кодеком коллекции.
+
+        sliced — поля, $slice для которых уже выполнен в SQL.
+        """
+        if not self.inclusive:
+            doc = codec.decode(values[0])
+        else:
+            doc = {}
+            for field, value in zip(self._names, values):
+                if value is not None:
+                    doc[field] = codec.decode_value(value)
+            doc = codec.restore(doc)
+        return self.apply_slices(doc, sliced)
+
+    def apply_slices(self, doc: dict, skip: Iterable[str] = ()) -> dict:
+        for field, spec in self.slices.items():
+            if field not in skip and isinstance(doc.get(field), list):
+                doc[field] = slice_list(doc[field], spec)
+        return doc
+
+    # -------------------------------------------------------------------------
+    # Python
+    # -------------------------------------------------------------------------
+
+    def apply(self, doc: dict) -> dict:
+        """Применить проекцию к полному документу."""
+        if not self.inclusive:
+            result = dict(doc)
+            for field in self.excluded:
+                _remove_path(result, field.split("."))
+            return self.apply_slices(result)
+
+        result = {}
+        if self.include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        for field, subtree in self.tree.items():
+            if field in doc:
+                value = _project_value(doc[field], subtree)
+                if value is not _SKIP:
+                    result[field] = value
+        return self.apply_slices(result)
+
+    def needs_field(self, field: str) -> bool:
+        """Попадает ли поле верхнего уровня (целиком или частично) в результат."""
+        if self.inclusive:
+            return field in self.tree
+        return field not in self.excluded
+
+
+_SKIP = object()
+
+
+def slice_bounds(spec: Any) -> Tuple[int, Optional[int]]:
+    """
+    $slice в (skip, limit): n — первые n, -n — последние n, [skip, n].
+
+    Отрицательный skip отсчитывается от конца массива, limit=None — до конца.
+    """
+    if isinstance(spec, bool) or not isinstance(spec, (int, list, tuple)):
+        raise ValueError("$slice expects a number or [skip, limit]")
+    if isinstance(spec, int):
+        return (0, spec) if spec >= 0 else (spec, None)
+    skip, limit = spec
+    if limit <= 0:
+        raise ValueError("$slice limit must be positive")
+    return skip, limit
+
+
+def slice_list(items: list, spec: Any) -> list:
+    skip, limit = slice_bounds(spec)
+    items = items[skip:] if skip else items
+    return items if limit is None else items[:limit]
+
+
+def _subtree_sql(node: str, tree: Tree, depth: int) -> str:
+    """
+    SQL для вложенной проекции значения node (объекта или массива объектов).
+
+    Отсутствующие поля отбрасываются через json_patch('{}', ...); значения,
+    которые не объект и не массив, дают NULL — поле не попадает в результат.
+    """
+    alias = f"e{depth}"
+
+    def object_sql(obj: str) -> str:
+        parts = []
+        for key, subtree in tree.items():
+            child = f"{obj} -> {_quote(json_path(key))}"
+            if subtree is not True:
+                child = _subtree_sql(child, subtree, depth + 1)
+            parts.append(f"{_quote(key)}, {child}")
+        return f"json_patch('{{}}', json_object({', '.join(parts)}))"
+
+    return (
+        f"CASE json_type({node}) "
+        f"WHEN 'object' THEN {object_sql(node)} "
+        f"WHEN 'array' THEN (SELECT json_group_array({object_sql(f'{alias}.value')}) "
+        f"FROM json_each({node}) AS {alias} WHERE {alias}.type = 'object') "
+        f"END"
+    )
+
+
+def _project_value(value: Any, subtree: Any) -> Any:
+    if subtree is True:
+        return value
+    if isinstance(value, dict):
+        result = {}
+        for key, child in subtree.items():
+            if key in value:
+                projected = _project_value(value[key], child)
+                if projected is not _SKIP:
+                    result[key] = projected
+        return result
+    if isinstance(value, list):
+        return [_project_value(item, subtree) for item in value if isinstance(item, dict)]
+    return _SKIP
+
+
+def _remove_path(doc: Any, parts: List[str]):
+    if isinstance(doc, list):
+        for item in doc:
+            _remove_path(item, parts)
+        return
+    if not isinstance(doc, dict):
+        return
+    if len(parts) == 1:
+        doc.pop(parts[0], None)
+    elif parts[0] in doc:
+        _remove_path(doc[parts[0]], parts[1:])
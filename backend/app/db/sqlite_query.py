@@ -0,0 +1,395 @@
+"""
+Компилятор MongoDB-запросов в SQL для SQLite fallback.
+
+Документы хранятся как JSON в колонке data, поэтому условия строятся
+через json_extract(). Поддерживаются операторы, которые используют
+роутеры и сервисы: равенство, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin,
+$exists, $regex/$options, $and, $or, $nor. Верхнеуровневый $text
+выполняется через FTS5-таблицу коллекции, сортировка по
+{"$meta": "textScore"} — по её рангу bm25.
+
+Если запрос содержит что-то неподдерживаемое, QueryCompiler бросает
+UnsupportedQuery — коллекция тогда фильтрует документы в Python.
+"""
+
+import re
+from datetime import datetime
+from functools import lru_cache
+
+from app.db.codec import format_datetime
+from typing import Any, Callable, List, Optional, Sequence, Tuple, Union
+
+SortSpec = List[Tuple[str, int]]
+
+_IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+_WORD_RE = re.compile(r"\w+")
+
+# $options, которые переносятся в inline-флаги Python re
+_REGEX_FLAGS = "imsx"
+
+# Типы, между которыми работают $gt/$gte/$lt/$lte: числа (и bool — в
+# SQLite это 0/1) с числами, строки (и datetime) со строками. Названия
+# общие для typeof() и json_type()
+_NUMBER_TYPES = "('integer', 'real', 'true', 'false')"
+_TEXT_TYPES = "('text')"
+
+
+class UnsupportedQuery(Exception):
+    """Запрос нельзя выразить в SQL — нужна фильтрация в Python."""
+
+
+class TextIndexRequired(Exception):
+    """$text по коллекции без полнотекстового индекса (как в MongoDB)."""
+
+
+def json_path(field: str) -> str:
+    """
+    Преобразовать путь Mongo в JSON path SQLite.
+
+    "seller.name" -> "$.seller.name", "messages.0" -> "$.messages[0]",
+    ключи с нестандартными символами берутся в кавычки.
+    """
+    path = "$"
+    for part in field.split("."):
+        if part.isdigit():
+            path += f"[{part}]"
+        elif _IDENTIFIER_RE.match(part):
+            path += f".{part}"
+        else:
+            escaped = part.replace('"', '\\"')
+            path += f'."{escaped}"'
+    return path
+
+
+def sql_value(value: Any) -> Any:
+    """Привести Python-значение к тому, что вернёт json_extract()."""
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    if isinstance(value, bool):
+        return int(value)
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise UnsupportedQuery(f"Cannot compare with {type(value).__name__}")
+
+
+def regex_pattern(pattern: Union[str, "re.Pattern"], options: str = "") -> str:
+    """Собрать шаблон с inline-флагами из $regex и $options."""
+    if isinstance(pattern, re.Pattern):
+        flags = ""
+        if pattern.flags & re.IGNORECASE:
+            flags += "i"
+        if pattern.flags & re.MULTILINE:
+            flags += "m"
+        if pattern.flags & re.DOTALL:
+            flags += "s"
+        options = flags + (options or "")
+        pattern = pattern.pattern
+    inline = "".join(sorted({o for o in options or "" if o in _REGEX_FLAGS}))
+    return f"(?{inline}){pattern}" if inline else pattern
+
+
+def search_terms(search: str) -> List[str]:
+    """Слова поисковой строки в нижнем регистре."""
+    return [word.lower() for word in _WORD_RE.findall(search or "")]
+
+
+def fts_query(search: str) -> Optional[str]:
+    """
+    Запрос FTS5 MATCH: все слова обязательны, каждое ищется по префиксу.
+
+    Слова берутся в кавычки, поэтому пользовательский ввод не может
+    использовать синтаксис FTS5 (NEAR, OR, столбцы и т.п.).
+    """
+    terms = search_terms(search)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+@lru_cache(maxsize=256)
+def compile_regex(pattern: str) -> "re.Pattern":
+    """
+    Скомпилированный шаблон из ограниченного LRU-кэша.
+
+    Флаги уже встроены в шаблон через regex_pattern(), поэтому ключ кэша —
+    одна строка. Общий для SQL-функции regexp() и матчера в Python.
+    """
+    return re.compile(pattern)
+
+
+def sqlite_regexp(pattern: Optional[str], value: Any) -> int:
+    """Функция regexp(pattern, value), регистрируемая в каждом соединении."""
+    if pattern is None:
+        return 0
+    text = "" if value is None else str(value)
+    return 1 if compile_regex(pattern).search(text) else 0
+
+
+class QueryCompiler:
+    """
+    Компилирует фильтр Mongo в SQL-условие с параметрами.
+
+    doc — SQL-выражение с JSON-документом ("data" для строк таблицы,
+    "value" для элементов json_each). columns — поля, для которых в
+    таблице есть отдельные колонки. table и text_table нужны для $text
+    (JOIN с FTS5-таблицей). array_fields — поля-массивы, для которых
+    равенство, $in и $all означают «содержит элемент», как в MongoDB.
+    """
+
+    def __init__(
+        self,
+        doc: str = "data",
+        columns: Optional[dict] = None,
+        table: Optional[str] = None,
+        text_table: Optional[str] = None,
+        array_fields: Sequence[str] = (),
+    ):
+        self.doc = doc
+        self.array_fields = set(array_fields)
+        self.table = table
+        self.columns = {"_id": "id"} if doc == "data" else {}
+        if columns:
+            self.columns.update(columns)
+        self.text_table = text_table
+        # Строка MATCH из $text; используется в from_clause()
+        self.text_search: Optional[str] = None
+
+    def field(self, name: str) -> str:
+        """SQL-выражение для значения поля документа."""
+        if name in self.columns:
+            return self.columns[name]
+        path = json_path(name).replace("'", "''")
+        return f"json_extract({self.doc}, '{path}')"
+
+    def compile(self, query: Optional[dict]) -> Tuple[str, list]:
+        params: list = []
+        query = dict(query or {})
+        text = query.pop("$text", None)
+        if text is not None:
+            if self.text_table is None:
+                raise TextIndexRequired("text index required for $text query")
+            self.text_search = fts_query(text.get("$search", ""))
+            if self.text_search is None:
+                # В строке поиска нет ни одного слова — ничего не найдено
+                return "0", []
+        sql = self._compile_doc(query, params)
+        return sql, params
+
+    def from_clause(self) -> Tuple[str, list]:
+        """
+        FROM для запроса; при $text добавляется JOIN с FTS5-таблицей.
+
+        Параметры JOIN идут в SQL раньше параметров WHERE.
+        """
+        table = self.table
+        if self.text_search is None:
+            return f"FROM {table}", []
+        return (
+            f"FROM {table} JOIN ("
+            f"SELECT rowid AS fts_rowid, rank AS fts_score "
+            f"FROM {self.text_table} WHERE {self.text_table} MATCH ?"
+            f") ON fts_rowid = {table}.rowid",
+            [self.text_search],
+        )
+
+    def _compile_doc(self, query: dict, params: list) -> str:
+        clauses = []
+        for key, value in query.items():
+            if key in ("$and", "$or", "$nor"):
+                clauses.append(self._compile_logical(key, value, params))
+            elif key.startswith("$"):
+                raise UnsupportedQuery(f"Unsupported top-level operator {key}")
+            elif "." in key and key not in self.columns:
+                # "items.name" в MongoDB проходит по элементам массива items,
+                # json_extract() так не умеет
+                raise UnsupportedQuery(f"Dotted path {key}")
+            elif key in self.array_fields:
+                clauses.append(self._compile_array(key, value, params))
+            elif isinstance(value, dict) and any(k.startswith("$") for k in value):
+                clauses.append(self._compile_operators(key, value, params))
+            else:
+                clauses.append(self._compile_eq(key, value, params))
+
+        if not clauses:
+            return "1"
+        return " AND ".join(clauses) if len(clauses) == 1 else "(" + " AND ".join(clauses) + ")"
+
+    def _compile_logical(self, op: str, branches: Sequence[dict], params: list) -> str:
+        if not isinstance(branches, (list, tuple)) or not branches:
+            raise UnsupportedQuery(f"{op} expects a non-empty list")
+        parts = [self._compile_doc(branch, params) for branch in branches]
+        if op == "$and":
+            return "(" + " AND ".join(parts) + ")"
+        if op == "$nor":
+            # Условие на отсутствующее поле даёт NULL, а NOT NULL — тоже NULL:
+            # документ без поля выпал бы, хотя MongoDB его возвращает
+            return "NOT (" + " OR ".join(f"COALESCE({part}, 0)" for part in parts) + ")"
+        return "(" + " OR ".join(parts) + ")"
+
+    def _compile_array(self, field: str, condition: Any, params: list) -> str:
+        """Условия на элементы поля-массива через json_each()."""
+        path = json_path(field).replace("'", "''")
+
+        def contains(values: list) -> str:
+            params.extend(sql_value(v) for v in values)
+            return (
+                f"EXISTS (SELECT 1 FROM json_each({self.doc}, '{path}') "
+                f"WHERE value IN ({', '.join('?' * len(values))}))"
+            )
+
+        if not isinstance(condition, dict) or not any(k.startswith("$") for k in condition):
+            if condition is None or isinstance(condition, (list, dict, re.Pattern)):
+                raise UnsupportedQuery(f"Unsupported array condition for {field}")
+            return contains([condition])
+
+        clauses = []
+        for op, value in condition.items():
+            if op == "$in" and isinstance(value, (list, tuple)) and value and None not in value:
+                clauses.append(contains(list(value)))
+            elif op == "$all" and isinstance(value, (list, tuple)) and value:
+                clauses.extend(contains([v]) for v in value)
+            elif op == "$eq" and not isinstance(value, (list, dict, re.Pattern)) and value is not None:
+                clauses.append(contains([value]))
+            else:
+                raise UnsupportedQuery(f"Unsupported array operator {op} for {field}")
+        return clauses[0] if len(clauses) == 1 else "(" + " AND ".join(clauses) + ")"
+
+    def _any_value(self, field: str, condition: Callable[[str, str], str]) -> str:
+        """
+        Условие на значение поля или на любой элемент массива в нём.
+
+        condition(value, type) строит SQL по выражению значения и его типа
+        (в названиях typeof()/json_type()) и сам добавляет параметры: для
+        массива он вызывается второй раз, над элементами json_each().
+        Индексированные колонки хранят скаляры — поля-массивы в индексы не
+        попадают, — для них условие одно и индекс используется.
+        """
+        if field in self.columns:
+            column = self.columns[field]
+            return condition(column, f"typeof({column})")
+        path = json_path(field).replace("'", "''")
+        value = f"json_extract({self.doc}, '{path}')"
+        value_type = f"json_type({self.doc}, '{path}')"
+        return (
+            f"({condition(value, value_type)} OR ({value_type} = 'array' AND EXISTS ("
+            f"SELECT 1 FROM json_each({self.doc}, '{path}') AS elem "
+            f"WHERE {condition('elem.value', 'elem.type')})))"
+        )
+
+    def _compile_eq(self, field: str, value: Any, params: list) -> str:
+        if isinstance(value, re.Pattern):
+            return self._compile_regex(field, regex_pattern(value), params)
+        if value is None:
+            return self._any_value(field, lambda expr, _: f"{expr} IS NULL")
+        value = sql_value(value)
+
+        def equals(expr: str, _: str) -> str:
+            params.append(value)
+            return f"{expr} = ?"
+
+        return self._any_value(field, equals)
+
+    def _compile_regex(self, field: str, pattern: str, params: list) -> str:
+        def matches(expr: str, expr_type: str) -> str:
+            # Только строки: JSON-текст массива или объекта не в счёт
+            params.append(pattern)
+            return f"({expr_type} = 'text' AND regexp(?, {expr}))"
+
+        return self._any_value(field, matches)
+
+    def _compile_compare(self, field: str, op: str, value: Any, params: list) -> str:
+        value = sql_value(value)
+        if value is None:
+            # С null не сравнивается ничего
+            return "0"
+        sign = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}[op]
+        types = _NUMBER_TYPES if isinstance(value, (int, float)) else _TEXT_TYPES
+
+        def compare(expr: str, expr_type: str) -> str:
+            params.append(value)
+            return f"({expr_type} IN {types} AND {expr} {sign} ?)"
+
+        return self._any_value(field, compare)
+
+    def _compile_operators(self, field: str, ops: dict, params: list) -> str:
+        clauses = []
+        for op, value in ops.items():
+            if op == "$eq":
+                clauses.append(self._compile_eq(field, value, params))
+            elif op == "$ne":
+                clauses.append(f"NOT COALESCE({self._compile_eq(field, value, params)}, 0)")
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                clauses.append(self._compile_compare(field, op, value, params))
+            elif op == "$in":
+                clauses.append(self._compile_in(field, value, params))
+            elif op == "$nin":
+                clauses.append(f"NOT COALESCE({self._compile_in(field, value, params)}, 0)")
+            elif op == "$exists":
+                if field == "_id" and "_id" in self.columns:
+                    check = self.columns["_id"]
+                else:
+                    # json_type() отличает JSON null от отсутствующего поля
+                    path = json_path(field).replace("'", "''")
+                    check = f"json_type({self.doc}, '{path}')"
+                clauses.append(f"{check} IS {'NOT ' if value else ''}NULL")
+            elif op == "$regex":
+                pattern = regex_pattern(value, ops.get("$options", ""))
+                clauses.append(self._compile_regex(field, pattern, params))
+            elif op == "$options":
+                if "$regex" not in ops:
+                    raise UnsupportedQuery("$options without $regex")
+            else:
+                raise UnsupportedQuery(f"Unsupported operator {op}")
+
+        return " AND ".join(clauses) if len(clauses) == 1 else "(" + " AND ".join(clauses) + ")"
+
+    def _compile_in(self, field: str, values: Sequence, params: list) -> str:
+        if not isinstance(values, (list, tuple, set)):
+            raise UnsupportedQuery("$in expects a list")
+        values = list(values)
+        has_null = any(v is None for v in values)
+        values = [sql_value(v) for v in values if v is not None]
+        if not values and not has_null:
+            return "0"
+
+        def contains(expr: str, _: str) -> str:
+            parts = []
+            if values:
+                params.extend(values)
+                parts.append(f"{expr} IN ({', '.join('?' * len(values))})")
+            if has_null:
+                parts.append(f"{expr} IS NULL")
+            return parts[0] if len(parts) == 1 else "(" + " OR ".join(parts) + ")"
+
+        return self._any_value(field, contains)
+
+    def compile_sort(self, sort: Optional[SortSpec]) -> str:
+        """ORDER BY для спецификации сортировки; пустая строка если её нет."""
+        if not sort:
+            return ""
+        terms = []
+        last = None
+        for field, direction in sort:
+            if isinstance(direction, dict) and direction.get("$meta") == "textScore":
+                # bm25 в FTS5: чем меньше, тем релевантнее
+                if self.text_search is not None:
+                    terms.append("fts_score ASC")
+                continue
+            terms.append(f"{self.field(field)} {'DESC' if direction == -1 else 'ASC'}")
+            last = (field, direction)
+        if not terms:
+            return ""
+        # Стабильный порядок при равных ключах: записи индекса с одинаковым
+        # значением уже упорядочены по rowid, так что индекс используется
+        if last is None or last[0] != "_id":
+            rowid = f"{self.table}.rowid" if self.table else "rowid"
+            terms.append(f"{rowid} {'DESC' if last and last[1] == -1 else 'ASC'}")
+        return "ORDER BY " + ", ".join(terms)
+
+
+def normalize_sort(key_or_list: Union[str, SortSpec], direction: Optional[int] = None) -> SortSpec:
+    """Привести аргументы cursor.sort() к списку (поле, направление)."""
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else 1)]
+    return [(field, dir_) for field, dir_ in key_or_list]
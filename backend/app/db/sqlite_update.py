@@ -0,0 +1,183 @@
+"""
+Компилятор операторов обновления MongoDB в SQL для SQLite fallback.
+
+Обновление превращается в одно выражение над колонкой data, поэтому
+UPDATE ... SET data = <выражение> выполняется атомарно одним statement,
+без чтения документа в Python.
+
+MongoDB не допускает в одном обновлении пересекающихся путей ("a" и
+"a.b"), поэтому каждый оператор читает текущее значение из исходной
+data, а все изменения собираются в один json_set(data, p1, v1, p2, v2, ...)
+(плюс json_replace() для массивов и json_remove() для $unset). Длина SQL
+и число параметров растут линейно с числом полей.
+
+Поддерживаются $set, $inc, $unset, $push (включая $each) и $set по
+пути с $[<id>] (arrayFilters) или $[] (все элементы массива).
+"""
+
+from typing import Any, Callable, List, Optional, Tuple
+
+from app.db.sqlite_query import QueryCompiler, UnsupportedQuery, json_path
+
+Fragment = Tuple[str, list]
+# (путь в SQL, выражение значения, параметры значения)
+Edit = Tuple[str, str, list]
+
+# Элемент json_each() как JSON-значение для json_group_array():
+# объекты/массивы помечаются как JSON, true/false не превращаются в 1/0
+_EACH_VALUE = (
+    "CASE type "
+    "WHEN 'object' THEN json(value) "
+    "WHEN 'array' THEN json(value) "
+    "WHEN 'true' THEN json('true') "
+    "WHEN 'false' THEN json('false') "
+    "ELSE value END"
+)
+
+
+def _quote(sql: str) -> str:
+    return "'" + sql.replace("'", "''") + "'"
+
+
+class UpdateCompiler:
+    """
+    Компилирует документ обновления в SQL-выражение для новой data.
+
+    encode — функция сериализации значения в JSON-текст (кодек коллекции).
+    """
+
+    def __init__(self, encode: Callable[[Any], str], array_filters: Optional[List[dict]] = None):
+        self.encode = encode
+        self.array_filters = {}
+        for flt in array_filters or []:
+            for key, condition in flt.items():
+                name, _, field = key.partition(".")
+                self.array_filters.setdefault(name, {})[field] = condition
+
+    def compile(self, update: dict) -> Fragment:
+        if not update or not all(op.startswith("$") for op in update):
+            raise ValueError("update only works with $ operators")
+
+        sets: List[Edit] = []
+        replaces: List[Edit] = []
+        removes: List[str] = []
+        paths: List[Tuple[List[str], bool]] = []
+        for op, fields in update.items():
+            apply = {
+                "$set": self._set,
+                "$inc": self._inc,
+                "$unset": None,
+                "$push": self._push,
+            }.get(op, False)
+            if apply is False:
+                raise NotImplementedError(f"Update operator {op} is not supported by the SQLite backend")
+            for field, value in fields.items():
+                _check_conflict(paths, field)
+                if op == "$unset":
+                    removes.append(_quote(json_path(field)))
+                elif op == "$set" and "$[" in field:
+                    replaces.append(self._set_in_array(field, value))
+                else:
+                    sets.append(apply(field, value))
+
+        sql, params = "data", []
+        for function, edits in (("json_set", sets), ("json_replace", replaces)):
+            if edits:
+                pairs = ", ".join(f"{path}, {value_sql}" for path, value_sql, _ in edits)
+                sql = f"{function}({sql}, {pairs})"
+                for _, _, value_params in edits:
+                    params += value_params
+        if removes:
+            sql = f"json_remove({sql}, {', '.join(removes)})"
+        return sql, params
+
+    def _value(self, value: Any) -> Fragment:
+        return "json(?)", [self.encode(value)]
+
+    def _set(self, field: str, value: Any) -> Edit:
+        val_sql, val_params = self._value(value)
+        return _quote(json_path(field)), val_sql, val_params
+
+    def _inc(self, field: str, value: Any) -> Edit:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"Cannot $inc by non-numeric value for {field}")
+        path = _quote(json_path(field))
+        return path, f"COALESCE(json_extract(data, {path}), 0) + ?", [value]
+
+    def _push(self, field: str, value: Any) -> Edit:
+        if isinstance(value, dict) and "$each" in value:
+            items = list(value["$each"])
+        else:
+            items = [value]
+        path = _quote(json_path(field))
+        sql = f"COALESCE(json_extract(data, {path}), json('[]'))"
+        params = []
+        if items:
+            appends = ", ".join("'$[#]', json(?)" for _ in items)
+            sql = f"json_insert({sql}, {appends})"
+            params = [self.encode(item) for item in items]
+        return path, sql, params
+
+    def _set_in_array(self, field: str, value: Any) -> Edit:
+        """
+        $set по пути вида "messages.$[elem].read".
+
+        Массив пересобирается через json_each(): элементы, подходящие под
+        arrayFilters, изменяются, остальные копируются как есть. Значение
+        идёт в json_replace(): отсутствующее поле не создаётся, а
+        не-массив заменяется сам на себя.
+        """
+        array_field, _, rest = field.partition(".$[")
+        name, _, inner = rest.partition("]")
+        inner = inner.lstrip(".")
+        if "$[" in inner or "$" in array_field.split("."):
+            raise NotImplementedError("Nested or positional array updates are not supported")
+
+        if name:
+            condition = self.array_filters.get(name)
+            if condition is None:
+                raise ValueError(f"No array filter found for identifier '{name}'")
+            try:
+                cond_sql, cond_params = QueryCompiler(doc="json_each.value").compile(condition)
+            except UnsupportedQuery as e:
+                raise NotImplementedError(str(e))
+        else:
+            cond_sql, cond_params = "1", []
+
+        val_sql, val_params = self._value(value)
+        if inner:
+            new_elem = f"json_set(value, {_quote(json_path(inner))}, {val_sql})"
+            # Поля есть только у элементов-объектов; CASE не даёт вычислять
+            # json_extract() над строками и числами
+            cond_sql = f"CASE WHEN type = 'object' THEN {cond_sql} ELSE 0 END"
+        else:
+            new_elem = val_sql
+
+        path = _quote(json_path(array_field))
+        rebuilt = (
+            f"(SELECT json_group_array(CASE WHEN {cond_sql} THEN {new_elem} ELSE {_EACH_VALUE} END) "
+            f"FROM json_each(data, {path}))"
+        )
+        sql = f"CASE WHEN json_type(data, {path}) = 'array' THEN {rebuilt} ELSE json(data -> {path}) END"
+        return path, sql, [*cond_params, *val_params]
+
+
+def _check_conflict(paths: List[Tuple[List[str], bool]], field: str):
+    """
+    Пути одного обновления не должны пересекаться — как в MongoDB.
+
+    Для "$[...]" путём считается сам массив: два изменения одного массива
+    читали бы его исходную версию и затирали друг друга.
+    """
+    array_field, positional, _ = field.partition(".$[")
+    parts = array_field.split(".")
+    for other, other_positional in paths:
+        common = min(len(parts), len(other))
+        if parts[:common] != other[:common]:
+            continue
+        if positional and other_positional and parts == other:
+            raise NotImplementedError(
+                f"Several $[] updates of '{array_field}' in one update are not supported by the SQLite backend"
+            )
+        raise ValueError(f"Updating the path '{field}' would create a conflict at '{'.'.join(parts[:common])}'")
+    paths.append((parts, bool(positional)))
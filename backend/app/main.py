@@ -5,8 +5,14 @@ from contextlib import asynccontextmanager
 from pathlib import Path
 
 from app.config import get_settings
-from app.db.database import connect_db, close_db
+from app.db.database import connect_db, close_db, get_db
+from app.db.migrations import backfill_unread_counts, migrate_conversation_messages
 from app.routers import chat, products, upload, auth, favorites, geocode, conversations
+from app.services.ai_cache import ai_cache
+from app.services.auth_service import token_cache_stats, user_cache_stats
+from app.services.chat_history import chat_history
+from app.services.http_client import close_http_client, start_http_client
+from app.services.view_counter import view_counter
 
 
 settings = get_settings()
@@ -20,7 +26,14 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 async def lifespan(app: FastAPI):
     print("Dehqonjon API starting...")
     await connect_db()
+    await migrate_conversation_messages(get_db())
+    await backfill_unread_counts(get_db())
+    await ai_cache.purge_expired()
+    await view_counter.start()
+    await start_http_client()
     yield
+    await close_http_client()
+    await view_counter.stop()
     await close_db()
     print("Dehqonjon API shutting down...")
 
@@ -61,3 +74,15 @@ async def root():
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "view_counter": view_counter.stats(),
+        "user_cache": user_cache_stats(),
+        "token_cache": token_cache_stats(),
+        "ai_cache": ai_cache.stats(),
+        "ai_context": chat.ai_service.context.stats(),
+        "chat_history": chat_history.stats(),
+    }
@@ -1,7 +1,7 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import Optional
-from app.services.auth_service import decode_token, get_user_by_id
+from app.services.auth_service import decode_token, get_cached_user
 
 security = HTTPBearer(auto_error=False)
 
@@ -21,7 +21,7 @@ async def get_optional_user(
     if not user_id:
         return None
     
-    user = await get_user_by_id(user_id)
+    user = await get_cached_user(user_id)
     if not user or not user.get("is_active"):
         return None
     
@@ -51,7 +51,7 @@ async def get_current_user(
         )
     
     user_id = payload.get("sub")
-    user = await get_user_by_id(user_id)
+    user = await get_cached_user(user_id)
     
     if not user:
         raise HTTPException(
@@ -37,6 +37,8 @@ class ChatRequest(BaseModel):
     conversation_id: Optional[str] = None
     image_url: Optional[str] = None
     history: Optional[list[ChatHistoryMessage]] = None  # История сообщений
+    # Сессия chat_sessions: история берётся на сервере, history не нужна
+    session_id: Optional[str] = None
 
 
 class ChatResponse(BaseModel):
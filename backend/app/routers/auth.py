@@ -9,6 +9,7 @@ from app.services.auth_service import (
     authenticate_user,
     create_access_token,
     upgrade_to_seller,
+    invalidate_user,
     get_user_by_id,
     get_user_by_username,
     search_users,
@@ -176,6 +177,7 @@ async def update_profile(request: UpdateProfileRequest, user: dict = Depends(get
         from datetime import datetime
         update_data["updated_at"] = datetime.utcnow()
         await db.users.update_one({"_id": user["_id"]}, {"$set": update_data})
+        invalidate_user(user["_id"])
     
     updated_user = await get_user_by_id(user["_id"])
     return user_to_response(updated_user)
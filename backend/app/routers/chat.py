@@ -1,7 +1,13 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends, Request
+from fastapi.responses import StreamingResponse
 from typing import Optional, List
 from pydantic import BaseModel
+from contextlib import aclosing
 from datetime import datetime
+import asyncio
+import anyio
+import json
+import time
 import uuid
 
 from app.models.chat import (
@@ -11,6 +17,8 @@ from app.models.chat import (
     ImageAnalysisResponse,
 )
 from app.services.ai_service import AIService
+from app.services.chat_history import chat_history, new_session_message, session_title
+from app.services.image_service import MAX_FILE_SIZE, ImageError, prepare_vision_image_async
 from app.middleware.auth import get_current_user, get_optional_user
 from app.db.database import get_db
 from app.db.models import generate_id
@@ -18,6 +26,11 @@ from app.db.models import generate_id
 router = APIRouter()
 ai_service = AIService()
 
+AI_WARNING = "Это предварительная оценка ИИ. Для точного диагноза обратитесь к специалисту."
+
+# Как часто (секунды) поток ответа проверяет, не ушёл ли клиент
+DISCONNECT_POLL_INTERVAL = 1.0
+
 
 # Models for chat persistence
 class ChatMessage(BaseModel):
@@ -46,36 +59,166 @@ class SaveMessageRequest(BaseModel):
     message: ChatMessage
 
 
+async def load_history(request: ChatRequest, user: Optional[dict]) -> Optional[list]:
+    """История для ИИ: из сессии на сервере (session_id) или присланная клиентом"""
+    if request.session_id:
+        if user is None:
+            raise HTTPException(status_code=401, detail="Требуется авторизация")
+        history = await chat_history.load(request.session_id, user["_id"])
+        if history is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        return history
+    
+    # Преобразуем историю в список словарей
+    if request.history:
+        return [{"role": msg.role, "content": msg.content} for msg in request.history]
+    return None
+
+
+async def save_turns(request: ChatRequest, user: dict, answer: str, history: list):
+    """Дописать вопрос и ответ в сессию одним обновлением"""
+    await chat_history.append(
+        request.session_id,
+        user["_id"],
+        [
+            new_session_message("user", request.message, request.image_url),
+            new_session_message("assistant", answer),
+        ],
+        first=not history,
+    )
+
+
 @router.post("/message", response_model=ChatResponse)
 async def send_message(request: ChatRequest, user: Optional[dict] = Depends(get_optional_user)):
     """Отправить сообщение ИИ-консультанту"""
     try:
-        conversation_id = request.conversation_id or str(uuid.uuid4())
-        
-        # Преобразуем историю в список словарей
-        history = None
-        if request.history:
-            history = [{"role": msg.role, "content": msg.content} for msg in request.history]
+        conversation_id = request.session_id or request.conversation_id or str(uuid.uuid4())
+        history = await load_history(request, user)
         
-        # Получаем ответ от ИИ
+        # Получаем ответ от ИИ. Краткое содержание истории строится только
+        # для сохранённых сессий: по сгенерированному id его не переиспользовать
         response = await ai_service.get_response(
             message=request.message,
-            conversation_id=conversation_id,
+            conversation_id=request.session_id,
             image_url=request.image_url,
             history=history,
         )
         
+        # Запасной ответ при недоступном ИИ в сессию не пишется
+        if request.session_id and not response.get("fallback"):
+            await save_turns(request, user, response["text"], history)
+        
         return ChatResponse(
             response=response["text"],
             conversation_id=conversation_id,
             suggestions=response.get("suggestions", []),
             diagnosis=response.get("diagnosis"),
-            warning="Это предварительная оценка ИИ. Для точного диагноза обратитесь к специалисту.",
+            warning=AI_WARNING,
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def sse_event(event: str, data: dict) -> str:
+    """Событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def while_connected(stream, http_request: Request, interval: float = DISCONNECT_POLL_INTERVAL):
+    """
+    События stream, пока клиент на связи; по выходу stream закрывается.
+    
+    Подключение проверяется не на каждом событии, а раз в interval секунд —
+    в том числе пока провайдер молчит между токенами. Если клиент ушёл,
+    ожидание следующего события отменяется: генератор stream получает
+    CancelledError и закрывает запрос к API. То же происходит при любом
+    выходе — в том числе когда Starlette сама отменяет ответ при
+    отключении клиента (ASGI до 2.4) или генератор закрывают снаружи.
+    """
+    checked = time.monotonic()
+    pending = None
+    try:
+        while True:
+            pending = asyncio.ensure_future(stream.__anext__())
+            # Провайдер молчит дольше interval — проверяем клиента, пока ждём
+            while not (await asyncio.wait({pending}, timeout=interval))[0]:
+                checked = time.monotonic()
+                if await http_request.is_disconnected():
+                    return
+            try:
+                event = pending.result()
+            except StopAsyncIteration:
+                return
+            pending = None
+            yield event
+            # Токены идут непрерывно — проверяем не чаще раза в interval
+            if time.monotonic() - checked >= interval:
+                checked = time.monotonic()
+                if await http_request.is_disconnected():
+                    return
+    finally:
+        # Пока __anext__ выполняется, aclose() упал бы с RuntimeError: сначала
+        # дожидаемся отмены. Экранируем от повторной отмены ответа Starlette
+        with anyio.CancelScope(shield=True):
+            if pending is not None:
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+            await stream.aclose()
+
+
+@router.post("/message/stream")
+async def stream_message(
+    request: ChatRequest,
+    http_request: Request,
+    user: Optional[dict] = Depends(get_optional_user),
+):
+    """
+    Отправить сообщение ИИ-консультанту с потоковым ответом (SSE).
+    
+    События: "token" ({"text": ...}) по мере генерации, затем одно "done"
+    с conversation_id, suggestions и warning. Если поток с провайдером
+    оборвался на середине, вместо "done" приходит "error" с detail, и
+    ответ в сессию не сохраняется.
+    """
+    conversation_id = request.session_id or request.conversation_id or str(uuid.uuid4())
+    history = await load_history(request, user)
+    
+    async def events():
+        stream = ai_service.stream_response(
+            message=request.message,
+            conversation_id=request.session_id,
+            history=history,
+        )
+        # Клиент ушёл — дальше не читаем, запрос к API закрывает while_connected
+        async with aclosing(while_connected(stream, http_request)) as stream_events:
+            async for event in stream_events:
+                if event["type"] == "token":
+                    yield sse_event("token", {"text": event["text"]})
+                elif event["type"] == "error":
+                    yield sse_event("error", {
+                        "conversation_id": conversation_id,
+                        "detail": event["detail"],
+                    })
+                else:
+                    # Сохраняется только ответ ИИ, дошедший до конца
+                    if request.session_id and not event.get("fallback"):
+                        await save_turns(request, user, event["text"], history)
+                    yield sse_event("done", {
+                        "conversation_id": conversation_id,
+                        "suggestions": event.get("suggestions", []),
+                        "warning": AI_WARNING,
+                    })
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Без буферизации в прокси: токены должны уходить сразу
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/upload-image", response_model=ImageAnalysisResponse)
 async def upload_and_analyze_image(
     image: UploadFile = File(...),
@@ -87,10 +230,22 @@ async def upload_and_analyze_image(
             raise HTTPException(status_code=400, detail="Файл должен быть изображением")
         
         image_data = await image.read()
+        if len(image_data) > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Файл слишком большой. Максимум: {MAX_FILE_SIZE // (1024*1024)} MB"
+            )
+        
+        # Уменьшаем фото до размера, которого хватает модели
+        try:
+            prepared = await prepare_vision_image_async(image_data)
+        except ImageError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         analysis = await ai_service.analyze_image(
-            image_data=image_data,
+            image_data=prepared.data,
             conversation_id=conversation_id,
+            mime_type=prepared.mime_type,
         )
         
         return ImageAnalysisResponse(
@@ -196,7 +351,11 @@ async def add_message_to_session(
     if db is None:
         raise HTTPException(status_code=503, detail="Database unavailable")
     
-    session = await db.chat_sessions.find_one({"_id": session_id, "user_id": user["_id"]})
+    # Достаточно знать, есть ли в сессии сообщения
+    session = await db.chat_sessions.find_one(
+        {"_id": session_id, "user_id": user["_id"]},
+        {"messages": {"$slice": 1}},
+    )
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -209,10 +368,10 @@ async def add_message_to_session(
     }
     
     if message.role == "user" and len(session.get("messages", [])) == 0:
-        title = message.content[:30] + ("..." if len(message.content) > 30 else "")
-        update_data["$set"]["title"] = title
+        update_data["$set"]["title"] = session_title(message.content)
     
     await db.chat_sessions.update_one({"_id": session_id}, update_data)
+    chat_history.invalidate(session_id)
     
     return {"success": True}
 
@@ -225,6 +384,7 @@ async def delete_chat_session(session_id: str, user: dict = Depends(get_current_
         raise HTTPException(status_code=503, detail="Database unavailable")
     
     result = await db.chat_sessions.delete_one({"_id": session_id, "user_id": user["_id"]})
+    chat_history.invalidate(session_id)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -239,7 +399,7 @@ async def get_chat_history(user: dict = Depends(get_current_user)):
     if db is None:
         return {"conversations": []}
     
-    cursor = db.chat_sessions.find({"user_id": user["_id"]}).sort("updated_at", -1)
+    cursor = db.chat_sessions.find({"user_id": user["_id"]}, {"title": 1}).sort("updated_at", -1)
     sessions = await cursor.to_list(length=100)
     
     return {"conversations": [{"id": s["_id"], "title": s["title"]} for s in sessions]}
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel
 from typing import Optional, List, Dict
 from datetime import datetime
+from pymongo import ReturnDocument
 
 from app.db.database import get_db
 from app.db.models import generate_id
@@ -41,6 +42,7 @@ class ConversationDetailResponse(BaseModel):
     participant_ids: List[str]
     participant_names: dict
     messages: List[MessageResponse]
+    has_more: bool = False
     product_id: Optional[str] = None
     product_title: Optional[str] = None
 
@@ -51,14 +53,92 @@ class StartConversationRequest(BaseModel):
     product_id: Optional[str] = None
 
 
+class MessagePageResponse(BaseModel):
+    messages: List[MessageResponse]
+    has_more: bool = False
+
+
+CONVERSATION_LIST_PROJECTION = {
+    "participant_ids": 1,
+    "participant_names": 1,
+    "last_message": 1,
+    "last_message_at": 1,
+    "product_id": 1,
+    "product_title": 1,
+    "created_at": 1,
+    "unread_counts": 1,
+}
+
+# Messages returned when a conversation is opened and per history page
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 100
+
+
+def new_message(conversation_id: str, sender_id: str, content: str, product_id: Optional[str], now: datetime) -> dict:
+    return {
+        "_id": generate_id(),
+        "conversation_id": conversation_id,
+        "sender_id": sender_id,
+        "content": content,
+        "product_id": product_id,
+        "created_at": now,
+        "read": False,
+    }
+
+
+def message_to_response(message: dict) -> MessageResponse:
+    return MessageResponse(
+        id=message["_id"],
+        sender_id=message["sender_id"],
+        content=message["content"],
+        product_id=message.get("product_id"),
+        created_at=message["created_at"],
+        read=message.get("read", False),
+    )
+
+
 def get_unread_count_for_user(conv: dict, user_id: str) -> int:
-    """Count unread messages for a specific user"""
-    count = 0
-    for msg in conv.get("messages", []):
-        # Count messages from OTHER users that are not read
-        if msg.get("sender_id") != user_id and not msg.get("read", False):
-            count += 1
-    return count
+    """Unread messages for a participant, maintained on the conversation"""
+    # A read can be counted before the matching increment lands, so the
+    # stored value may briefly go below zero
+    return max(0, (conv.get("unread_counts") or {}).get(user_id, 0))
+
+
+def unread_increments(participant_ids: List[str], sender_id: str) -> dict:
+    """$inc that counts a new message as unread for everyone but the sender"""
+    return {f"unread_counts.{uid}": 1 for uid in participant_ids if uid != sender_id}
+
+
+async def get_message_page(db, conversation_id: str, before: Optional[str], limit: int) -> MessagePageResponse:
+    """
+    Newest messages older than the `before` message, oldest first.
+
+    Seeks through the (conversation_id, created_at, _id) index instead of
+    skipping rows, so deep history pages cost the same as the first one.
+    """
+    query = {"conversation_id": conversation_id}
+    if before:
+        anchor = await db.messages.find_one(
+            {"_id": before, "conversation_id": conversation_id},
+            {"created_at": 1},
+        )
+        if not anchor:
+            raise HTTPException(status_code=400, detail="Invalid before cursor")
+        query["created_at"] = {"$lte": anchor["created_at"]}
+        query["$or"] = [
+            {"created_at": {"$lt": anchor["created_at"]}},
+            {"_id": {"$lt": before}},
+        ]
+
+    cursor = db.messages.find(query).sort([("created_at", -1), ("_id", -1)]).limit(limit + 1)
+    messages = await cursor.to_list(length=limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return MessagePageResponse(
+        messages=[message_to_response(m) for m in messages],
+        has_more=has_more,
+    )
 
 
 @router.post("/start", response_model=ConversationResponse)
@@ -95,49 +175,33 @@ async def start_conversation(
     
     if existing:
         # Add message to existing conversation
-        message_id = generate_id()
-        message = {
-            "id": message_id,
-            "sender_id": sender_id,
-            "content": request.message,
-            "product_id": request.product_id,
-            "created_at": now,
-            "read": False,
-        }
-        
-        await db.conversations.update_one(
-            {"_id": existing["_id"]},
+        conv_id = existing["_id"]
+        await db.messages.insert_one(
+            new_message(conv_id, sender_id, request.message, request.product_id, now)
+        )
+        conv = await db.conversations.find_one_and_update(
+            {"_id": conv_id},
             {
-                "$push": {"messages": message},
                 "$set": {
                     "last_message": request.message,
                     "last_message_at": now,
                 },
-            }
+                "$inc": unread_increments(existing["participant_ids"], sender_id),
+            },
+            projection=CONVERSATION_LIST_PROJECTION,
+            return_document=ReturnDocument.AFTER,
         )
-        
-        conv = await db.conversations.find_one({"_id": existing["_id"]})
     else:
         # Create new conversation
         conv_id = generate_id()
-        message_id = generate_id()
         
         # Get product info if provided
         product_title = None
         if request.product_id:
-            product = await db.products.find_one({"_id": request.product_id})
+            product = await db.products.find_one({"_id": request.product_id}, {"title": 1})
             if product:
                 product_title = product.get("title")
         
-        message = {
-            "id": message_id,
-            "sender_id": sender_id,
-            "content": request.message,
-            "product_id": request.product_id,
-            "created_at": now,
-            "read": False,
-        }
-        
         conv = {
             "_id": conv_id,
             "participant_ids": [sender_id, recipient_id],
@@ -145,15 +209,18 @@ async def start_conversation(
                 sender_id: user.get("name") or user.get("username") or "User",
                 recipient_id: recipient.get("name") or recipient.get("username") or "User",
             },
-            "messages": [message],
             "last_message": request.message,
             "last_message_at": now,
             "product_id": request.product_id,
             "product_title": product_title,
             "created_at": now,
+            "unread_counts": {sender_id: 0, recipient_id: 1},
         }
         
         await db.conversations.insert_one(conv)
+        await db.messages.insert_one(
+            new_message(conv_id, sender_id, request.message, request.product_id, now)
+        )
     
     return ConversationResponse(
         id=conv["_id"],
@@ -177,7 +244,8 @@ async def get_conversations(user: dict = Depends(get_current_user)):
     
     user_id = user["_id"]
     cursor = db.conversations.find(
-        {"participant_ids": user_id}
+        {"participant_ids": user_id},
+        CONVERSATION_LIST_PROJECTION,
     ).sort("last_message_at", -1)
     
     conversations = await cursor.to_list(length=50)
@@ -198,60 +266,105 @@ async def get_conversations(user: dict = Depends(get_current_user)):
     ]
 
 
+@router.get("/unread")
+async def get_total_unread(user: dict = Depends(get_current_user)):
+    """Total unread messages across conversations, for the app badge"""
+    db = get_db()
+    if db is None:
+        return {"unread": 0}
+    
+    user_id = user["_id"]
+    field = f"unread_counts.{user_id}"
+    cursor = db.conversations.find(
+        {"participant_ids": user_id, field: {"$gt": 0}},
+        {"_id": 0, field: 1},
+    )
+    
+    total = 0
+    async for conv in cursor:
+        total += get_unread_count_for_user(conv, user_id)
+    return {"unread": total}
+
+
+async def get_participant_conversation(db, conversation_id: str, user_id: str) -> dict:
+    conv = await db.conversations.find_one(
+        {
+            "_id": conversation_id,
+            "participant_ids": user_id,
+        },
+        CONVERSATION_LIST_PROJECTION,
+    )
+    
+    if not conv:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conv
+
+
 @router.get("/{conversation_id}", response_model=ConversationDetailResponse)
 async def get_conversation(
     conversation_id: str,
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
     user: dict = Depends(get_current_user),
 ):
-    """Get conversation with messages and mark as read"""
+    """Get conversation with its latest messages and mark them as read"""
     db = get_db()
     if db is None:
         raise HTTPException(status_code=503, detail="Database unavailable")
     
     user_id = user["_id"]
-    
-    conv = await db.conversations.find_one({
-        "_id": conversation_id,
-        "participant_ids": user_id,
-    })
-    
-    if not conv:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    conv = await get_participant_conversation(db, conversation_id, user_id)
     
     # Mark messages from OTHER users as read
-    await db.conversations.update_one(
-        {"_id": conversation_id},
+    result = await db.messages.update_many(
         {
-            "$set": {"messages.$[elem].read": True}
+            "conversation_id": conversation_id,
+            "read": False,
+            "sender_id": {"$ne": user_id},
         },
-        array_filters=[{"elem.sender_id": {"$ne": user_id}}]
+        {"$set": {"read": True}},
     )
-    
-    # Get updated conversation
-    conv = await db.conversations.find_one({"_id": conversation_id})
-    
-    messages = [
-        MessageResponse(
-            id=m["id"],
-            sender_id=m["sender_id"],
-            content=m["content"],
-            product_id=m.get("product_id"),
-            created_at=m["created_at"],
-            read=m.get("read", False),
+    # Decrement by what was actually marked: resetting to 0 would drop the
+    # increment of a message sent between the two writes
+    if result.modified_count:
+        await db.conversations.update_one(
+            {"_id": conversation_id},
+            {"$inc": {f"unread_counts.{user_id}": -result.modified_count}},
         )
-        for m in conv.get("messages", [])
-    ]
+    
+    page = await get_message_page(db, conversation_id, None, limit)
     
     return ConversationDetailResponse(
         id=conv["_id"],
         participant_ids=conv["participant_ids"],
         participant_names=conv.get("participant_names", {}),
-        messages=messages,
+        messages=page.messages,
+        has_more=page.has_more,
         product_id=conv.get("product_id"),
         product_title=conv.get("product_title"),
     )
 
 
+@router.get("/{conversation_id}/messages", response_model=MessagePageResponse)
+async def get_messages(
+    conversation_id: str,
+    before: Optional[str] = None,
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+    user: dict = Depends(get_current_user),
+):
+    """
+    Page of older messages.
+
+    `before` is the id of the oldest message the client already has;
+    without it the newest page is returned.
+    """
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    
+    await get_participant_conversation(db, conversation_id, user["_id"])
+    return await get_message_page(db, conversation_id, before, limit)
+
+
 @router.post("/{conversation_id}/messages", response_model=MessageResponse)
 async def send_message(
     conversation_id: str,
@@ -264,43 +377,21 @@ async def send_message(
         raise HTTPException(status_code=503, detail="Database unavailable")
     
     user_id = user["_id"]
-    
-    conv = await db.conversations.find_one({
-        "_id": conversation_id,
-        "participant_ids": user_id,
-    })
-    
-    if not conv:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    conv = await get_participant_conversation(db, conversation_id, user_id)
     
     now = datetime.utcnow()
-    message_id = generate_id()
-    
-    message = {
-        "id": message_id,
-        "sender_id": user_id,
-        "content": request.content,
-        "product_id": request.product_id,
-        "created_at": now,
-        "read": False,
-    }
+    message = new_message(conversation_id, user_id, request.content, request.product_id, now)
     
+    await db.messages.insert_one(message)
     await db.conversations.update_one(
         {"_id": conversation_id},
         {
-            "$push": {"messages": message},
             "$set": {
                 "last_message": request.content,
                 "last_message_at": now,
             },
+            "$inc": unread_increments(conv["participant_ids"], user_id),
         }
     )
     
-    return MessageResponse(
-        id=message_id,
-        sender_id=user_id,
-        content=request.content,
-        product_id=request.product_id,
-        created_at=now,
-        read=False,
-    )
+    return message_to_response(message)
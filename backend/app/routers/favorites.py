@@ -40,12 +40,17 @@ async def get_favorites(user: dict = Depends(get_current_user)):
         return FavoriteListResponse(favorites=[], total=0)
     
     # Get user's favorites
-    cursor = db.favorites.find({"user_id": user["_id"]}).sort("created_at", -1)
+    cursor = db.favorites.find(
+        {"user_id": user["_id"]}, {"product_id": 1}
+    ).sort("created_at", -1)
     favorites = await cursor.to_list(length=100)
     
-    # Get product details
+    # Get product details (only the fields the card shows)
     product_ids = [f["product_id"] for f in favorites]
-    products = await db.products.find({"_id": {"$in": product_ids}}).to_list(length=100)
+    products = await db.products.find(
+        {"_id": {"$in": product_ids}},
+        {"title": 1, "price": 1, "images": 1, "region": 1},
+    ).to_list(length=100)
     products_map = {p["_id"]: p for p in products}
     
     result = []
@@ -2,10 +2,19 @@ from fastapi import APIRouter, HTTPException, Query, Depends
 from pydantic import BaseModel
 from typing import Optional, List
 from datetime import datetime
+import base64
+import binascii
+import json
 
-from app.db.database import get_db
+from app.db.database import (
+    get_db,
+    count_documents_cached,
+    find_page,
+    text_search_query,
+)
 from app.db.models import generate_id
 from app.middleware.auth import get_current_user, get_current_seller
+from app.services.view_counter import view_counter
 
 router = APIRouter()
 
@@ -52,6 +61,41 @@ class ProductListResponse(BaseModel):
     total: int
     page: int
     pages: int
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(product: dict) -> str:
+    """Opaque token pointing after the given product in (created_at, _id) order."""
+    created_at = product.get("created_at")
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    raw = json.dumps([created_at, product["_id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        created_at, product_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(product_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_after(created_at: datetime, product_id: str) -> dict:
+    """
+    Filter for products after the cursor in (created_at desc, _id desc) order.
+
+    The $lte bound lets both backends seek through the
+    (status, ..., created_at, _id) index instead of skipping rows.
+    """
+    return {
+        "created_at": {"$lte": created_at},
+        "$or": [
+            {"created_at": {"$lt": created_at}},
+            {"_id": {"$lt": product_id}},
+        ],
+    }
 
 
 def product_to_response(product: dict) -> ProductResponse:
@@ -83,6 +127,7 @@ async def get_products(
     search: Optional[str] = None,
     page: int = Query(1, ge=1),
     limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
 ):
     db = get_db()
     
@@ -101,25 +146,38 @@ async def get_products(
         query["price"] = {"$gte": min_price}
     if max_price is not None:
         query.setdefault("price", {})["$lte"] = max_price
+    
+    sort = [("created_at", -1), ("_id", -1)]
     if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-        ]
+        if cursor:
+            raise HTTPException(status_code=400, detail="Cursor is not supported with search")
+        # Полнотекстовый поиск: результаты сначала по релевантности
+        text_filter, text_sort = text_search_query(search, ["title", "description"])
+        query.update(text_filter)
+        sort = text_sort + sort
     
-    # Count total
-    total = await db.products.count_documents(query)
+    if cursor:
+        # Keyset pagination: seek past the last seen product, no skip
+        page_query = {**query, "$and": [keyset_after(*decode_cursor(cursor))]}
+        products = await db.products.find(page_query).sort(sort).limit(limit).to_list(length=limit)
+        total = await count_documents_cached(db.products, query)
+    else:
+        # Page and total in one query
+        skip = (page - 1) * limit
+        products, total = await find_page(
+            db.products, query, sort, skip, limit, cache_total=True
+        )
     
-    # Get products
-    skip = (page - 1) * limit
-    cursor = db.products.find(query).sort("created_at", -1).skip(skip).limit(limit)
-    products = await cursor.to_list(length=limit)
+    next_cursor = None
+    if not search and len(products) == limit:
+        next_cursor = encode_cursor(products[-1])
     
     return ProductListResponse(
         products=[product_to_response(p) for p in products],
         total=total,
         page=page,
         pages=(total + limit - 1) // limit if total > 0 else 1,
+        next_cursor=next_cursor,
     )
 
 
@@ -149,9 +207,8 @@ async def get_product(product_id: str):
     if not product:
         raise HTTPException(status_code=404, detail="Товар не найден")
     
-    # Increment views
-    await db.products.update_one({"_id": product_id}, {"$inc": {"views": 1}})
-    product["views"] = product.get("views", 0) + 1
+    # Просмотры пишутся в базу пачками; в ответе учитываем ещё не записанные
+    product["views"] = product.get("views", 0) + view_counter.record(product_id)
     
     return product_to_response(product)
 
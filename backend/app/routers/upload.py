@@ -2,8 +2,8 @@ from fastapi import APIRouter, HTTPException, UploadFile, File
 from typing import List
 import uuid
 from pathlib import Path
-from PIL import Image
-import io
+
+from app.services.image_service import MAX_FILE_SIZE, ImageError, compress_image_async
 
 router = APIRouter()
 
@@ -11,33 +11,8 @@ router = APIRouter()
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-# Максимальный размер файла (10 MB)
-MAX_FILE_SIZE = 10 * 1024 * 1024
 ALLOWED_TYPES = ["image/jpeg", "image/png", "image/webp"]
 
-# Настройки сжатия
-MAX_WIDTH = 1200
-MAX_HEIGHT = 1200
-JPEG_QUALITY = 85
-
-
-def compress_image(content: bytes) -> bytes:
-    """Сжать изображение до оптимального размера"""
-    img = Image.open(io.BytesIO(content))
-    
-    # Конвертируем RGBA в RGB если нужно
-    if img.mode in ('RGBA', 'P'):
-        img = img.convert('RGB')
-    
-    # Изменяем размер если слишком большое
-    if img.width > MAX_WIDTH or img.height > MAX_HEIGHT:
-        img.thumbnail((MAX_WIDTH, MAX_HEIGHT), Image.Resampling.LANCZOS)
-    
-    # Сохраняем в JPEG с оптимальным качеством
-    output = io.BytesIO()
-    img.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
-    return output.getvalue()
-
 
 @router.post("/image")
 async def upload_image(image: UploadFile = File(...)):
@@ -57,8 +32,11 @@ async def upload_image(image: UploadFile = File(...)):
             detail=f"Файл слишком большой. Максимум: {MAX_FILE_SIZE // (1024*1024)} MB"
         )
     
-    # Сжимаем изображение
-    compressed = compress_image(content)
+    # Сжимаем изображение (в пуле потоков, см. image_service)
+    try:
+        compressed = await compress_image_async(content)
+    except ImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Генерируем уникальное имя файла (всегда .jpg после сжатия)
     file_id = str(uuid.uuid4())
@@ -91,7 +69,10 @@ async def upload_images(images: List[UploadFile] = File(...)):
             continue
         
         # Сжимаем изображение
-        compressed = compress_image(content)
+        try:
+            compressed = await compress_image_async(content)
+        except ImageError:
+            continue
         
         file_id = str(uuid.uuid4())
         filename = f"{file_id}.jpg"
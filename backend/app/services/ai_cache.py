@@ -0,0 +1,194 @@
+"""
+Кэш ответов ИИ на повторяющиеся вопросы.
+
+Ключ — sha256 от модели, системного промпта и нормализованного вопроса
+(регистр, апострофы ʻ ’ `, пунктуация и пробелы не различаются), так что
+"Barglar nega sarg'ayyapti?" и "barglar nega sargʻayyapti" дают одну
+запись. Ответ на вопрос с историей зависит от контекста, поэтому такие
+запросы по умолчанию идут мимо кэша; с ai_cache_with_history в ключ
+добавляется отпечаток последних ai_cache_history_turns сообщений.
+
+Два уровня: LRU+TTL в памяти процесса и, если включено
+ai_cache_persistent, коллекция ai_cache — записи переживают перезапуск
+и общие для воркеров. В MongoDB просроченные записи удаляет TTL-индекс
+по expires_at, в SQLite — purge_expired() при старте и периодически при
+записи. Ошибки базы не ломают ответ: кэш просто промахивается.
+
+В кэш попадают только ответы провайдера, запасные ответы — нет.
+"""
+
+import hashlib
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from typing import Optional
+
+from app.cache import TTLCache
+from app.config import get_settings
+from app.db.database import get_db
+
+settings = get_settings()
+
+_APOSTROPHES = str.maketrans({c: "'" for c in "ʻʼ‘’`´"})
+_PUNCTUATION = re.compile(r"[^\w\s']+")
+
+# Раз в столько записей из коллекции удаляются просроченные ответы
+PURGE_EVERY = 100
+
+
+def normalize_message(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).translate(_APOSTROPHES).lower()
+    return " ".join(_PUNCTUATION.sub(" ", text).split())
+
+
+def history_fingerprint(history: Optional[list], turns: int) -> str:
+    """Отпечаток последних turns сообщений истории; "" — если истории нет."""
+    if not history or turns <= 0:
+        return ""
+    digest = hashlib.sha256()
+    for msg in history[-turns:]:
+        digest.update(f"{msg.get('role', 'user')}:{normalize_message(msg.get('content', ''))}\n".encode())
+    return digest.hexdigest()
+
+
+class AIResponseCache:
+    """Двухуровневый кэш ответов: память процесса и коллекция ai_cache."""
+
+    def __init__(
+        self,
+        ttl: float = 86400.0,
+        maxsize: int = 2000,
+        persistent: bool = True,
+        with_history: bool = False,
+        history_turns: int = 2,
+    ):
+        self.ttl = ttl
+        self.persistent = persistent
+        self.with_history = with_history
+        self.history_turns = history_turns
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        self.stores = 0
+        self.bypassed = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def key(self, message: str, history: Optional[list], model: str, prompt: str = "") -> Optional[str]:
+        """Ключ запроса; None — запрос мимо кэша."""
+        if not self.enabled:
+            return None
+        normalized = normalize_message(message)
+        if not normalized or (history and not self.with_history):
+            self.bypassed += 1
+            return None
+        fingerprint = history_fingerprint(history, self.history_turns)
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        raw = f"{model}\n{prompt_hash}\n{fingerprint}\n{normalized}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get(self, key: Optional[str]) -> Optional[str]:
+        """Текст закэшированного ответа или None."""
+        if key is None:
+            return None
+        text = self._memory.get(key)
+        if text is not None:
+            return text
+
+        db = get_db() if self.persistent else None
+        if db is None:
+            return None
+        try:
+            doc = await db.ai_cache.find_one(
+                {"_id": key, "expires_at": {"$gt": datetime.utcnow()}},
+                {"text": 1, "expires_at": 1},
+            )
+        except Exception as e:
+            self._error("read", e)
+            return None
+        if doc is None:
+            self.persistent_misses += 1
+            return None
+
+        self.persistent_hits += 1
+        ttl = (doc["expires_at"] - datetime.utcnow()).total_seconds()
+        self._memory.set(key, doc["text"], ttl=min(self.ttl, ttl))
+        return doc["text"]
+
+    async def set(self, key: Optional[str], text: str, model: str = ""):
+        if key is None or not text:
+            return
+        self._memory.set(key, text)
+        self.stores += 1
+
+        db = get_db() if self.persistent else None
+        if db is None:
+            return
+        now = datetime.utcnow()
+        try:
+            await db.ai_cache.update_one(
+                {"_id": key},
+                {"$set": {
+                    "text": text,
+                    "model": model,
+                    "created_at": now,
+                    "expires_at": now + timedelta(seconds=self.ttl),
+                }},
+                upsert=True,
+            )
+        except Exception as e:
+            self._error("write", e)
+            return
+        if self.stores % PURGE_EVERY == 0:
+            await self.purge_expired()
+
+    async def purge_expired(self) -> int:
+        """Удалить просроченные ответы из коллекции (для SQLite; в MongoDB — TTL-индекс)."""
+        db = get_db() if self.persistent else None
+        if db is None:
+            return 0
+        try:
+            result = await db.ai_cache.delete_many({"expires_at": {"$lte": datetime.utcnow()}})
+        except Exception as e:
+            self._error("purge", e)
+            return 0
+        return result.deleted_count
+
+    def clear(self):
+        self._memory.clear()
+
+    def _error(self, operation: str, e: Exception):
+        self.errors += 1
+        print(f"[WARNING] AI cache {operation} failed: {type(e).__name__}: {str(e)[:100]}")
+
+    def stats(self) -> dict:
+        memory = self._memory.stats()
+        hits = memory["hits"] + self.persistent_hits
+        # Промах памяти, попавший в коллекцию, — не промах
+        lookups = memory["hits"] + memory["misses"]
+        return {
+            "enabled": self.enabled,
+            "persistent": self.persistent,
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory": memory,
+            "persistent_hits": self.persistent_hits,
+            "persistent_misses": self.persistent_misses,
+            "stores": self.stores,
+            "bypassed": self.bypassed,
+            "errors": self.errors,
+        }
+
+
+ai_cache = AIResponseCache(
+    ttl=settings.ai_cache_ttl,
+    maxsize=settings.ai_cache_size,
+    persistent=settings.ai_cache_persistent,
+    with_history=settings.ai_cache_with_history,
+    history_turns=settings.ai_cache_history_turns,
+)
@@ -1,9 +1,14 @@
-from typing import Optional
+from typing import AsyncIterator, Optional
 import base64
+import json
+
 import httpx
 
 from app.config import get_settings
 from app.models.chat import Diagnosis
+from app.services.ai_cache import ai_cache
+from app.services.context_builder import ContextBuilder
+from app.services.http_client import get_http_client, timeout
 
 settings = get_settings()
 
@@ -133,6 +138,12 @@ FAQAT foydalanuvchi tilida javob bering.
 """
 
 
+# Промпт для краткого содержания старой части разговора
+SUMMARY_PROMPT = """Ты сжимаешь историю разговора фермера с ИИ-агрономом Dehqonjon.
+Перескажи кратко на языке разговора: о каких растениях, проблемах и условиях
+шла речь, какие советы уже даны и что осталось невыясненным. Только факты
+из разговора, без приветствий и без новых советов. Не больше 120 слов."""
+
 
 class AIService:
     """Сервис для работы с Groq AI API"""
@@ -143,125 +154,292 @@ class AIService:
         self.text_model = settings.text_ai_model
         self.vision_model = settings.vision_ai_model
         self.api_url = "https://api.groq.com/openai/v1/chat/completions"
+        self.context = ContextBuilder(
+            summarize=self._summarize,
+            budget=settings.ai_history_token_budget,
+            cache_size=settings.ai_summary_cache_size,
+        )
 
     async def get_response(
         self,
         message: str,
-        conversation_id: str,
+        conversation_id: Optional[str] = None,
         image_url: Optional[str] = None,
         history: Optional[list] = None,
     ) -> dict:
-        """Получить ответ от ИИ"""
+        """
+        Получить ответ от ИИ.
+        
+        conversation_id — id сохранённой сессии: по нему кэшируется краткое
+        содержание длинной истории. Без него история просто обрезается.
+        Если API недоступен, возвращается запасной ответ с "fallback": True.
+        """
+        
+        # Повторный вопрос отдаётся из кэша без запроса к API
+        cache_key = self._cache_key(message, history)
+        cached = await ai_cache.get(cache_key)
+        if cached is not None:
+            return {
+                "text": cached,
+                "suggestions": self._generate_suggestions(message, cached),
+            }
         
         try:
-            # Формируем сообщения с историей
-            messages = [{"role": "system", "content": TEXT_SYSTEM_PROMPT}]
-            
-            # Добавляем историю (до 100 сообщений, потом начинаем забывать старые)
-            if history:
-                # Если больше 100 сообщений - берём последние 100
-                history_to_use = history[-100:] if len(history) > 100 else history
-                for msg in history_to_use:
-                    messages.append({
-                        "role": msg.get("role", "user"),
-                        "content": msg.get("content", "")
-                    })
+            messages = self._build_messages(message, history, conversation_id)
             
-            # Добавляем текущее сообщение
-            messages.append({"role": "user", "content": message})
+            # Общий клиент из lifespan: соединение с API уже открыто
+            response = await get_http_client().post(
+                self.api_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "model": self.text_model,
+                    "messages": messages,
+                    "max_tokens": 1024,
+                    "temperature": 0.7,
+                },
+                timeout=timeout(settings.ai_text_timeout),
+            )
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    self.api_url,
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": self.text_model,
-                        "messages": messages,
-                        "max_tokens": 1024,
-                        "temperature": 0.7,
-                    },
-                )
+            if response.status_code == 200:
+                data = response.json()
+                ai_text = data["choices"][0]["message"]["content"]
+                await ai_cache.set(cache_key, ai_text, model=self.text_model)
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    ai_text = data["choices"][0]["message"]["content"]
-                    
-                    return {
-                        "text": ai_text,
-                        "suggestions": self._generate_suggestions(message, ai_text),
-                    }
-                else:
-                    print(f"Groq API error: {response.status_code} - {response.text}")
-                    return self._get_fallback_response(message)
+                return {
+                    "text": ai_text,
+                    "suggestions": self._generate_suggestions(message, ai_text),
+                }
+            else:
+                print(f"Groq API error: {response.status_code} - {response.text}")
+                return {**self._get_fallback_response(message), "fallback": True}
                     
         except Exception as e:
             print(f"AI Service error: {type(e).__name__}: {e}")
-            return self._get_fallback_response(message)
+            return {**self._get_fallback_response(message), "fallback": True}
+    
+    async def stream_response(
+        self,
+        message: str,
+        conversation_id: Optional[str] = None,
+        history: Optional[list] = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Потоковый ответ ИИ (stream=true у Groq).
+        
+        Отдаёт {"type": "token", "text": ...} по мере генерации, последним —
+        {"type": "done", "text": полный ответ, "suggestions": [...]}.
+        Если API недоступен до первого токена, запасной ответ приходит одним
+        токеном, а в "done" добавляется "fallback": True. Если поток
+        оборвался после первых токенов, последним приходит
+        {"type": "error", "text": полученная часть, "detail": ...} вместо
+        "done". Закрытие генератора (клиент отключился) закрывает и
+        соединение с API — генерация у провайдера прерывается.
+        Ответ из кэша приходит одним токеном. conversation_id — как в
+        get_response().
+        """
+        cache_key = self._cache_key(message, history)
+        cached = await ai_cache.get(cache_key)
+        if cached is not None:
+            yield {"type": "token", "text": cached}
+            yield {
+                "type": "done",
+                "text": cached,
+                "suggestions": self._generate_suggestions(message, cached),
+            }
+            return
+        
+        parts = []
+        complete = False
+        try:
+            async with get_http_client().stream(
+                "POST",
+                self.api_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "model": self.text_model,
+                    "messages": self._build_messages(message, history, conversation_id),
+                    "max_tokens": 1024,
+                    "temperature": 0.7,
+                    "stream": True,
+                },
+                timeout=timeout(settings.ai_text_timeout),
+            ) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    print(f"Groq API error: {response.status_code} - {body[:200]!r}")
+                else:
+                    async for line in response.aiter_lines():
+                        # Формат SSE: "data: {...}", конец потока — "data: [DONE]"
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            complete = True
+                            break
+                        choices = json.loads(data).get("choices") or [{}]
+                        text = (choices[0].get("delta") or {}).get("content")
+                        if text:
+                            parts.append(text)
+                            yield {"type": "token", "text": text}
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"AI Service stream error: {type(e).__name__}: {e}")
+        
+        if not parts:
+            fallback = self._get_fallback_response(message)
+            yield {"type": "token", "text": fallback["text"]}
+            yield {
+                "type": "done",
+                "text": fallback["text"],
+                "suggestions": fallback["suggestions"],
+                "fallback": True,
+            }
+            return
+        
+        ai_text = "".join(parts)
+        # Оборванный на середине ответ не кэшируется и не считается готовым
+        if not complete:
+            yield {
+                "type": "error",
+                "text": ai_text,
+                "detail": "Ответ ИИ прервался. Попробуйте ещё раз.",
+            }
+            return
+        await ai_cache.set(cache_key, ai_text, model=self.text_model)
+        yield {
+            "type": "done",
+            "text": ai_text,
+            "suggestions": self._generate_suggestions(message, ai_text),
+        }
+    
+    def _cache_key(self, message: str, history: Optional[list] = None) -> Optional[str]:
+        return ai_cache.key(message, history, self.text_model, TEXT_SYSTEM_PROMPT)
+    
+    def _build_messages(
+        self,
+        message: str,
+        history: Optional[list] = None,
+        conversation_id: Optional[str] = None,
+    ) -> list:
+        """Сообщения для API: системный промпт, история в пределах бюджета и текущее сообщение"""
+        messages = [{"role": "system", "content": TEXT_SYSTEM_PROMPT}]
+        
+        # Старая часть истории — кратким содержанием, последние сообщения — как есть
+        summary, recent = self.context.build(history, conversation_id)
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": f"Suhbatning oldingi qismi / Ранее в разговоре:\n{summary}",
+            })
+        messages.extend(recent)
+        
+        # Добавляем текущее сообщение
+        messages.append({"role": "user", "content": message})
+        return messages
+    
+    async def _summarize(self, previous: Optional[str], turns: list) -> Optional[str]:
+        """Краткое содержание: предыдущее содержание, дополненное новыми сообщениями"""
+        lines = []
+        if previous:
+            lines.append(f"Краткое содержание до этого:\n{previous}\n")
+        for msg in turns:
+            role = "Фермер" if msg["role"] == "user" else "Dehqonjon"
+            lines.append(f"{role}: {msg['content']}")
+        
+        response = await get_http_client().post(
+            self.api_url,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            },
+            json={
+                "model": self.text_model,
+                "messages": [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": "\n".join(lines)},
+                ],
+                "max_tokens": settings.ai_summary_max_tokens,
+                "temperature": 0.3,
+            },
+            timeout=timeout(settings.ai_text_timeout),
+        )
+        if response.status_code != 200:
+            print(f"Groq API error (summary): {response.status_code} - {response.text[:200]}")
+            return None
+        return response.json()["choices"][0]["message"]["content"].strip() or None
     
     async def analyze_image(
         self,
         image_data: bytes,
         conversation_id: str,
         user_message: str = "",
+        mime_type: str = "image/jpeg",
     ) -> dict:
-        """Анализ изображения растения"""
+        """
+        Анализ изображения растения.
+        
+        image_data должен быть уже подготовлен (app/services/image_service.py):
+        уменьшен и с MIME-типом по содержимому.
+        """
         
         # Конвертируем изображение в base64
         image_base64 = base64.b64encode(image_data).decode("utf-8")
         
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    self.api_url,
-                    headers={
-                        "Authorization": f"Bearer {self.vision_api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": self.vision_model,
-                        "messages": [
-                            {"role": "system", "content": VISION_SYSTEM_PROMPT},
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{image_base64}"
-                                        },
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": user_message or "Что с этим растением? Помоги определить проблему."
+            response = await get_http_client().post(
+                self.api_url,
+                headers={
+                    "Authorization": f"Bearer {self.vision_api_key}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "model": self.vision_model,
+                    "messages": [
+                        {"role": "system", "content": VISION_SYSTEM_PROMPT},
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": f"data:{mime_type};base64,{image_base64}"
                                     },
-                                ],
-                            },
-                        ],
-                        "max_tokens": 1024,
-                        "temperature": 0.5,
-                    },
-                )
+                                },
+                                {
+                                    "type": "text",
+                                    "text": user_message or "Что с этим растением? Помоги определить проблему."
+                                },
+                            ],
+                        },
+                    ],
+                    "max_tokens": 1024,
+                    "temperature": 0.5,
+                },
+                timeout=timeout(settings.ai_vision_timeout),
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                ai_text = data["choices"][0]["message"]["content"]
+                
+                # Парсим диагноз из ответа
+                diagnosis = self._parse_diagnosis(ai_text)
+                
+                return {
+                    "text": ai_text,
+                    "diagnosis": diagnosis,
+                    "recommendations": self._extract_recommendations(ai_text),
+                    "confidence": 0.75,
+                }
+            else:
+                print(f"Groq Vision API error: {response.status_code} - {response.text}")
+                return self._get_fallback_image_response()
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    ai_text = data["choices"][0]["message"]["content"]
-                    
-                    # Парсим диагноз из ответа
-                    diagnosis = self._parse_diagnosis(ai_text)
-                    
-                    return {
-                        "text": ai_text,
-                        "diagnosis": diagnosis,
-                        "recommendations": self._extract_recommendations(ai_text),
-                        "confidence": 0.75,
-                    }
-                else:
-                    print(f"Groq Vision API error: {response.status_code} - {response.text}")
-                    return self._get_fallback_image_response()
-                    
         except Exception as e:
             print(f"Vision AI Service error: {e}")
             return self._get_fallback_image_response()
@@ -2,14 +2,26 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import jwt, JWTError
 import bcrypt
+import hashlib
 import random
 import string
+import time
+from app.cache import TTLCache
 from app.config import get_settings
-from app.db.database import get_db
+from app.db.database import get_db, text_search_query
 from app.db.models import UserInDB, UserRole, generate_id
 
 settings = get_settings()
 
+# Users resolved by the auth middleware, keyed by id. Per process: changes
+# made through another worker become visible after user_cache_ttl
+_user_cache = TTLCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl)
+
+# Payloads of verified tokens keyed by sha256 of the token. Entries never
+# outlive the token's exp. Settings are read once per process, so a new
+# secret takes effect on restart, together with an empty cache
+_token_cache = TTLCache(maxsize=settings.token_cache_size, ttl=settings.token_cache_ttl)
+
 
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -37,7 +49,8 @@ def create_access_token(user_id: str, role: str) -> str:
     return jwt.encode(payload, settings.jwt_secret, algorithm=settings.jwt_algorithm)
 
 
-def decode_token(token: str) -> Optional[dict]:
+def verify_token(token: str) -> Optional[dict]:
+    """Full jose verification, without the cache"""
     try:
         payload = jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
         return payload
@@ -45,6 +58,31 @@ def decode_token(token: str) -> Optional[dict]:
         return None
 
 
+def decode_token(token: str) -> Optional[dict]:
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = _token_cache.get(digest)
+    if payload is None:
+        payload = verify_token(token)
+        if payload is None:
+            # Invalid tokens are not cached
+            return None
+        ttl = _token_cache.ttl
+        exp = payload.get("exp")
+        if isinstance(exp, (int, float)):
+            ttl = min(ttl, exp - time.time())
+        if ttl > 0:
+            _token_cache.set(digest, payload, ttl=ttl)
+    return dict(payload)
+
+
+def clear_token_cache():
+    _token_cache.clear()
+
+
+def token_cache_stats() -> dict:
+    return _token_cache.stats()
+
+
 async def get_user_by_phone(phone: str) -> Optional[dict]:
     db = get_db()
     if db is None:
@@ -61,6 +99,27 @@ async def get_user_by_id(user_id: str) -> Optional[dict]:
     return user
 
 
+async def get_cached_user(user_id: str) -> Optional[dict]:
+    """get_user_by_id() through the in-process user cache"""
+    user = _user_cache.get(user_id)
+    if user is None:
+        user = await get_user_by_id(user_id)
+        if user is None:
+            return None
+        _user_cache.set(user_id, user)
+    # Callers may modify the returned dict; keep the cached one intact
+    return dict(user)
+
+
+def invalidate_user(user_id: str):
+    """Drop a user from the cache after the document was changed"""
+    _user_cache.pop(user_id)
+
+
+def user_cache_stats() -> dict:
+    return _user_cache.stats()
+
+
 async def get_user_by_username(username: str) -> Optional[dict]:
     db = get_db()
     if db is None:
@@ -75,13 +134,12 @@ async def search_users(query: str, limit: int = 20) -> list:
     if db is None:
         return []
     
-    # Search by username or name (case-insensitive)
-    cursor = db.users.find({
-        "$or": [
-            {"username": {"$regex": query, "$options": "i"}},
-            {"name": {"$regex": query, "$options": "i"}}
-        ]
-    }).limit(limit)
+    # Full-text search by username or name, best matches first
+    text_filter, text_sort = text_search_query(query, ["username", "name"])
+    cursor = db.users.find(text_filter, {"password_hash": 0})
+    if text_sort:
+        cursor = cursor.sort(text_sort)
+    cursor = cursor.limit(limit)
     
     users = await cursor.to_list(length=limit)
     return users
@@ -147,4 +205,5 @@ async def upgrade_to_seller(user_id: str, seller_name: str, region: str, seller_
             }
         }
     )
+    invalidate_user(user_id)
     return await get_user_by_id(user_id)
@@ -0,0 +1,121 @@
+"""
+История сессий ИИ-чата на стороне сервера.
+
+POST /api/chat/message с session_id не требует от клиента присылать
+историю: последние chat_history_limit сообщений сессии читаются из
+chat_sessions (проекция $slice) и держатся в LRU+TTL-кэше процесса.
+После ответа обе реплики — вопрос и ответ — дописываются в сессию одним
+$push с $each, и тот же список дополняется в кэше.
+
+Кэш не синхронизируется между воркерами: если сессию изменил другой
+процесс, запись в кэше устареет не дольше чем на chat_history_cache_ttl
+секунд. Изменения через этот процесс (add_message_to_session, удаление
+сессии) сбрасывают запись через invalidate().
+"""
+
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+from app.cache import TTLCache
+from app.config import get_settings
+from app.db.database import get_db
+from app.db.models import generate_id
+
+settings = get_settings()
+
+
+class CachedHistory(NamedTuple):
+    user_id: str
+    messages: List[dict]  # [{"id": ..., "role": ..., "content": ...}], старые первыми
+
+
+def session_title(content: str) -> str:
+    """Название сессии по первому сообщению пользователя"""
+    return content[:30] + ("..." if len(content) > 30 else "")
+
+
+def new_session_message(role: str, content: str, image_url: Optional[str] = None) -> dict:
+    return {
+        "id": generate_id(),
+        "role": role,
+        "content": content,
+        "image_url": image_url,
+        "created_at": datetime.utcnow().isoformat(),
+    }
+
+
+class ChatHistoryStore:
+    """Последние сообщения сессий: кэш в памяти поверх chat_sessions."""
+
+    def __init__(self, limit: int = 100, maxsize: int = 1000, ttl: float = 600.0):
+        self.limit = limit
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def load(self, session_id: str, user_id: str) -> Optional[List[dict]]:
+        """История сессии пользователя; None — сессии нет или она чужая."""
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            return list(cached.messages) if cached.user_id == user_id else None
+
+        db = get_db()
+        if db is None:
+            return None
+        session = await db.chat_sessions.find_one(
+            {"_id": session_id, "user_id": user_id},
+            {"user_id": 1, "messages": {"$slice": -self.limit}},
+        )
+        if session is None:
+            return None
+
+        # id нужен ContextBuilder: по нему ищется граница краткого содержания
+        messages = [
+            {"id": m.get("id"), "role": m.get("role", "user"), "content": m.get("content", "")}
+            for m in session.get("messages", [])
+        ]
+        self._cache.set(session_id, CachedHistory(user_id, messages))
+        return list(messages)
+
+    async def append(self, session_id: str, user_id: str, turns: List[dict], first: bool = False) -> bool:
+        """
+        Дописать реплики в сессию одним обновлением.
+
+        first — в сессии ещё не было сообщений: название берётся из
+        первой реплики пользователя. Возвращает False, если сессии нет.
+        """
+        db = get_db()
+        if db is None:
+            return False
+
+        update = {
+            "$push": {"messages": {"$each": turns}},
+            "$set": {"updated_at": datetime.utcnow().isoformat()},
+        }
+        first_user = next((t for t in turns if t["role"] == "user"), None)
+        if first and first_user is not None:
+            update["$set"]["title"] = session_title(first_user["content"])
+
+        result = await db.chat_sessions.update_one({"_id": session_id, "user_id": user_id}, update)
+        if result.matched_count == 0:
+            self.invalidate(session_id)
+            return False
+
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            messages = cached.messages + [
+                {"id": t["id"], "role": t["role"], "content": t["content"]} for t in turns
+            ]
+            self._cache.set(session_id, CachedHistory(user_id, messages[-self.limit:]))
+        return True
+
+    def invalidate(self, session_id: str):
+        self._cache.pop(session_id)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+chat_history = ChatHistoryStore(
+    limit=settings.chat_history_limit,
+    maxsize=settings.chat_history_cache_size,
+    ttl=settings.chat_history_cache_ttl,
+)
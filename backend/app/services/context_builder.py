@@ -0,0 +1,161 @@
+"""
+Контекст запроса к ИИ в пределах бюджета токенов.
+
+Из истории в запрос попадают последние сообщения, которые укладываются
+в ai_history_token_budget токенов (оценка — estimate_tokens()). Всё, что
+старше, сворачивается в краткое содержание разговора: оно идёт в запрос
+отдельным системным сообщением.
+
+Краткое содержание считается один раз и кэшируется по conversation_id
+вместе с id последнего покрытого сообщения. История приходит окном
+последних сообщений сессии (см. ChatHistoryStore) и сдвигается с каждым
+ходом, поэтому граница содержания ищется в окне по id, а не по номеру
+сообщения. Если граница уже ушла из окна, старое содержание всё равно
+идёт в запрос и дополняется сообщениями окна. conversation_id — id
+сохранённой сессии чата; без него, как и для сообщений без id, история
+только обрезается, а содержание не строится.
+
+Пересчёт идёт в фоне и не задерживает ответ: пока он не готов, запрос
+уходит со старым содержанием (или без него), а несколько сообщений между
+ним и окном последних временно выпадают. Чтобы не пересчитывать
+содержание на каждом ходу, новое покрывает историю так, что в окне
+остаётся половина бюджета — следующие ходы укладываются в него без
+пересчёта.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set
+
+from app.cache import TTLCache
+
+# Служебные токены на сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценка числа токенов без токенизатора.
+
+    Латиница — около 4 символов на токен, кириллица и прочее не-ASCII
+    дробится мельче — около 2 символов на токен.
+    """
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 1
+
+
+def message_tokens(msg: dict) -> int:
+    return estimate_tokens(msg.get("content", "")) + MESSAGE_OVERHEAD
+
+
+class Summary(NamedTuple):
+    last_id: str  # id последнего покрытого сообщения сессии
+    text: str
+
+
+# summarize(предыдущее содержание или None, сообщения) -> новое содержание
+Summarizer = Callable[[Optional[str], List[dict]], Awaitable[Optional[str]]]
+
+
+class ContextBuilder:
+    """Последние сообщения в пределах бюджета плюс краткое содержание старых."""
+
+    def __init__(
+        self,
+        summarize: Summarizer,
+        budget: int = 2000,
+        cache_size: int = 1000,
+        cache_ttl: float = 86400.0,
+    ):
+        self.summarize = summarize
+        self.budget = budget
+        self._summaries = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.trimmed = 0
+        self.summaries_built = 0
+        self.summary_errors = 0
+
+    def build(self, history: Optional[List[dict]], conversation_id: Optional[str]) -> tuple:
+        """
+        Разбить историю на (краткое содержание или None, последние сообщения).
+
+        history — сообщения сессии по порядку, с "id" у каждого. При
+        необходимости запускает фоновый пересчёт содержания.
+        """
+        ids = [msg.get("id") for msg in history or []]
+        history = [
+            {"role": msg.get("role", "user"), "content": msg.get("content", "")}
+            for msg in history or []
+        ]
+        start = self._window_start(history, self.budget)
+        if start == 0:
+            return None, history
+
+        self.trimmed += 1
+        summary = self._summaries.get(conversation_id) if conversation_id else None
+        covered = self._covered(summary, ids)
+        if summary is not None and covered >= start:
+            return summary.text, history[covered:]
+
+        # Содержание отстало от окна: пересчитать с запасом на следующие ходы
+        target = self._window_start(history, self.budget // 2)
+        if conversation_id and ids[target - 1]:
+            self._schedule(conversation_id, history[covered:target], ids[target - 1], summary)
+        return (summary.text if summary else None), history[start:]
+
+    def _window_start(self, history: List[dict], budget: int) -> int:
+        """Индекс первого сообщения окна последних, укладывающихся в budget."""
+        used = 0
+        for i in range(len(history) - 1, -1, -1):
+            used += message_tokens(history[i])
+            if used > budget:
+                return i + 1
+        return 0
+
+    def _covered(self, summary: Optional[Summary], ids: List[Optional[str]]) -> int:
+        """Сколько первых сообщений окна покрыто содержанием; 0 — граница не в окне."""
+        if summary is None:
+            return 0
+        try:
+            return ids.index(summary.last_id) + 1
+        except ValueError:
+            return 0
+
+    def _schedule(self, conversation_id: str, new: List[dict], last_id: str, previous: Optional[Summary]):
+        if conversation_id in self._pending:
+            return
+        task = asyncio.create_task(self._rebuild(conversation_id, new, last_id, previous))
+        self._pending[conversation_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _rebuild(self, conversation_id: str, new: List[dict], last_id: str, previous: Optional[Summary]):
+        try:
+            # Старое содержание дополняется только новыми сообщениями
+            text = await self.summarize(previous.text if previous else None, new)
+            if text:
+                self._summaries.set(conversation_id, Summary(last_id, text))
+                self.summaries_built += 1
+            else:
+                self.summary_errors += 1
+        except Exception as e:
+            self.summary_errors += 1
+            print(f"[WARNING] Conversation summary failed: {type(e).__name__}: {str(e)[:100]}")
+        finally:
+            self._pending.pop(conversation_id, None)
+
+    async def wait(self):
+        """Дождаться фоновых пересчётов (скрипты, проверки)."""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.budget,
+            "trimmed": self.trimmed,
+            "summaries_built": self.summaries_built,
+            "summary_errors": self.summary_errors,
+            "pending": len(self._pending),
+            "cache": self._summaries.stats(),
+        }
@@ -0,0 +1,94 @@
+"""
+Общий HTTP-клиент приложения для внешних API (Groq).
+
+Один httpx.AsyncClient на процесс: соединения держатся keep-alive и
+переиспользуются, так что запрос к ИИ не платит каждый раз за DNS, TCP
+и TLS. Клиент открывается в lifespan (start_http_client) и закрывается
+при остановке (close_http_client). HTTP/2 включается, если установлен
+пакет h2 (httpx[http2]); без него — HTTP/1.1 с тем же пулом.
+
+Таймауты задаются на операцию: timeout(settings.ai_text_timeout) и т.п.
+"""
+
+import asyncio
+from typing import Optional
+
+import httpx
+
+from app.config import get_settings
+
+settings = get_settings()
+
+try:
+    import h2  # noqa: F401 — нужен httpx для HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover - зависит от окружения
+    HTTP2_AVAILABLE = False
+
+# Хост, соединение с которым открывается заранее при старте
+PREWARM_URL = "https://api.groq.com/"
+
+_client: Optional[httpx.AsyncClient] = None
+_prewarm_task: Optional[asyncio.Task] = None
+
+
+def timeout(read: float) -> httpx.Timeout:
+    """Таймаут операции: read/write/pool — read секунд, connect — из настроек."""
+    return httpx.Timeout(read, connect=settings.http_connect_timeout)
+
+
+def _create_client() -> httpx.AsyncClient:
+    http2 = settings.http2 and HTTP2_AVAILABLE
+    if settings.http2 and not HTTP2_AVAILABLE:
+        print("[WARNING] h2 is not installed, HTTP client uses HTTP/1.1")
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=settings.http_max_connections,
+            max_keepalive_connections=settings.http_max_keepalive_connections,
+            keepalive_expiry=settings.http_keepalive_expiry,
+        ),
+        timeout=timeout(settings.ai_text_timeout),
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Общий клиент; вне lifespan (скрипты) создаётся при первом обращении."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+    return _client
+
+
+async def _prewarm(client: httpx.AsyncClient):
+    try:
+        # Любой ответ подходит: нужно только открытое TLS-соединение в пуле
+        await client.head(PREWARM_URL, timeout=timeout(settings.http_connect_timeout))
+        print("[OK] HTTP client connection to api.groq.com is warm")
+    except httpx.HTTPError as e:
+        print(f"[WARNING] HTTP client prewarm failed: {type(e).__name__}: {str(e)[:100]}")
+
+
+async def start_http_client():
+    global _prewarm_task
+    client = get_http_client()
+    http2 = settings.http2 and HTTP2_AVAILABLE
+    print(f"[INFO] HTTP client: {'HTTP/2' if http2 else 'HTTP/1.1'}, "
+          f"up to {settings.http_max_connections} connections")
+    if settings.http_prewarm:
+        # В фоне: недоступный API не задерживает старт приложения
+        _prewarm_task = asyncio.create_task(_prewarm(client))
+
+
+async def close_http_client():
+    global _client, _prewarm_task
+    if _prewarm_task is not None and not _prewarm_task.done():
+        _prewarm_task.cancel()
+        try:
+            await _prewarm_task
+        except asyncio.CancelledError:
+            pass
+    _prewarm_task = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
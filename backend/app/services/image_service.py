@@ -0,0 +1,132 @@
+"""
+Подготовка изображений: сжатие загрузок и фото для анализа ИИ.
+
+Фото с телефона (5–10 МБ, 4000px, поворот в EXIF) уменьшается до
+размера, которого хватает модели, разворачивается по EXIF Orientation и
+перекодируется в JPEG не больше заданного числа байт: качество снижается
+ступенями, если этого мало — уменьшается и размер. Небольшое фото в
+нужном формате и без поворота отдаётся как есть, без повторного сжатия.
+MIME-тип определяется по содержимому, а не по заголовку клиента.
+
+Декодирование и кодирование занимают сотни миллисекунд процессора,
+поэтому async-функции выполняют их в пуле потоков (asyncio.to_thread),
+не блокируя event loop. Pillow отпускает GIL на время этой работы.
+"""
+
+import asyncio
+import io
+from typing import NamedTuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from app.config import get_settings
+
+settings = get_settings()
+
+# Максимальный размер исходного файла (10 MB)
+MAX_FILE_SIZE = 10 * 1024 * 1024
+
+# Сжатие загрузок (товары, аватары)
+UPLOAD_MAX_SIDE = 1200
+UPLOAD_JPEG_QUALITY = 85
+
+# Форматы, которые vision API принимает без перекодирования
+VISION_FORMATS = {"JPEG", "PNG", "WEBP"}
+# Ступени качества JPEG, пока файл не уложится в лимит байт
+VISION_QUALITIES = (85, 75, 65, 55)
+
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageError(ValueError):
+    """Файл не удалось прочитать как изображение."""
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+
+
+def _open(content: bytes) -> Image.Image:
+    try:
+        img = Image.open(io.BytesIO(content))
+    except (UnidentifiedImageError, OSError) as e:
+        raise ImageError("Файл не является изображением") from e
+    return img
+
+
+def _load(content: bytes, max_side: int) -> Image.Image:
+    """Открыть, развернуть по EXIF и привести к RGB."""
+    img = _open(content)
+    # JPEG декодируется сразу в уменьшенном масштабе — в разы быстрее
+    img.draft("RGB", (max_side, max_side))
+    try:
+        img = ImageOps.exif_transpose(img)
+    except OSError as e:
+        raise ImageError("Не удалось прочитать изображение") from e
+    if img.mode != "RGB":
+        # Прозрачность — на белый фон, а не на чёрный
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        else:
+            img = img.convert("RGB")
+    return img
+
+
+def _encode_jpeg(img: Image.Image, quality: int) -> bytes:
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def compress_image(content: bytes, max_side: int = UPLOAD_MAX_SIDE, quality: int = UPLOAD_JPEG_QUALITY) -> bytes:
+    """Сжать изображение до оптимального размера (JPEG)"""
+    img = _load(content, max_side)
+    if img.width > max_side or img.height > max_side:
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return _encode_jpeg(img, quality)
+
+
+def prepare_vision_image(content: bytes, max_side: int = 1024, max_bytes: int = 400_000) -> PreparedImage:
+    """Фото для vision API: не больше max_side пикселей по стороне и max_bytes байт."""
+    original = _open(content)
+    orientation = original.getexif().get(EXIF_ORIENTATION, 1)
+    if (
+        len(content) <= max_bytes
+        and original.format in VISION_FORMATS
+        and max(original.size) <= max_side
+        and orientation == 1
+    ):
+        return PreparedImage(content, Image.MIME[original.format], *original.size)
+
+    img = _load(content, max_side)
+    side = max_side
+    while True:
+        if img.width > side or img.height > side:
+            img.thumbnail((side, side), Image.Resampling.LANCZOS)
+        for quality in VISION_QUALITIES:
+            data = _encode_jpeg(img, quality)
+            if len(data) <= max_bytes:
+                return PreparedImage(data, "image/jpeg", img.width, img.height)
+        # Даже минимальное качество не уложилось — уменьшаем размер
+        side = int(max(img.size) * 0.75)
+        if side < 256:
+            return PreparedImage(data, "image/jpeg", img.width, img.height)
+
+
+async def compress_image_async(content: bytes) -> bytes:
+    return await asyncio.to_thread(compress_image, content)
+
+
+async def prepare_vision_image_async(content: bytes) -> PreparedImage:
+    return await asyncio.to_thread(
+        prepare_vision_image,
+        content,
+        settings.vision_image_max_side,
+        settings.vision_image_max_bytes,
+    )
@@ -0,0 +1,132 @@
+"""
+Отложенная запись просмотров товаров.
+
+GET /api/products/{id} не пишет в базу: просмотр попадает в буфер
+процесса {product_id: count}, а фоновая задача сбрасывает буфер одной
+пачкой $inc — раз в view_flush_interval секунд или сразу, когда
+в буфере набралось view_flush_threshold просмотров. При остановке
+приложения буфер сбрасывается в lifespan.
+
+Если запись не удалась, просмотры возвращаются в буфер и уйдут со
+следующим сбросом; при падении процесса несброшенные просмотры теряются.
+"""
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from pymongo import UpdateOne
+
+from app.config import get_settings
+from app.db.database import get_db
+
+settings = get_settings()
+
+
+class ViewCounter:
+    """Буфер инкрементов views по товарам с периодическим сбросом."""
+
+    def __init__(self, flush_interval: float = 5.0, flush_threshold: int = 500):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending: Dict[str, int] = {}
+        self._pending_total = 0
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed_views = 0
+        self.flush_errors = 0
+        self.last_flush_ms = 0.0
+
+    def record(self, product_id: str) -> int:
+        """Учесть просмотр; возвращает число ещё не записанных просмотров товара."""
+        count = self._pending.get(product_id, 0) + 1
+        self._pending[product_id] = count
+        self._pending_total += 1
+        self.recorded += 1
+        if self._pending_total >= self.flush_threshold:
+            self._wakeup.set()
+        return count
+
+    def pending(self, product_id: str) -> int:
+        return self._pending.get(product_id, 0)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую задачу и записать остаток буфера."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Записать буфер в базу; возвращает число записанных просмотров."""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            db = get_db()
+            if db is None:
+                return 0
+
+            batch, self._pending = self._pending, {}
+            self._pending_total = 0
+            started = time.perf_counter()
+            try:
+                await self._write(db, batch)
+            except Exception as e:
+                # Вернуть просмотры в буфер, поверх накопившихся за время записи
+                for product_id, count in batch.items():
+                    self._pending[product_id] = self._pending.get(product_id, 0) + count
+                    self._pending_total += count
+                self.flush_errors += 1
+                print(f"[WARNING] View counter flush failed: {str(e)[:100]}")
+                return 0
+
+            views = sum(batch.values())
+            self.flushes += 1
+            self.flushed_views += views
+            self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+            return views
+
+    async def _write(self, db, batch: Dict[str, int]):
+        # В SQLite одинаковые $inc по _id уходят одним executemany()
+        await db.products.bulk_write(
+            [UpdateOne({"_id": product_id}, {"$inc": {"views": count}}) for product_id, count in batch.items()],
+            ordered=False,
+        )
+
+    def stats(self) -> dict:
+        return {
+            "pending_products": len(self._pending),
+            "pending_views": self._pending_total,
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "flushed_views": self.flushed_views,
+            "flush_errors": self.flush_errors,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+
+view_counter = ViewCounter(
+    flush_interval=settings.view_flush_interval,
+    flush_threshold=settings.view_flush_threshold,
+)
@@ -0,0 +1,140 @@
+"""
+Фильтрация в Python: предкомпилированный матчер против прежнего разбора
+фильтра на каждый документ.
+
+legacy_matches() — SQLiteCollection._matches до app/db/matcher.py, без
+изменений, кроме того что text_fields передаётся аргументом. Он понимал
+меньше операторов, поэтому запросы ограничены тем, что умели оба.
+
+Запуск из backend/: python -m benchmarks.matcher_bench [число документов]
+"""
+
+import random
+import re
+import sys
+import time
+
+from app.db.matcher import compile_matcher
+from app.db.sqlite_query import search_terms
+
+REGIONS = ["Toshkent", "Samarqand", "Buxoro", "Farg'ona", "Andijon", "Namangan"]
+CATEGORIES = ["fruits", "vegetables", "grain", "seeds", "fertilizers"]
+WORDS = ["olma", "nok", "uzum", "anor", "pomidor", "bodring", "bug'doy", "urug'", "o'g'it", "sifatli"]
+
+QUERIES = {
+    "status + region $regex": {
+        "status": "active",
+        "region": {"$regex": "^sam", "$options": "i"},
+    },
+    "status + $or title/desc $regex": {
+        "status": "active",
+        "$or": [
+            {"title": {"$regex": "anor", "$options": "i"}},
+            {"description": {"$regex": "anor", "$options": "i"}},
+        ],
+    },
+    "status + category + price range": {
+        "status": "active",
+        "category": "fruits",
+        "price": {"$gte": 10_000, "$lte": 50_000},
+    },
+    "$text prefix search": {"$text": {"$search": "sifat ano"}},
+}
+
+TEXT_FIELDS = ("title", "description")
+
+
+def legacy_matches(doc: dict, query: dict, text_fields=TEXT_FIELDS) -> bool:
+    """Проверить, соответствует ли документ запросу."""
+    for key, value in query.items():
+        # Полнотекстовый поиск: каждое слово — префикс слова в текстовых полях
+        if key == "$text":
+            words = search_terms(" ".join(str(doc.get(f) or "") for f in text_fields))
+            terms = search_terms(value.get("$search", ""))
+            if not terms or not all(any(w.startswith(t) for w in words) for t in terms):
+                return False
+            continue
+
+        # Оператор $or
+        if key == "$or":
+            if not any(legacy_matches(doc, sub_q, text_fields) for sub_q in value):
+                return False
+            continue
+
+        # Вложенные операторы
+        if isinstance(value, dict):
+            doc_value = doc.get(key)
+
+            # $regex
+            if "$regex" in value:
+                pattern = value["$regex"]
+                flags = re.IGNORECASE if value.get("$options") == "i" else 0
+                if not re.search(pattern, str(doc_value or ""), flags):
+                    return False
+
+            # $gte, $lte
+            if "$gte" in value:
+                if (doc_value or 0) < value["$gte"]:
+                    return False
+            if "$lte" in value:
+                if (doc_value or 0) > value["$lte"]:
+                    return False
+
+            # $in
+            if "$in" in value:
+                if doc_value not in value["$in"]:
+                    return False
+        else:
+            # Простое сравнение
+            if doc.get(key) != value:
+                return False
+
+    return True
+
+
+def make_docs(count: int) -> list:
+    rng = random.Random(42)
+    return [
+        {
+            "_id": f"p{i}",
+            "status": rng.choice(["active", "active", "active", "sold"]),
+            "category": rng.choice(CATEGORIES),
+            "region": rng.choice(REGIONS),
+            "price": rng.randrange(1_000, 100_000),
+            "title": " ".join(rng.choices(WORDS, k=3)).capitalize(),
+            "description": " ".join(rng.choices(WORDS, k=12)),
+        }
+        for i in range(count)
+    ]
+
+
+def best_of(runs: int, func) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(count: int = 50_000, runs: int = 5):
+    docs = make_docs(count)
+    print(f"{count} documents, best of {runs}")
+    for name, query in QUERIES.items():
+        legacy = [doc["_id"] for doc in docs if legacy_matches(doc, query)]
+        matches = compile_matcher(query, TEXT_FIELDS)
+        compiled = [doc["_id"] for doc in docs if matches(doc)]
+        assert legacy == compiled, name
+
+        def run_compiled():
+            # Компиляция входит в замер: она выполняется на каждый запрос
+            matches = compile_matcher(query, TEXT_FIELDS)
+            return [doc for doc in docs if matches(doc)]
+
+        old = best_of(runs, lambda: [doc for doc in docs if legacy_matches(doc, query)])
+        new = best_of(runs, run_compiled)
+        print(f"  {name:<34} {old * 1000:7.1f} ms -> {new * 1000:7.1f} ms ({old / new:.1f}x), {len(compiled)} matches")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -0,0 +1,33 @@
+"""
+Проверка JWT: python-jose на каждый запрос против кэша decode_token().
+
+Запуск из backend/: python -m benchmarks.token_cache_bench [число проверок]
+"""
+
+import sys
+import time
+
+from app.services.auth_service import clear_token_cache, create_access_token, decode_token, verify_token
+
+
+def per_call(count: int, func, token: str) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        func(token)
+    return (time.perf_counter() - start) / count
+
+
+def main(count: int = 20_000):
+    token = create_access_token("user-1", "user")
+    assert decode_token(token) == verify_token(token)
+
+    clear_token_cache()
+    uncached = per_call(count, verify_token, token)
+    cached = per_call(count, decode_token, token)
+    print(f"{count} decodes of one HS256 token")
+    print(f"  verify_token  {uncached * 1e6:6.1f} us")
+    print(f"  decode_token  {cached * 1e6:6.1f} us ({uncached / cached:.0f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,20 @@
+import pytest
+
+from app.db import database
+from app.db.database import SQLiteDatabase
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(tmp_path, monkeypatch):
+    """Пустая SQLite-база, доступная коду через get_db()."""
+    sqlite_db = SQLiteDatabase(str(tmp_path / "test.db"))
+    await sqlite_db.connect()
+    monkeypatch.setattr(database, "_db_instance", sqlite_db)
+    monkeypatch.setattr(database, "_db_type", "sqlite")
+    yield sqlite_db
+    await sqlite_db.close()
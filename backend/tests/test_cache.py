@@ -0,0 +1,144 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import cache
+from app.cache import TTLCache
+from app.services import auth_service
+from app.services.ai_cache import AIResponseCache
+
+pytestmark = pytest.mark.anyio
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+# -----------------------------------------------------------------------------
+# TTLCache
+# -----------------------------------------------------------------------------
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    lru = TTLCache(maxsize=2, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+
+    assert lru.get("b") is None
+    assert (lru.get("a"), lru.get("c")) == (1, 3)
+    assert lru.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1, "hit_rate": 0.75}
+
+
+def test_ttl_cache_expires_entries(clock):
+    lru = TTLCache(maxsize=10, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2, ttl=5)
+
+    clock.now += 10
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+
+    clock.now += 60
+    assert lru.get("a", "default") == "default"
+    assert len(lru) == 0
+
+
+def test_ttl_cache_disabled_with_zero_size(clock):
+    lru = TTLCache(maxsize=0)
+    lru.set("a", 1)
+    assert lru.get("a") is None
+
+
+# -----------------------------------------------------------------------------
+# Кэш пользователей и токенов
+# -----------------------------------------------------------------------------
+
+async def test_cached_user_reads_db_once_until_invalidated(db, monkeypatch):
+    monkeypatch.setattr(auth_service, "_user_cache", TTLCache(maxsize=10, ttl=60))
+    await db.users.insert_one({"_id": "u1", "phone": "+998901111111", "name": "Ali"})
+
+    user = await auth_service.get_cached_user("u1")
+    user["name"] = "changed by caller"
+    await db.users.update_one({"_id": "u1"}, {"$set": {"name": "Vali"}})
+
+    # Копия из кэша: правка вызывающего кода и базы не видна до invalidate
+    assert (await auth_service.get_cached_user("u1"))["name"] == "Ali"
+    auth_service.invalidate_user("u1")
+    assert (await auth_service.get_cached_user("u1"))["name"] == "Vali"
+    assert await auth_service.get_cached_user("missing") is None
+    assert auth_service.user_cache_stats()["hits"] == 1
+
+
+def test_token_cache_stores_only_valid_tokens(monkeypatch):
+    monkeypatch.setattr(auth_service, "_token_cache", TTLCache(maxsize=10, ttl=3600))
+    token = auth_service.create_access_token("u1", "user")
+
+    payload = auth_service.decode_token(token)
+    payload["sub"] = "changed by caller"
+    assert auth_service.decode_token(token)["sub"] == "u1"
+    assert auth_service.decode_token(token + "x") is None
+    assert auth_service.token_cache_stats()["size"] == 1
+
+
+def test_token_cache_entry_does_not_outlive_exp(monkeypatch):
+    tokens = TTLCache(maxsize=10, ttl=3600)
+    monkeypatch.setattr(auth_service, "_token_cache", tokens)
+    monkeypatch.setattr(auth_service, "verify_token", lambda token: {"sub": "u1", "exp": time.time() + 30})
+
+    auth_service.decode_token("token")
+    (_, expires_at), = tokens._data.values()
+    assert expires_at - time.monotonic() <= 30
+
+
+# -----------------------------------------------------------------------------
+# Кэш ответов ИИ
+# -----------------------------------------------------------------------------
+
+def test_ai_cache_key_normalizes_question():
+    ai = AIResponseCache(persistent=False)
+    key = ai.key("Barglar nega sarg'ayyapti?", None, "model")
+
+    assert ai.key("  barglar NEGA sargʻayyapti ", None, "model") == key
+    assert ai.key("Barglar nega sarg'ayyapti?", None, "other-model") != key
+    assert ai.key("Barglar nega sarg'ayyapti?", [{"role": "user", "content": "salom"}], "model") is None
+    assert AIResponseCache(ttl=0).key("savol", None, "model") is None
+
+
+async def test_ai_cache_persists_between_processes(db):
+    first = AIResponseCache(ttl=60)
+    key = first.key("savol", None, "model")
+    await first.set(key, "javob", model="model")
+
+    # Новый экземпляр с пустой памятью читает ответ из коллекции
+    second = AIResponseCache(ttl=60)
+    assert await second.get(key) == "javob"
+    assert await second.get(key) == "javob"
+    stats = second.stats()
+    assert (stats["persistent_hits"], stats["memory"]["hits"]) == (1, 1)
+
+
+async def test_ai_cache_ignores_and_purges_expired_answers(db):
+    ai = AIResponseCache(ttl=60)
+    now = datetime.utcnow()
+    await db.ai_cache.insert_many([
+        {"_id": "old", "text": "eski", "expires_at": now - timedelta(seconds=1)},
+        {"_id": "new", "text": "yangi", "expires_at": now + timedelta(seconds=60)},
+    ])
+
+    assert await ai.get("old") is None
+    assert await ai.get("new") == "yangi"
+    assert await ai.purge_expired() == 1
+    assert await db.ai_cache.count_documents({}) == 1
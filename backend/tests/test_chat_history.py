@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import pytest
+
+from app.services.chat_history import ChatHistoryStore, new_session_message
+from app.services.context_builder import ContextBuilder
+
+pytestmark = pytest.mark.anyio
+
+
+async def create_session(db, session_id="s1", user_id="u1"):
+    now = datetime.utcnow().isoformat()
+    await db.chat_sessions.insert_one({
+        "_id": session_id,
+        "user_id": user_id,
+        "title": "Yangi chat",
+        "messages": [],
+        "created_at": now,
+        "updated_at": now,
+    })
+
+
+def turn(i: int) -> list:
+    return [
+        new_session_message("user", f"savol {i} " + "x" * 60),
+        new_session_message("assistant", f"javob {i} " + "y" * 60),
+    ]
+
+
+async def test_load_returns_last_messages(db):
+    await create_session(db)
+    store = ChatHistoryStore(limit=5)
+    assert await store.load("s1", "u1") == []
+    for i in range(4):
+        assert await store.append("s1", "u1", turn(i), first=i == 0)
+
+    cached = await store.load("s1", "u1")
+    store.invalidate("s1")
+    loaded = await store.load("s1", "u1")
+    assert cached == loaded
+    assert [m["content"][:8] for m in loaded] == ["javob 1 ", "savol 2 ", "javob 2 ", "savol 3 ", "javob 3 "]
+    assert all(m["id"] for m in loaded)
+
+    session = await db.chat_sessions.find_one({"_id": "s1"})
+    assert len(session["messages"]) == 8
+    assert session["title"].startswith("savol 0")
+
+
+async def test_foreign_or_missing_session(db):
+    await create_session(db)
+    store = ChatHistoryStore()
+    assert await store.load("s1", "u1") == []
+    assert await store.load("s1", "u2") is None
+    assert await store.load("missing", "u1") is None
+    assert not await store.append("s1", "u2", turn(0))
+    assert not await store.append("missing", "u1", turn(0))
+
+
+async def test_summary_reused_past_history_limit(db):
+    await create_session(db)
+    store = ChatHistoryStore(limit=100)
+    calls = []
+
+    async def summarize(previous, turns):
+        calls.append(previous)
+        return f"summary#{len(calls)}"
+
+    builder = ContextBuilder(summarize, budget=200)
+    for i in range(120):
+        history = await store.load("s1", "u1")
+        builder.build(history, "s1")
+        await builder.wait()
+        await store.append("s1", "u1", turn(i), first=i == 0)
+        if i % 30 == 0:
+            # Сессия перечитывается из базы, окно сдвинулось
+            store.invalidate("s1")
+
+    # Содержание строится один раз и дальше только дополняется
+    assert calls[0] is None
+    assert all(previous is not None for previous in calls[1:])
+    assert len(calls) < 120 // 2
+    history = await store.load("s1", "u1")
+    assert len(history) == 100
+    summary, recent = builder.build(history, "s1")
+    assert summary == f"summary#{len(calls)}"
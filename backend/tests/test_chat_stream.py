@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI
+
+from app.routers import chat
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeAI:
+    """Провайдер, который отдаёт один токен и зависает."""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.closed = False
+
+    async def stream_response(self, message, conversation_id=None, history=None):
+        try:
+            yield {"type": "token", "text": "Salom"}
+            self.started.set()
+            await asyncio.sleep(3600)
+            yield {"type": "done", "text": "Salom", "suggestions": []}
+        finally:
+            self.closed = True
+
+
+class ClientRequest:
+    def __init__(self):
+        self.gone = False
+
+    async def is_disconnected(self):
+        return self.gone
+
+
+async def call_stream(app, receive):
+    sent = []
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/api/chat/message/stream",
+        "raw_path": b"/api/chat/message/stream",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"host", b"test")],
+        "client": ("127.0.0.1", 1),
+        "server": ("test", 80),
+    }
+
+    async def send(message):
+        sent.append(message)
+
+    await asyncio.wait_for(app(scope, receive, send), 5)
+    return b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+
+
+async def test_disconnect_mid_stream_closes_upstream(monkeypatch):
+    ai = FakeAI()
+    monkeypatch.setattr(chat, "ai_service", ai)
+    app = FastAPI()
+    app.include_router(chat.router, prefix="/api/chat")
+    body = json.dumps({"message": "salom"}).encode()
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # Клиент уходит, пока провайдер молчит после первого токена
+        await ai.started.wait()
+        return {"type": "http.disconnect"}
+
+    tasks_before = asyncio.all_tasks()
+    data = await call_stream(app, receive)
+    assert b"event: token" in data and b"event: done" not in data
+    assert ai.closed
+    # Ни одного осиротевшего __anext__
+    assert asyncio.all_tasks() - tasks_before == set()
+
+
+async def test_while_connected_polls_disconnect():
+    ai = FakeAI()
+    request = ClientRequest()
+    received = []
+
+    async def consume():
+        async for event in chat.while_connected(ai.stream_response("salom"), request, interval=0.01):
+            received.append(event)
+
+    task = asyncio.ensure_future(consume())
+    await ai.started.wait()
+    request.gone = True
+    await asyncio.wait_for(task, 5)
+    assert [e["type"] for e in received] == ["token"]
+    assert ai.closed
+
+
+async def test_while_connected_cancelled_while_waiting():
+    ai = FakeAI()
+    events = chat.while_connected(ai.stream_response("salom"), ClientRequest(), interval=0.01)
+    assert (await events.__anext__())["type"] == "token"
+
+    task = asyncio.ensure_future(events.__anext__())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert ai.closed
+    await events.aclose()
@@ -0,0 +1,67 @@
+import pytest
+
+from app.services.context_builder import ContextBuilder
+
+pytestmark = pytest.mark.anyio
+
+
+class Summarizer:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, previous, turns):
+        self.calls.append((previous, [t["content"] for t in turns]))
+        return f"summary#{len(self.calls)}"
+
+
+def message(i: int) -> dict:
+    return {"id": f"m{i}", "role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " + "x" * 60}
+
+
+async def test_summary_survives_sliding_window():
+    summarize = Summarizer()
+    builder = ContextBuilder(summarize, budget=200)
+    session = []
+    for turn in range(150):
+        session += [message(2 * turn), message(2 * turn + 1)]
+        # Окно последних 100 сообщений, как у ChatHistoryStore
+        summary, recent = builder.build(session[-100:], "s1")
+        await builder.wait()
+        if turn > 10:
+            assert summary is not None
+            assert recent[-1]["content"] == session[-1]["content"]
+
+    # Содержание дополняется по частям, а не пересчитывается на каждом ходу
+    assert len(summarize.calls) < 150 // 2
+    for previous, turns in summarize.calls[1:]:
+        assert previous is not None
+        assert len(turns) < 20
+    # Каждое сообщение до окна свёрнуто ровно один раз
+    folded = [content for _, turns in summarize.calls for content in turns]
+    assert len(folded) == len(set(folded))
+
+
+async def test_summary_continues_when_boundary_left_window():
+    summarize = Summarizer()
+    builder = ContextBuilder(summarize, budget=200)
+    session = [message(i) for i in range(40)]
+    builder.build(session, "s1")
+    await builder.wait()
+
+    # Граница содержания уже не в окне: старый текст остаётся контекстом
+    summary, _ = builder.build(session[-10:] + [message(i) for i in range(40, 50)], "s1")
+    await builder.wait()
+    assert summary == "summary#1"
+    assert summarize.calls[-1][0] == "summary#1"
+
+
+async def test_no_summary_without_session_or_ids():
+    summarize = Summarizer()
+    builder = ContextBuilder(summarize, budget=200)
+    session = [message(i) for i in range(40)]
+
+    summary, recent = builder.build(session, None)
+    assert summary is None and len(recent) < len(session)
+    builder.build([{k: v for k, v in m.items() if k != "id"} for m in session], "s1")
+    await builder.wait()
+    assert summarize.calls == []
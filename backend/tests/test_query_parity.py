@@ -0,0 +1,92 @@
+import re
+from datetime import datetime
+
+import pytest
+
+from app.db.matcher import compile_matcher
+
+pytestmark = pytest.mark.anyio
+
+DOCS = [
+    {"_id": "p1", "status": "active", "price": 10, "tags": ["olma", "nok"], "title": "Olma",
+     "created_at": datetime(2025, 1, 1)},
+    {"_id": "p2", "status": "active", "price": 10.5, "tags": ["nok"], "title": "Nok",
+     "created_at": datetime(2025, 2, 1)},
+    {"_id": "p3", "status": "sold", "price": "12", "tags": "olma", "title": 12},
+    {"_id": "p4", "status": "draft", "price": None, "tags": [], "title": None},
+    {"_id": "p5", "status": "active", "price": [5, 20], "tags": [None, "uzum"], "title": ["Uzum", "Anor"]},
+    {"_id": "p6", "price": True, "tags": [["olma"]], "meta": {"price": 10}},
+    {"_id": "p7", "status": "active", "tags": [1, 2.5, "3"], "title": "[\"olma\"]"},
+]
+
+FILTERS = [
+    # Скаляр против поля-массива
+    {"tags": "olma"},
+    {"tags": "nok", "status": "active"},
+    {"tags": 1},
+    {"tags": None},
+    {"tags": {"$ne": "olma"}},
+    {"tags": {"$eq": "uzum"}},
+    # $in / $nin против массивов
+    {"tags": {"$in": ["uzum", "nok"]}},
+    {"tags": {"$in": [None]}},
+    {"tags": {"$in": []}},
+    {"tags": {"$nin": ["olma"]}},
+    {"tags": {"$nin": [None, "nok"]}},
+    {"price": {"$in": [10, "12"]}},
+    # Сравнения разных типов
+    {"price": {"$gt": 9}},
+    {"price": {"$gte": 10, "$lt": 11}},
+    {"price": {"$lt": "2"}},
+    {"price": {"$gt": "1"}},
+    {"price": {"$lte": 1}},
+    {"price": {"$gt": None}},
+    {"tags": {"$gt": 2}},
+    {"tags": {"$gte": "3"}},
+    {"title": {"$gt": "N"}},
+    {"created_at": {"$gte": datetime(2025, 1, 15)}},
+    {"status": {"$gt": "b"}},
+    # null, отсутствие, отрицания
+    {"price": None},
+    {"price": {"$ne": None}},
+    {"price": {"$exists": False}},
+    {"price": {"$exists": True}},
+    {"status": {"$exists": False}},
+    {"status": {"$ne": "active"}},
+    {"status": {"$nin": ["active", "sold"]}},
+    {"meta": {"$exists": True}},
+    # $regex только по строкам
+    {"title": {"$regex": "^o", "$options": "i"}},
+    {"title": re.compile("an", re.IGNORECASE)},
+    {"title": {"$regex": "1"}},
+    {"title": {"$regex": "olma"}},
+    {"price": {"$regex": "1"}},
+    # Логические операторы
+    {"$or": [{"tags": "olma"}, {"price": {"$gt": 15}}]},
+    {"$nor": [{"tags": "nok"}, {"price": {"$lt": 10}}]},
+    {"$and": [{"status": "active"}, {"$nor": [{"title": None}]}]},
+]
+
+
+@pytest.mark.parametrize("query", FILTERS, ids=[str(f) for f in FILTERS])
+async def test_sql_matches_python(db, query):
+    await db.products.insert_many([dict(doc) for doc in DOCS])
+    assert db.products._compile(query) is not None
+
+    sql_ids = sorted([doc["_id"] async for doc in db.products.find(query)])
+    matches = compile_matcher(query)
+    all_docs = await db.products.find({}).to_list(length=None)
+    python_ids = sorted(doc["_id"] for doc in all_docs if matches(doc))
+    assert sql_ids == python_ids
+
+
+async def test_dotted_paths_cross_arrays(db):
+    await db.products.insert_many([
+        {"_id": "a", "variants": [{"size": "S"}, {"size": "M"}]},
+        {"_id": "b", "variants": {"size": "S"}},
+        {"_id": "c", "variants": [{"size": "L"}]},
+    ])
+    query = {"variants.size": "S"}
+    # Не компилируется: json_extract() не проходит по элементам массива
+    assert db.products._compile(query) is None
+    assert sorted([doc["_id"] async for doc in db.products.find(query)]) == ["a", "b"]
@@ -0,0 +1,289 @@
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo import DeleteMany, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from app.db import database
+from app.db.database import find_page, text_search_query
+
+pytestmark = pytest.mark.anyio
+
+BASE = datetime(2025, 1, 1, 12, 0, 0)
+
+
+def product(i: int, **fields) -> dict:
+    doc = {
+        "_id": f"p{i:03d}",
+        "title": f"Mahsulot {i}",
+        "status": "active" if i % 3 else "sold",
+        "category": "meva" if i % 2 else "sabzavot",
+        "price": i * 10,
+        "meta": {"color": "red" if i % 4 == 0 else "green"},
+        "created_at": BASE + timedelta(minutes=i),
+    }
+    doc.update(fields)
+    return doc
+
+
+@pytest.fixture
+async def products(db):
+    await db.products.insert_many([product(i) for i in range(1, 31)])
+    return db.products
+
+
+# -----------------------------------------------------------------------------
+# find_page
+# -----------------------------------------------------------------------------
+
+async def test_find_page_returns_page_and_total(products):
+    query = {"status": "active"}
+    expected = sorted(
+        (product(i) for i in range(1, 31) if i % 3),
+        key=lambda doc: doc["created_at"],
+        reverse=True,
+    )
+
+    docs, total = await products.find_page(query, [("created_at", -1)], 5, 5)
+
+    assert total == len(expected) == 20
+    assert [doc["_id"] for doc in docs] == [doc["_id"] for doc in expected[5:10]]
+
+
+async def test_find_page_skip_past_end_still_counts(products):
+    docs, total = await products.find_page({"status": "sold"}, [("price", 1)], 100, 5)
+    assert docs == []
+    assert total == 10
+
+    docs, total = await products.find_page({"status": "missing"}, None, 0, 5)
+    assert (docs, total) == ([], 0)
+
+
+async def test_find_page_python_fallback_matches_sql(products):
+    # Вложенное поле без generated-колонки фильтруется в Python
+    query = {"meta.color": "red"}
+    assert products._compile(query) is None
+
+    docs, total = await products.find_page(query, [("price", -1)], 1, 3)
+
+    assert total == 7
+    assert [doc["price"] for doc in docs] == [240, 200, 160]
+
+
+async def test_find_page_cached_total(products, monkeypatch):
+    monkeypatch.setattr(database, "LARGE_TOTAL", 10)
+    database._total_cache.clear()
+    query = {"category": "meva"}
+
+    docs, total = await find_page(products, query, [("price", 1)], 0, 2, cache_total=True)
+    assert total == 15
+    assert [doc["price"] for doc in docs] == [10, 30]
+
+    await products.insert_one(product(99, category="meva"))
+
+    # total из кэша, страница — актуальная
+    docs, total = await find_page(products, query, [("price", 1)], 14, 2, cache_total=True)
+    assert total == 15
+    assert [doc["price"] for doc in docs] == [290, 990]
+
+    _, total = await find_page(products, query, [("price", 1)], 0, 2)
+    assert total == 16
+    database._total_cache.clear()
+
+
+# -----------------------------------------------------------------------------
+# Курсоры
+# -----------------------------------------------------------------------------
+
+async def test_cursor_iterates_across_batches(products):
+    cursor = products.find({"status": "active"}).skip(3).limit(12).batch_size(4)
+    ids = [doc["_id"] async for doc in cursor]
+
+    active = [f"p{i:03d}" for i in range(1, 31) if i % 3]
+    assert ids == active[3:15]
+
+
+async def test_sorted_cursor_iterates_across_batches(products):
+    cursor = products.find({}, {"price": 1, "_id": 0}).sort("price", -1).skip(2).batch_size(7)
+    docs = [doc async for doc in cursor]
+
+    assert docs == [{"price": i * 10} for i in range(28, 0, -1)]
+
+
+async def test_fallback_cursor_filters_skips_and_projects(products):
+    query = {"meta.color": "green"}
+    cursor = products.find(query, {"title": 1}).skip(2).limit(5).batch_size(3)
+    docs = [doc async for doc in cursor]
+
+    green = [i for i in range(1, 31) if i % 4]
+    assert docs == [{"_id": f"p{i:03d}", "title": f"Mahsulot {i}"} for i in green[2:7]]
+
+    sorted_docs = await products.find(query).sort("price", -1).to_list(length=3)
+    assert [doc["price"] for doc in sorted_docs] == [300, 290, 270]
+
+
+async def test_cursor_close_stops_iteration(products):
+    cursor = products.find({}).batch_size(2)
+    seen = []
+    async for doc in cursor:
+        seen.append(doc["_id"])
+        if len(seen) == 3:
+            await cursor.close()
+    assert seen == ["p001", "p002", "p003"]
+
+
+async def test_to_list_default_length(db):
+    await db.favorites.insert_many([{"_id": f"f{i:03d}", "user_id": "u1"} for i in range(150)])
+    assert len(await db.favorites.find({"user_id": "u1"}).to_list()) == 100
+    assert len(await db.favorites.find({"user_id": "u1"}).to_list(length=150)) == 150
+
+
+# -----------------------------------------------------------------------------
+# Массовые операции
+# -----------------------------------------------------------------------------
+
+async def test_bulk_write_in_one_transaction(products):
+    result = await products.bulk_write([
+        InsertOne(product(100)),
+        UpdateOne({"_id": "p001"}, {"$inc": {"price": 5}}),
+        UpdateOne({"_id": "new"}, {"$set": {"status": "draft"}}, upsert=True),
+        DeleteMany({"status": "sold"}),
+    ])
+
+    assert result.inserted_count == 1
+    assert result.modified_count == 1
+    assert result.upserted_ids == {2: "new"}
+    assert result.deleted_count == 10
+    assert (await products.find_one({"_id": "p001"}))["price"] == 15
+    assert await products.count_documents({}) == 22
+
+
+async def test_ordered_bulk_write_stops_at_error(products):
+    with pytest.raises(BulkWriteError) as error:
+        await products.bulk_write([
+            UpdateOne({"_id": "p001"}, {"$set": {"title": "yangi"}}),
+            InsertOne(product(1)),
+            UpdateOne({"_id": "p002"}, {"$set": {"title": "yangi"}}),
+        ])
+
+    details = error.value.details
+    assert [e["index"] for e in details["writeErrors"]] == [1]
+    assert details["nModified"] == 1
+    assert (await products.find_one({"_id": "p001"}))["title"] == "yangi"
+    assert (await products.find_one({"_id": "p002"}))["title"] == "Mahsulot 2"
+
+
+async def test_update_many_and_delete_many(products):
+    result = await products.update_many({"category": "meva"}, {"$set": {"status": "archived"}})
+    assert (result.matched_count, result.modified_count) == (15, 15)
+    assert await products.count_documents({"status": "archived"}) == 15
+
+    # Запасной путь в Python выбирает те же строки
+    result = await products.delete_many({"meta.color": "red", "status": "archived"})
+    assert result.deleted_count == 0
+    result = await products.delete_many({"meta.color": "red"})
+    assert result.deleted_count == 7
+    assert await products.count_documents({}) == 23
+
+
+async def test_unique_index_raises_duplicate_key(db):
+    await db.users.insert_one({"_id": "u1", "phone": "+998901111111", "username": None})
+    await db.users.insert_one({"_id": "u2", "phone": "+998902222222", "username": None})
+
+    with pytest.raises(DuplicateKeyError):
+        await db.users.insert_one({"_id": "u3", "phone": "+998901111111"})
+
+
+# -----------------------------------------------------------------------------
+# Индексы, FTS, проекции, кодек
+# -----------------------------------------------------------------------------
+
+async def query_plan(collection, query: dict, sort) -> str:
+    compiled = collection._compile(query)
+    order_by = compiled[0].compile_sort(sort)
+    sql, params = collection._select("data", compiled, order_by)
+    async with collection.pool.reader() as conn:
+        async with conn.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+            return " ".join(row[-1] for row in await cursor.fetchall())
+
+
+async def test_indexed_query_uses_generated_column_index(products):
+    plan = await query_plan(products, {"status": "active"}, [("created_at", -1), ("_id", -1)])
+    assert "USING INDEX ix_products_status_created_at_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+    plan = await query_plan(products, {"status": "active", "price": {"$gt": 10}}, [])
+    assert "USING INDEX ix_products_status" in plan
+
+
+async def test_text_search_uses_fts_with_prefixes(products):
+    await products.update_one({"_id": "p007"}, {"$set": {"description": "Shirin olma"}})
+    await products.update_one({"_id": "p008"}, {"$set": {"title": "Olmali sharbat"}})
+
+    query, sort = text_search_query("olm", ["title", "description"])
+    docs = await products.find(query).sort(sort).to_list()
+    assert sorted(doc["_id"] for doc in docs) == ["p007", "p008"]
+
+    # Триггеры FTS поддерживают индекс при удалении
+    await products.delete_one({"_id": "p008"})
+    docs = await products.find(query).to_list()
+    assert [doc["_id"] for doc in docs] == ["p007"]
+
+
+async def test_projection_include_and_exclude(products):
+    doc = await products.find_one({"_id": "p004"}, {"title": 1, "meta.color": 1})
+    assert doc == {"_id": "p004", "title": "Mahsulot 4", "meta": {"color": "red"}}
+
+    doc = await products.find_one({"_id": "p004"}, {"meta": 0, "created_at": 0, "_id": 0})
+    assert doc == {"title": "Mahsulot 4", "status": "active", "category": "sabzavot", "price": 40}
+
+
+async def test_codec_round_trips_datetimes(products):
+    doc = await products.find_one({"_id": "p001"})
+    assert doc["created_at"] == BASE + timedelta(minutes=1)
+    assert isinstance(doc["created_at"], datetime)
+
+    # Строки фиксированной ширины сравниваются в SQL как datetime
+    after = BASE + timedelta(minutes=29, seconds=30)
+    docs = await products.find({"created_at": {"$gte": after}}).to_list()
+    assert [doc["_id"] for doc in docs] == ["p030"]
+
+
+# -----------------------------------------------------------------------------
+# Дочерние таблицы массивов
+# -----------------------------------------------------------------------------
+
+def message(i: int) -> dict:
+    return {"id": f"m{i}", "role": "user", "content": f"xabar {i}", "created_at": (BASE + timedelta(seconds=i)).isoformat()}
+
+
+async def test_child_array_push_slice_and_items(db):
+    sessions = db.chat_sessions
+    await sessions.insert_one({"_id": "s1", "user_id": "u1", "messages": [message(0)]})
+    await sessions.insert_one({"_id": "s2", "user_id": "u1", "messages": []})
+    for i in range(1, 6):
+        await sessions.update_one({"_id": "s1"}, {"$push": {"messages": message(i)}})
+    await sessions.update_one({"_id": "s2"}, {"$push": {"messages": {"$each": [message(10), message(11)]}}})
+
+    doc = await sessions.find_one({"_id": "s1"})
+    assert [m["id"] for m in doc["messages"]] == ["m0", "m1", "m2", "m3", "m4", "m5"]
+
+    doc = await sessions.find_one({"_id": "s1"}, {"messages": {"$slice": -2}})
+    assert [m["id"] for m in doc["messages"]] == ["m4", "m5"]
+    assert doc["user_id"] == "u1"
+
+    doc = await sessions.find_one({"_id": "s1"}, {"messages": {"$slice": [1, 2]}, "user_id": 1})
+    assert doc == {"_id": "s1", "user_id": "u1", "messages": [message(1), message(2)]}
+
+    batches = [batch async for batch in sessions.child_items(batch_size=1)]
+    assert [list(batch) for batch in batches] == [["s1"], ["s2"]]
+    assert [m["id"] for m in batches[1]["s2"]] == ["m10", "m11"]
+
+    # Фильтр по элементам массива — запасной путь по собранному документу
+    docs = await sessions.find({"messages.id": "m11"}).to_list()
+    assert [doc["_id"] for doc in docs] == ["s2"]
+
+    # Строки дочерней таблицы удаляются вместе с документом
+    await sessions.delete_one({"_id": "s1"})
+    batches = [batch async for batch in sessions.child_items()]
+    assert [list(batch) for batch in batches] == [["s2"]]
@@ -0,0 +1,106 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from app.db.database import SQLiteConnectionPool
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def pool(tmp_path):
+    pool = SQLiteConnectionPool(str(tmp_path / "pool.db"), readers=2, acquire_timeout=0.2)
+    await pool.open()
+    async with pool.writer() as conn:
+        await conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT)")
+    yield pool
+    await pool.close()
+
+
+async def count(pool) -> int:
+    async with pool.reader() as conn:
+        async with conn.execute("SELECT COUNT(*) FROM items") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def test_writers_are_serialized(pool):
+    events = []
+
+    async def write(name):
+        async with pool.writer() as conn:
+            events.append(f"{name}:begin")
+            await conn.execute("INSERT INTO items (value) VALUES (?)", (name,))
+            await asyncio.sleep(0.05)
+            events.append(f"{name}:end")
+
+    await asyncio.gather(write("a"), write("b"))
+
+    # Второй писатель входит только после COMMIT первого
+    assert events in (
+        ["a:begin", "a:end", "b:begin", "b:end"],
+        ["b:begin", "b:end", "a:begin", "a:end"],
+    )
+    assert await count(pool) == 2
+
+
+async def test_writer_rolls_back_on_error(pool):
+    with pytest.raises(ValueError):
+        async with pool.writer() as conn:
+            await conn.execute("INSERT INTO items (value) VALUES ('x')")
+            raise ValueError
+
+    assert await count(pool) == 0
+    # Писатель снова доступен после ROLLBACK
+    async with pool.writer() as conn:
+        await conn.execute("INSERT INTO items (value) VALUES ('y')")
+    assert await count(pool) == 1
+
+
+async def test_reader_does_not_see_uncommitted_write(pool):
+    async with pool.writer() as conn:
+        await conn.execute("INSERT INTO items (value) VALUES ('x')")
+        assert await count(pool) == 0
+    assert await count(pool) == 1
+
+
+async def test_readers_are_read_only(pool):
+    async with pool.reader() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            await conn.execute("INSERT INTO items (value) VALUES ('x')")
+
+
+async def test_readers_run_concurrently_and_acquire_times_out(pool):
+    both_held = asyncio.Event()
+    release = asyncio.Event()
+    held = []
+
+    async def hold():
+        async with pool.reader() as conn:
+            held.append(conn)
+            if len(held) == pool.readers:
+                both_held.set()
+            await release.wait()
+
+    tasks = [asyncio.create_task(hold()) for _ in range(pool.readers)]
+    await asyncio.wait_for(both_held.wait(), 1)
+    assert held[0] is not held[1]
+
+    # Все читатели заняты: ожидание ограничено acquire_timeout
+    with pytest.raises(sqlite3.OperationalError):
+        await count(pool)
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert await count(pool) == 0
+
+
+async def test_pool_reopens_after_close(pool):
+    async with pool.writer() as conn:
+        await conn.execute("INSERT INTO items (value) VALUES ('x')")
+    await pool.close()
+    with pytest.raises(RuntimeError):
+        await count(pool)
+
+    await pool.open()
+    assert await count(pool) == 1
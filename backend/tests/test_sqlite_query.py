@@ -0,0 +1,28 @@
+import pytest
+
+from app.db.sqlite_query import QueryCompiler
+
+pytestmark = pytest.mark.anyio
+
+
+async def ids(cursor) -> list:
+    return sorted([doc["_id"] async for doc in cursor])
+
+
+async def test_nor_keeps_documents_without_field(db):
+    await db.products.insert_many([
+        {"_id": "a", "status": "active", "price": 10},
+        {"_id": "b", "status": "sold"},
+        {"_id": "c"},
+    ])
+
+    assert await ids(db.products.find({"$nor": [{"status": "sold"}]})) == ["a", "c"]
+    assert await ids(db.products.find({"$nor": [{"price": {"$gt": 5}}, {"status": "sold"}]})) == ["c"]
+    assert await ids(db.products.find({"$nor": [{"status": "active", "price": 10}]})) == ["b", "c"]
+    assert await ids(db.products.find({"$nor": [{"$nor": [{"status": "sold"}]}]})) == ["b"]
+
+
+def test_nor_compiles_to_sql():
+    sql, params = QueryCompiler().compile({"$nor": [{"status": "sold"}, {"price": {"$lt": 5}}]})
+    assert sql.startswith("NOT (COALESCE(")
+    assert set(params) == {"sold", 5}
@@ -0,0 +1,59 @@
+import json
+import sqlite3
+
+import pytest
+
+from app.db.sqlite_update import UpdateCompiler
+
+
+def apply_update(doc: dict, update: dict, array_filters=None) -> dict:
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE docs (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    conn.execute("INSERT INTO docs VALUES ('a', ?)", (json.dumps(doc),))
+    sql, params = UpdateCompiler(json.dumps, array_filters).compile(update)
+    conn.execute(f"UPDATE docs SET data = {sql} WHERE id = 'a'", params)
+    return json.loads(conn.execute("SELECT data FROM docs").fetchone()[0])
+
+
+def test_multi_field_inc_is_linear():
+    fields = {f"f{i}": i for i in range(40)}
+    update = {"$set": {"title": "x"}, "$inc": fields}
+
+    sql, params = UpdateCompiler(json.dumps).compile(update)
+    # Один json_set на все поля: параметр на каждое поле
+    assert len(params) == len(fields) + 1
+    assert sql.count("json_set(") == 1
+
+    doc = apply_update({"f0": 10, "f1": 1.5}, update)
+    assert doc["title"] == "x"
+    assert doc["f0"] == 10
+    assert doc["f1"] == 2.5
+    assert doc["f39"] == 39
+
+
+def test_operators_combined():
+    doc = apply_update(
+        {"a": 1, "old": True, "tags": ["x"], "items": [{"id": 1, "read": False}, {"id": 2, "read": False}]},
+        {
+            "$set": {"b.c": "d", "items.$[i].read": True},
+            "$inc": {"a": 2},
+            "$unset": {"old": ""},
+            "$push": {"tags": {"$each": ["y", "z"]}},
+        },
+        array_filters=[{"i.id": 2}],
+    )
+    assert doc == {
+        "a": 3,
+        "b": {"c": "d"},
+        "tags": ["x", "y", "z"],
+        "items": [{"id": 1, "read": False}, {"id": 2, "read": True}],
+    }
+
+
+def test_array_update_does_not_create_missing_field():
+    assert apply_update({"a": 1}, {"$set": {"items.$[].read": True}}) == {"a": 1}
+
+
+def test_conflicting_paths_rejected():
+    with pytest.raises(ValueError):
+        UpdateCompiler(json.dumps).compile({"$set": {"a": {}}, "$inc": {"a.b": 1}})